@@ -0,0 +1,175 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import os
+import json
+import Queue
+import multiprocessing
+
+from pylons import app_globals as g
+from ming.orm import ThreadLocalORMSession
+
+from allura.tasks.index_tasks import add_artifacts
+from allura.lib.exceptions import CompoundError
+from allura.lib import utils
+from . import base
+
+
+class ReindexAllCommand(base.Command):
+    min_args=1
+    max_args=1
+    usage = '<ini file>'
+    summary = ('Reindex all artifacts into solr, using several processes.  '
+               'Progress is saved to a checkpoint file, and an interrupted '
+               'run picks up where it left off when run again.')
+    parser = base.Command.standard_parser(verbose=True)
+    parser.add_option('--procs', dest='procs', type='int',
+                      default=multiprocessing.cpu_count(),
+                      help='number of worker processes (default: number of cpus)')
+    parser.add_option('--ranges', dest='ranges', type='int', default=None,
+                      help='number of ranges to split the artifacts into '
+                           '(default: 4 per worker process)')
+    parser.add_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+                      help='number of artifacts to send to solr at once')
+    parser.add_option('--checkpoint', dest='checkpoint', default='reindex-all.checkpoint',
+                      help='file to save progress to, and resume from')
+    parser.add_option('--restart', action='store_true', dest='restart',
+                      help='ignore an existing checkpoint and start over')
+    parser.add_option('--refs', action='store_true', dest='refs',
+                      help='also update artifact references')
+
+    def command(self):
+        self.basic_setup()
+        ranges = None
+        if not self.options.restart:
+            ranges = self._load_checkpoint()
+        if ranges is None:
+            ranges = self._split_ranges(self.options.ranges or self.options.procs * 4)
+            self._save_checkpoint(ranges)
+        else:
+            base.log.info('Resuming from checkpoint %s', self.options.checkpoint)
+        todo = [i for i, r in enumerate(ranges) if not r['done']]
+        base.log.info('Reindexing %s of %s ranges with %s processes',
+                      len(todo), len(ranges), self.options.procs)
+
+        progress = multiprocessing.Queue()
+        running = []
+        failed = []
+        while todo or running:
+            while todo and len(running) < self.options.procs:
+                i = todo.pop(0)
+                p = multiprocessing.Process(target=self._index_range,
+                        args=(i, ranges[i], progress), name='reindex-%s' % i)
+                p.start()
+                running.append(p)
+            self._update_progress(ranges, progress, timeout=1)
+            for p in running[:]:
+                if not p.is_alive():
+                    p.join()
+                    running.remove(p)
+                    if p.exitcode != 0:
+                        failed.append(p.name)
+        # pick up progress reported just before the last workers exited
+        self._update_progress(ranges, progress)
+
+        if all(r['done'] for r in ranges):
+            os.remove(self.options.checkpoint)
+            base.log.info('Reindex done')
+        else:
+            base.log.error('Reindex incomplete (failed workers: %s); run again to resume '
+                           'from %s', ', '.join(failed), self.options.checkpoint)
+            return 1
+
+    def _split_ranges(self, num_ranges):
+        '''Split the ArtifactReference ids into num_ranges contiguous ranges of
+        about the same size.  Each range covers start <= _id < end, where
+        None means unbounded.'''
+        from allura import model as M
+        total = M.ArtifactReference.query.find().count()
+        bounds = []
+        for i in range(1, num_ranges):
+            ref = M.ArtifactReference.query.find().sort('_id').skip(
+                    total * i // num_ranges).limit(1).first()
+            if ref and (not bounds or ref._id > bounds[-1]):
+                bounds.append(ref._id)
+        bounds = [None] + bounds + [None]
+        return [dict(start=start, end=end, last=None, done=False)
+                for start, end in zip(bounds, bounds[1:])]
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.options.checkpoint):
+            return None
+        with open(self.options.checkpoint) as fp:
+            return json.load(fp)['ranges']
+
+    def _save_checkpoint(self, ranges):
+        # write and rename, so an interruption never leaves a partial file
+        tmp_path = self.options.checkpoint + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(dict(ranges=ranges), fp)
+        os.rename(tmp_path, self.options.checkpoint)
+
+    def _update_progress(self, ranges, progress, timeout=None):
+        '''Record progress reported by the workers, and save a checkpoint if
+        there was any.'''
+        updated = False
+        while True:
+            try:
+                if timeout and not updated:
+                    i, last, done = progress.get(timeout=timeout)
+                else:
+                    i, last, done = progress.get_nowait()
+            except Queue.Empty:
+                break
+            ranges[i]['last'] = last
+            ranges[i]['done'] = done
+            updated = True
+        if updated:
+            self._save_checkpoint(ranges)
+
+    def _index_range(self, i, r, progress):
+        '''Worker process: index one range of artifacts, in chunks, reporting
+        the last id of each chunk once it is in solr.'''
+        from allura import model as M
+        # don't share the parent's session state
+        ThreadLocalORMSession.close_all()
+        q_id = {}
+        if r['last'] is not None:
+            q_id['$gt'] = r['last']
+        elif r['start'] is not None:
+            q_id['$gte'] = r['start']
+        if r['end'] is not None:
+            q_id['$lt'] = r['end']
+        query = dict(_id=q_id) if q_id else {}
+        last = r['last']
+        for refs in utils.chunked_find(M.ArtifactReference, query,
+                                       pagesize=self.options.chunk_size):
+            ref_ids = [ref._id for ref in refs]
+            try:
+                add_artifacts(ref_ids, update_solr=True, update_refs=self.options.refs)
+            except CompoundError, err:
+                base.log.exception('Error indexing artifacts:\n%r', err)
+                base.log.error('%s', err.format_error())
+            except Exception:
+                # add_artifacts raises a lone failure as it is
+                base.log.exception('Error indexing artifacts')
+            g.solr.flush()
+            ThreadLocalORMSession.flush_all()
+            ThreadLocalORMSession.close_all()
+            last = ref_ids[-1]
+            progress.put((i, last, False))
+        progress.put((i, last, True))
@@ -130,6 +130,8 @@ def command(self):
                         base.log.error('%s', err.format_error())
                     M.main_orm_session.flush()
                     M.main_orm_session.clear()
+        if self.options.solr and not self.options.tasks:
+            g.solr.flush()
         base.log.info('Reindex %s', 'queued' if self.options.tasks else 'done')
 
     def _chunked_add_artifacts(self, ref_ids):
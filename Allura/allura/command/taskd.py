@@ -19,6 +19,7 @@
 import os
 import time
 import Queue
+import threading
 from datetime import datetime, timedelta
 import signal
 import sys
@@ -41,6 +42,12 @@ class TaskdCommand(base.Command):
     parser = base.Command.standard_parser(verbose=True)
     parser.add_option('--only', dest='only', type='string', default=None,
                       help='only handle tasks of the given name(s) (can be comma-separated list)')
+    parser.add_option('--slots', dest='slots', type='int', default=None,
+                      help='number of tasks to run concurrently in this process, each in its own '
+                           'thread (default: taskd.slots from the config, or 1)')
+    parser.add_option('--batch-size', dest='batch_size', type='int', default=None,
+                      help='max number of ready tasks to claim from the queue at once '
+                           '(default: monq.batch_size from the config, or the number of slots)')
 
     def command(self):
         self.basic_setup()
@@ -68,7 +75,11 @@ def graceful_stop(self, signum, frame):
         self.keep_running = False
 
     def log_current_task(self, signum, frame):
-        entry = 'taskd pid %s is currently handling task %s' % (os.getpid(), getattr(self, 'task', None))
+        tasks = list(getattr(self, 'tasks', {}).values()) or [None]
+        # a single line, so that taskd_cleanup can find every running task
+        # with just the last line of the status log
+        entry = '; '.join('taskd pid %s is currently handling task %s' % (os.getpid(), task)
+                          for task in tasks)
         status_log.info(entry)
         base.log.info(entry)
 
@@ -77,9 +88,12 @@ def worker(self):
         name = '%s pid %s' % (os.uname()[1], os.getpid())
         wsgi_app = loadapp('config:%s#task' % self.args[0],relative_to=os.getcwd())
         poll_interval = asint(pylons.config.get('monq.poll_interval', 10))
+        slots = self.options.slots or asint(pylons.config.get('taskd.slots', 1))
+        batch_size = self.options.batch_size or asint(pylons.config.get('monq.batch_size', slots))
         only = self.options.only
         if only:
             only = only.split(',')
+        self.tasks = {}
 
         # errors get logged via regular logging and also recorded into the mongo task record
         # so this is generally not needed, and only present to avoid errors within
@@ -106,28 +120,97 @@ def waitfunc_checks_running():
                     raise StopIteration
             return waitfunc_checks_running
 
+        solr = pylons.app_globals.solr
+        if solr and solr.buffer_size:
+            # send buffered index updates from here, between tasks, rather
+            # than from within whichever task happens to fill the buffer
+            solr.auto_flush = False
+        else:
+            solr = None
+
+        def flush_solr_updates(force=False):
+            if solr and (force or solr.flush_due()):
+                try:
+                    solr.flush()
+                except Exception:
+                    base.log.exception('taskd error flushing solr updates')
+
+        def solr_flusher():
+            # a long task mustn't hold back the updates of the ones before it
+            interval = solr.buffer_timeout or poll_interval
+            while self.keep_running:
+                time.sleep(interval)
+                flush_solr_updates()
+
+        def flush_solr(func):
+            def waitfunc_flushes_solr():
+                # the queue is empty, so don't hold index updates back any longer
+                flush_solr_updates(force=True)
+                return func()
+            return waitfunc_flushes_solr
+
+        def run_task(task, slot=0):
+            self.tasks[slot] = task
+            try:
+                # Build the (fake) request
+                r = Request.blank('/--%s--/%s/' % (task.task_name, task._id),
+                                  {'task': task,
+                                   'wsgi.errors': wsgi_error_log,  # ErrorMiddleware records error details here
+                                   })
+                list(wsgi_app(r.environ, start_response))
+            finally:
+                del self.tasks[slot]
+            flush_solr_updates()
+
+        def slot_worker(slot):
+            while True:
+                task_id = pending.get()
+                if task_id is None:
+                    return
+                try:
+                    # load the task in this thread's own ORM session
+                    task = M.MonQTask.query.get(_id=task_id, state='busy', process=name)
+                    if task:
+                        run_task(task, slot)
+                except Exception as e:
+                    base.log.exception('taskd error %s in slot %s' % (e, slot))
+
         if pylons.app_globals.amq_conn:
             waitfunc = waitfunc_amqp
         else:
             waitfunc = waitfunc_noq
-        waitfunc = check_running(waitfunc)
+        waitfunc = check_running(flush_solr(waitfunc))
+        if solr:
+            flusher = threading.Thread(target=solr_flusher, name='taskd-solr-flusher')
+            flusher.daemon = True
+            flusher.start()
+        if slots > 1:
+            pending = Queue.Queue(maxsize=slots)
+            slot_threads = [threading.Thread(target=slot_worker, args=(slot,), name='taskd-slot-%s' % slot)
+                            for slot in range(slots)]
+            for t in slot_threads:
+                t.start()
+        claimed = []
         while self.keep_running:
             if pylons.app_globals.amq_conn:
                 pylons.app_globals.amq_conn.reset()
             try:
                 while self.keep_running:
-                    self.task = M.MonQTask.get(
-                            process=name,
-                            waitfunc=waitfunc,
-                            only=only)
-                    if self.task:
-                        # Build the (fake) request
-                        r = Request.blank('/--%s--/%s/' % (self.task.task_name, self.task._id),
-                                          {'task': self.task,
-                                           'wsgi.errors': wsgi_error_log,  # ErrorMiddleware records error details here
-                                           })
-                        list(wsgi_app(r.environ, start_response))
-                        self.task = None
+                    if not claimed:
+                        claimed = M.MonQTask.get_batch(
+                                process=name,
+                                size=batch_size,
+                                waitfunc=waitfunc,
+                                only=only)
+                    while claimed and self.keep_running:
+                        if slots > 1:
+                            try:
+                                pending.put(claimed[0]._id, timeout=1)
+                            except Queue.Full:
+                                continue
+                            claimed.pop(0)
+                        else:
+                            run_task(claimed.pop(0))
             except Exception as e:
                 if self.keep_running:
                     base.log.exception('taskd error %s; pausing for 10s before taking more tasks' % e)
@@ -136,6 +219,21 @@ def waitfunc_checks_running():
                     base.log.exception('taskd error %s' % e)
             finally:
                 wsgi_error_log.flush()
+        if slots > 1:
+            # drop whatever the slots haven't picked up yet, and let them
+            # finish the tasks they are running
+            while True:
+                try:
+                    pending.get_nowait()
+                except Queue.Empty:
+                    break
+            for t in slot_threads:
+                pending.put(None)
+            for t in slot_threads:
+                t.join()
+        # hand back tasks we claimed but never started
+        M.MonQTask.release(name)
+        flush_solr_updates(force=True)
         base.log.info('taskd pid %s stopping gracefully.' % os.getpid())
 
         if self.restart_when_done:
@@ -45,6 +45,7 @@ def command(self):
         self.taskd_status_log = self.args[1]
         self.stuck_pids = []
         self.error_tasks = []
+        self.released_tasks = []
         self.suspicious_tasks = []
 
         taskd_pids = self._taskd_pids()
@@ -67,12 +68,23 @@ def command(self):
         # find 'forsaken' tasks
         base.log.info('Seeking for forsaken busy tasks')
         tasks = [t for t in self._busy_tasks()
-                 if t not in self.error_tasks]  # skip seen tasks
+                 if t not in self.error_tasks
+                 and t not in self.released_tasks]  # skip seen tasks
         base.log.info('Found %s busy tasks on %s' % (len(tasks), self.hostname))
         for task in tasks:
             base.log.info('Verifying task %s' % task)
             pid = task.process.split()[-1]
-            if pid not in taskd_pids:
+            if task.time_start is None:
+                # claimed in a batch, but not started yet
+                if pid not in taskd_pids:
+                    base.log.info('Task is forsaken, but was never started. '
+                        'Setting state to \'ready\'')
+                    task.state = 'ready'
+                    task.process = None
+                    self.released_tasks.append(task)
+                else:
+                    base.log.info('...task is claimed by taskd pid %s, but not started yet' % pid)
+            elif pid not in taskd_pids:
                 # 'forsaken' task
                 base.log.info('Task is forsaken '
                     '(can\'t find taskd with given pid). '
@@ -109,6 +121,8 @@ def print_summary(self):
                 base.log.info('...to kill these processes run command with -k flag if you are sure they are really stuck')
         if self.error_tasks:
             base.log.info('Tasks marked as \'error\': %s' % self.error_tasks)
+        if self.released_tasks:
+            base.log.info('Unstarted tasks marked as \'ready\': %s' % self.released_tasks)
 
     def _busy_tasks(self, pid=None):
         regex = '^%s ' % self.hostname
@@ -165,14 +179,20 @@ def _check_task(self, taskd_pid, task):
 
     def _kill_stuck_taskd(self, pid):
         os.kill(int(pid), signal.SIGKILL)
-        # find all 'busy' tasks for this pid and mark them as 'error'
+        # find all 'busy' tasks for this pid and mark the ones it started as
+        # 'error'; the ones it claimed but never started can just be retried
         tasks = list(self._busy_tasks(pid=pid))
         base.log.info('...taskd pid %s has assigned tasks: %s. '
-                'setting state to \'error\' for all of them' % (pid, tasks))
+                'setting state to \'error\' for the started ones' % (pid, tasks))
         for task in tasks:
-            task.state = 'error'
-            task.result = 'Taskd has stuck with this task'
-            self.error_tasks.append(task)
+            if task.time_start is None:
+                task.state = 'ready'
+                task.process = None
+                self.released_tasks.append(task)
+            else:
+                task.state = 'error'
+                task.result = 'Taskd has stuck with this task'
+                self.error_tasks.append(task)
 
     def _complete_suspicious_tasks(self):
         complete_tasks = M.MonQTask.query.find({
@@ -455,12 +455,27 @@ def tarball(self, **kw):
         path = kw.pop('path', None)
         if not asbool(tg.config.get('scm.repos.tarball.enable', False)):
             raise exc.HTTPNotFound()
+        if asbool(tg.config.get('scm.repos.tarball.stream', False)):
+            redirect('tarball_stream' + ('?path=' + h.urlquote(path) if path else ''))
         rev = self._commit.url().split('/')[-2]
         status = c.app.repo.get_tarball_status(rev, path)
         if status is None:
             allura.tasks.repo_tasks.tarball.post(revision=rev, path=path)
         return dict(commit=self._commit, revision=rev, status=status)
 
+    @expose()
+    def tarball_stream(self, path=None, **kw):
+        if not (asbool(tg.config.get('scm.repos.tarball.enable', False)) and
+                asbool(tg.config.get('scm.repos.tarball.stream', False))):
+            raise exc.HTTPNotFound()
+        rev = self._commit.url().split('/')[-2]
+        filename = h.really_unicode(c.app.repo.tarball_filename(rev, path)).encode('utf-8')
+        response.headers['Content-Type'] = ''
+        response.content_type = 'application/zip'
+        response.headers.add(
+            'Content-Disposition', 'attachment;filename="%s.zip"' % filename)
+        return c.app.repo.tarball_stream(rev, path)
+
     @expose('json:')
     def tarball_status(self, path=None, **kw):
         if not asbool(tg.config.get('scm.repos.tarball.enable', False)):
@@ -523,6 +538,8 @@ def index(self, **kw):
             if request.path.endswith('/') and not self._path.endswith('/'):
                 cutout += 1
             tarball_url = quote('%starball' % unquote(request.path)[:-cutout])
+            if asbool(tg.config.get('scm.repos.tarball.stream', False)):
+                tarball_url += '_stream'
         return dict(
             repo=c.app.repo,
             commit=self._commit,
@@ -49,6 +49,7 @@
 import allura.tasks.event_tasks
 from allura import model as M
 from allura.lib.markdown_extensions import ForgeExtension
+from allura.lib.markdown_cache import MarkdownCache
 from allura.eventslistener import PostEvent
 
 from allura.lib import gravatar, plugin, utils
@@ -63,12 +64,21 @@
 
 
 class ForgeMarkdown(markdown.Markdown):
+    # set by Globals.forge_markdown
+    render_cache = None
+    render_context = None
+
     def convert(self, source):
         if len(source) > asint(config.get('markdown_render_max_length', 40000)):
             # if text is too big, markdown can take a long time to process it, so we return it as a plain text
             log.info('Text is too big. Skipping markdown processing')
             escaped = cgi.escape(h.really_unicode(source))
             return h.html.literal(u'<pre>%s</pre>' % escaped)
+        if self.render_cache is not None:
+            return self.render_cache.convert(self, source, self._convert)
+        return self._convert(source)
+
+    def _convert(self, source):
         try:
             return markdown.Markdown.convert(self, source)
         except Exception:
@@ -104,6 +114,9 @@ def __init__(self):
             self.solr = Solr(self.solr_server, self.solr_query_server,
                              commit=asbool(config.get('solr.commit', True)),
                              commitWithin=config.get('solr.commitWithin'),
+                             buffer_size=int(config.get('solr.buffer_size', 0)),
+                             buffer_timeout=int(config.get('solr.buffer_timeout', 0)),
+                             buffer_max=int(config.get('solr.buffer_max', 0)),
                              timeout=int(config.get('solr.long_timeout', 60)))
             self.solr_short_timeout = Solr(self.solr_server, self.solr_query_server,
                                            commit=asbool(config.get('solr.commit', True)),
@@ -114,6 +127,9 @@ def __init__(self):
             self.solr_short_timeout = None
         self.use_queue = asbool(config.get('use_queue', False))
 
+        # Setup rendered markdown cache
+        self.markdown_cache = MarkdownCache.from_config(config)
+
         # Load login/logout urls; only used for SFX logins
         self.login_url = config.get('auth.login_url', '/auth/')
         self.logout_url = config.get('auth.logout_url', '/auth/logout')
@@ -367,9 +383,12 @@ def highlight(self, text, lexer=None, filename=None):
 
     def forge_markdown(self, **kwargs):
         '''return a markdown.Markdown object on which you can call convert'''
-        return ForgeMarkdown(
+        md = ForgeMarkdown(
                 extensions=['codehilite', ForgeExtension(**kwargs), 'tables', 'toc', 'nl2br'], # 'fenced_code'
                 output_format='html4')
+        md.render_cache = self.markdown_cache
+        md.render_context = tuple(sorted(kwargs.items()))
+        return md
 
     @property
     def markdown(self):
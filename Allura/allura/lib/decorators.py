@@ -28,12 +28,21 @@
 
 from webob import exc
 
-def task(func):
-    '''Decorator to add some methods to task functions'''
+def task(func=None, coalesce=None):
+    '''Decorator to add some methods to task functions
+
+    Use @task(coalesce=some_func) to merge duplicate posts of a task into one
+    that is still waiting in the queue.  some_func is called with the args of
+    each post and returns None (don't coalesce this one) or a dict describing
+    how to merge it; see MonQTask.post
+    '''
+    if func is None:
+        return lambda func: task(func, coalesce=coalesce)
     def post(*args, **kwargs):
         from allura import model as M
         delay = kwargs.pop('delay', 0)
-        return M.MonQTask.post(func, args, kwargs, delay=delay)
+        spec = coalesce(*args, **kwargs) if coalesce else None
+        return M.MonQTask.post(func, args, kwargs, delay=delay, coalesce=spec)
     # if decorating a class, have to make it a staticmethod
     # or it gets a spurious cls argument
     func.post = staticmethod(post) if inspect.isclass(func) else post
@@ -0,0 +1,176 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Caches for markdown rendered by ForgeMarkdown.convert.
+
+Rendered html is keyed by a hash of the source and the render context (the
+ForgeExtension options, and the current project and tool, which shortlinks
+are resolved against).  Each entry remembers what the shortlinks in the source
+resolved to, and is only used if they still resolve the same way.  Sources
+with macros are never cached, since macro output can change at any time.
+"""
+
+import re
+import time
+import logging
+import threading
+from hashlib import sha1
+from collections import OrderedDict
+
+from pylons import tmpl_context as c
+from paste.deploy.converters import asint
+
+from allura.lib import helpers as h
+from allura.lib.markdown_extensions import MACRO_PATTERN
+
+log = logging.getLogger(__name__)
+
+macro_re = re.compile(MACRO_PATTERN)
+
+
+class MarkdownCache(object):
+    '''Base class for markdown render caches.  Subclasses store and fetch
+    entries, which are dicts with html, links and timestamp keys.'''
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+
+    @classmethod
+    def from_config(cls, config):
+        '''Return the cache configured by markdown_cache.* settings, or None'''
+        backend = config.get('markdown_cache.backend')
+        ttl = asint(config.get('markdown_cache.ttl', 0)) or None
+        if backend == 'memory':
+            return MemoryMarkdownCache(
+                max_entries=asint(config.get('markdown_cache.max_entries', 10000)),
+                ttl=ttl)
+        elif backend == 'mongo':
+            return MongoMarkdownCache(
+                ttl=ttl,
+                cleanup_interval=asint(config.get('markdown_cache.cleanup_interval', 3600)))
+        elif backend:
+            log.warning('Unknown markdown_cache.backend %r, not caching markdown', backend)
+        return None
+
+    def get(self, key):
+        raise NotImplementedError, 'get'
+
+    def set(self, key, entry):
+        raise NotImplementedError, 'set'
+
+    def key(self, source, context):
+        project = getattr(c, 'project', None)
+        app = getattr(c, 'app', None)
+        context = (context,
+                   project and project._id,
+                   app and app.config._id)
+        return sha1(h.really_unicode(source).encode('utf-8') + '\0' +
+                    repr(context)).hexdigest()
+
+    def convert(self, md, source, render):
+        '''Return the cached html for md.convert(source), or render it with
+        render(source) and cache the result.'''
+        if macro_re.search(source):
+            return render(source)
+        key = self.key(source, md.render_context)
+        links = md.treeprocessors['links']
+        links.reset()
+        entry = self.get(key)
+        if entry is not None:
+            current = self._current_links(entry)
+            if current is not None:
+                # leave md as if it had rendered the source, for callers
+                # that look at the links found
+                links.lookups = dict((l['link'], l['url']) for l in entry['links'])
+                links.alinks = [current[l['link']] for l in entry['links'] if l['url']]
+                return h.html.literal(entry['html'])
+        html = render(source)
+        if links.cacheable:
+            self.set(key, dict(
+                html=unicode(html),
+                links=[dict(link=l, url=url) for l, url in links.lookups.iteritems()],
+                timestamp=time.time()))
+        return html
+
+    def _current_links(self, entry):
+        '''If entry is still valid, return what its links resolve to now
+        (link -> Shortlink or None), otherwise None'''
+        from allura import model as M
+        if self.ttl and time.time() - entry['timestamp'] > self.ttl:
+            return None
+        if not entry['links']:
+            return {}
+        current = M.Shortlink.from_links(*[l['link'] for l in entry['links']])
+        for l in entry['links']:
+            shortlink = current.get(l['link'])
+            if (shortlink and shortlink.url) != l['url']:
+                return None
+        return current
+
+
+class MemoryMarkdownCache(MarkdownCache):
+    '''Per-process cache of the most recently used max_entries renders'''
+
+    def __init__(self, max_entries=10000, ttl=None):
+        super(MemoryMarkdownCache, self).__init__(ttl=ttl)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class MongoMarkdownCache(MarkdownCache):
+    '''Cache shared by all processes, in the markdown_cache collection.
+    Entries older than the ttl are never used; each process removes them
+    with remove_expired() on its first write every cleanup_interval
+    seconds.'''
+
+    def __init__(self, ttl=None, cleanup_interval=3600):
+        super(MongoMarkdownCache, self).__init__(ttl=ttl)
+        self.cleanup_interval = cleanup_interval
+        self._last_cleanup = time.time()
+
+    def get(self, key):
+        from allura import model as M
+        return M.MarkdownCacheDoc.m.get(_id=key)
+
+    def set(self, key, entry):
+        from allura import model as M
+        M.MarkdownCacheDoc.m.update_partial(
+            dict(_id=key), {'$set': entry}, upsert=True)
+        if self.ttl and time.time() - self._last_cleanup > self.cleanup_interval:
+            self._last_cleanup = time.time()
+            self.remove_expired()
+
+    def remove_expired(self):
+        from allura import model as M
+        if self.ttl:
+            M.MarkdownCacheDoc.m.remove(dict(timestamp={'$lt': time.time() - self.ttl}))
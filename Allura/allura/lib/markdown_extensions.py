@@ -129,11 +129,16 @@ def _expand_alink(self, link, is_link_with_brackets):
         if shortlink and not getattr(shortlink.ref.artifact, 'deleted', False):
             href = shortlink.url
             self.ext.forge_link_tree_processor.alinks.append(shortlink)
-        elif is_link_with_brackets:
-            href = h.urlquote(link)
-            classes += ' notfound'
+            self.ext.forge_link_tree_processor.lookups[link] = shortlink.url
+        else:
+            self.ext.forge_link_tree_processor.lookups[link] = None
+            if is_link_with_brackets:
+                href = h.urlquote(link)
+                classes += ' notfound'
         attach_link = link.split('/attachment/')
         if len(attach_link) == 2 and self.ext._use_wiki:
+            # attachments can come and go without the shortlink changing
+            self.ext.forge_link_tree_processor.cacheable = False
             shortlink = M.Shortlink.lookup(attach_link[0])
             if shortlink:
                 attach_status = ' notfound'
@@ -209,6 +214,10 @@ class ForgeLinkTreeProcessor(markdown.treeprocessors.Treeprocessor):
     def __init__(self, parent):
         self.parent = parent
         self.alinks = []
+        # what each looked up link resolved to, so cached renders can be
+        # checked against the current shortlinks
+        self.lookups = {}
+        self.cacheable = True
 
     def run(self, root):
         for node in root.getiterator('a'):
@@ -218,6 +227,8 @@ def run(self, root):
 
     def reset(self):
         self.alinks = []
+        self.lookups = {}
+        self.cacheable = True
 
 
 class MarkAsSafe(markdown.postprocessors.Postprocessor):
@@ -20,33 +20,62 @@
 from logging import getLogger
 from urllib import urlencode
 from itertools import imap
+from contextlib import contextmanager
 
 import markdown
 import jinja2
-from tg import redirect, url
+from tg import redirect, url, config
+from paste.deploy.converters import asint
 from pylons import tmpl_context as c, app_globals as g
 from pylons import request
 from pysolr import SolrError
 
 from allura.lib import helpers as h
+from allura.lib.security import filter_by_access
 from allura.model import ArtifactReference
 from .markdown_extensions import ForgeExtension
 
 log = getLogger(__name__)
 
+# ForgeMarkdown instances ready for reuse by indexing, so that each artifact
+# doesn't have to build the whole extension stack again
+_markdown_pool = []
+
+@contextmanager
+def pooled_markdown():
+    try:
+        md = _markdown_pool.pop()
+    except IndexError:
+        md = g.forge_markdown()
+    md.reset()
+    try:
+        yield md
+    finally:
+        _markdown_pool.append(md)
+
 def solarize(obj):
-    if obj is None: return None
+    return solarize_with_shortlinks(obj)[0]
+
+def solarize_with_shortlinks(obj):
+    '''Return the solr document for obj, and the shortlinks found in its
+    text, rendering the text with markdown only once.'''
+    if obj is None: return None, []
     doc = obj.index()
-    if doc is None: return None
+    if doc is None: return None, []
     # if index() returned doc without text, assume empty text
     if not doc.get('text'):
         doc['text'] = ''
     # Convert text to plain text (It usually contains markdown markup).
     # To do so, we convert markdown into html, and then strip all html tags.
-    text = doc['text']
-    text = g.markdown.convert(text)
+    source = doc['text']
+    with pooled_markdown() as md:
+        text = md.convert(source)
+        shortlinks = [link for link in md.treeprocessors['links'].alinks if link is not None]
     doc['text'] = jinja2.Markup.escape(text).striptags()
-    return doc
+    if len(source) > asint(config.get('markdown_render_max_length', 40000)):
+        # too big for ForgeMarkdown to render, so find the links separately
+        shortlinks = find_shortlinks(source)
+    return doc, shortlinks
 
 class SearchError(SolrError):
     pass
@@ -70,24 +99,53 @@ def search(q,short_timeout=False,ignore_errors=True,**kw):
             match = re.search(r'<pre>(.*)</pre>', str(e))
             raise SearchError('Error running search query: %s' % (match.group(1) if match else e))
 
-def search_artifact(atype, q, history=False, rows=10, short_timeout=False, **kw):
-    """Performs SOLR search.
+def search_artifact(atype, q, history=False, rows=10, short_timeout=False, fq=None, **kw):
+    """Performs SOLR search.  fq is a list of extra filter queries.
 
     Raises SearchError if SOLR returns an error.
     """
     # first, grab an artifact and get the fields that it indexes
-    a = atype.query.find().first()
-    if a is None: return # if there are no instance of atype, we won't find anything
-    fields = a.index()
+    fields = _artifact_fields(atype)
+    if fields is None: return # if there are no instance of atype, we won't find anything
     # Now, we'll translate all the fld:
     q = atype.translate_query(q, fields)
+    fq = _artifact_fq(fields, history) + (fq or [])
+    return search(q, fq=fq, rows=rows, short_timeout=short_timeout, ignore_errors=False, **kw)
+
+
+def count_artifacts(atype, queries, history=False, short_timeout=False):
+    """Count the artifacts matching each of queries, with one faceted SOLR
+    request.  Returns a list of hit counts, in the same order as queries.
+
+    Raises SearchError if SOLR returns an error (which a single malformed
+    query is enough for).
+    """
+    fields = _artifact_fields(atype)
+    if fields is None or not queries:
+        return [0] * len(queries)
+    facet_queries = [atype.translate_query(q, fields) for q in queries]
+    r = search('*:*', fq=_artifact_fq(fields, history), rows=0,
+               short_timeout=short_timeout, ignore_errors=False,
+               facet='true', **{'facet.query': facet_queries})
+    counts = (r.facets or {}).get('facet_queries', {}) if r is not None else {}
+    return [counts.get(q, 0) for q in facet_queries]
+
+
+def _artifact_fields(atype):
+    '''The solr fields indexed for atype, from any instance of it'''
+    a = atype.query.find().first()
+    if a is None: return None
+    return a.index()
+
+
+def _artifact_fq(fields, history):
     fq = [
         'type_s:%s' % fields['type_s'],
         'project_id_s:%s' % c.project._id,
         'mount_point_s:%s' % c.app.config.options.mount_point ]
     if not history:
         fq.append('is_history_b:False')
-    return search(q, fq=fq, rows=rows, short_timeout=short_timeout, ignore_errors=False, **kw)
+    return fq
 
 
 def search_app(q='', fq=None, app=True, **kw):
@@ -172,11 +230,20 @@ def add_matches(doc):
                 doc['title_match'] = title
                 doc['text_match'] = text or h.get_first(doc, 'text')
                 return doc
+            results = list(results)
+            # leave out what the user can't read, such as private tickets or
+            # posts in private forums; count stays solr's, so a page can be
+            # short
+            readable = set(filter_by_access([doc.get('id') for doc in results]))
+            results = [doc for doc in results if doc.get('id') in readable]
+            # look up all the posts at once
+            posts = ArtifactReference.artifacts_by_id(
+                [doc.get('id') for doc in results if doc.get('type_s', '') == 'Post'])
             def paginate_comment_urls(doc):
                 if doc.get('type_s', '') == 'Post':
-                    aref = ArtifactReference.query.get(_id=doc.get('id'))
-                    if aref and aref.artifact:
-                        doc['url_paginated'] = aref.artifact.url_paginated()
+                    post = posts.get(doc.get('id'))
+                    if post:
+                        doc['url_paginated'] = post.url_paginated()
                 return doc
             results = imap(historize_urls, results)
             results = imap(add_matches, results)
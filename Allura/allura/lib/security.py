@@ -19,7 +19,8 @@
 This module provides the security predicates used in decorating various models.
 """
 import logging
-from collections import defaultdict
+import threading
+from collections import defaultdict, OrderedDict
 
 from pylons import tmpl_context as c
 from pylons import request
@@ -55,15 +56,20 @@ def clear(self):
         'clear cache'
         self.users = {}
         self.projects = {}
+        self.reaching = {}
+        self.versions = {}
 
     def clear_user(self, user_id, project_id=None):
         if project_id == '*':
             to_remove = [(uid, pid) for uid, pid in self.users if uid == user_id]
+            to_remove += [(uid, pid) for uid, pid in self.reaching if uid == user_id]
         else:
             to_remove = [(user_id, project_id)]
         for uid, pid in to_remove:
             self.projects.pop(pid, None)
             self.users.pop((uid, pid), None)
+            self.reaching.pop((uid, pid), None)
+            self.versions.pop(pid, None)
 
     def load_user_roles(self, user_id, *project_ids):
         '''Load the credentials with all user roles for a set of projects'''
@@ -129,9 +135,37 @@ def user_roles(self, user_id, project_id=None):
             self.users[user_id, project_id] = roles
         return roles
 
+    def reaching_ids(self, user_id, project_id=None):
+        '''
+        :returns: a set of the ids of all ProjectRoles that given user_id has in project_id, directly or through other roles.  These are also cached across requests, see RoleClosureCache
+        '''
+        ids = self.reaching.get((user_id, project_id))
+        if ids is None:
+            if project_id is None:
+                ids = self.user_roles(user_id, project_id).reaching_ids_set
+            else:
+                # get the version before loading any roles, so that roles
+                # changed in between never get cached under the old version
+                version = self.role_version(project_id)
+                ids = role_closure_cache.get(user_id, project_id, version)
+                if ids is None:
+                    ids = frozenset(self.user_roles(user_id, project_id).reaching_ids)
+                    role_closure_cache.set(user_id, project_id, version, ids)
+            self.reaching[user_id, project_id] = ids
+        return ids
+
+    def role_version(self, project_id):
+        '''
+        :returns: the current version of project_id's roles, see allura.model.auth.project_role_version
+        '''
+        from allura import model as M
+        if project_id not in self.versions:
+            doc = M.project_role_version.m.get(_id=project_id)
+            self.versions[project_id] = doc and doc.version
+        return self.versions[project_id]
+
     def user_has_any_role(self, user_id, project_id, role_ids):
-        user_roles = self.user_roles(user_id=user_id, project_id=project_id)
-        return bool(set(role_ids)  & user_roles.reaching_ids_set)
+        return bool(set(role_ids) & self.reaching_ids(user_id, project_id))
 
     def users_with_named_role(self, project_id, name):
         """ returns in sorted order """
@@ -142,6 +176,41 @@ def userids_with_named_role(self, project_id, name):
         roles = self.project_roles(project_id)
         return RoleCache(self, roles.find(name=name)).userids_that_reach
 
+class RoleClosureCache(object):
+    '''
+    The reaching role ids of the most recently used (user, project) pairs,
+    shared by all requests in this process.  Each entry is tagged with the
+    project's role version, which changes whenever one of the project's
+    ProjectRoles is saved, so an entry is only used while the roles it was
+    computed from are unchanged.
+    '''
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, project_id, version):
+        with self._lock:
+            entry = self._entries.pop((user_id, project_id), None)
+            if entry is None: return None
+            self._entries[user_id, project_id] = entry
+        if entry[0] != version: return None
+        return entry[1]
+
+    def set(self, user_id, project_id, version, reaching_ids):
+        with self._lock:
+            self._entries.pop((user_id, project_id), None)
+            self._entries[user_id, project_id] = (version, reaching_ids)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+role_closure_cache = RoleClosureCache()
+
 class RoleCache(object):
 
     def __init__(self, cred, q):
@@ -285,7 +354,7 @@ def predicate(obj=obj, user=user, project=project, roles=None):
                     project = obj.root_project
                 else:
                     project = c.project.root_project
-            roles = cred.user_roles(user_id=user._id, project_id=project._id).reaching_ids
+            roles = cred.reaching_ids(user._id, project._id)
         chainable_roles = []
         for rid in roles:
             for ace in obj.acl:
@@ -314,6 +383,70 @@ def predicate(obj=obj, user=user, project=project, roles=None):
         return result
     return TruthyCallable(predicate)
 
+def has_access_many(objs, permission, user=None, project=None):
+    '''Return a list of the objs on which the given user has the permission
+    name; the same as checking has_access() on each of them, but faster.
+
+    The user's roles are looked up once, and artifacts of the same class,
+    app config and ACL are only checked once.
+    '''
+    from allura import model as M
+    if user is None: user = c.user
+    results = {}
+    allowed = []
+    for obj in objs:
+        if obj is None: continue
+        if (isinstance(obj, M.Artifact) and
+                type(obj).parent_security_context.im_func is
+                M.Artifact.parent_security_context.im_func):
+            key = (type(obj), obj.app_config_id, tuple(
+                (ace.access, ace.role_id, ace.permission) for ace in obj.acl))
+            if key not in results:
+                results[key] = has_access(obj, permission, user=user, project=project)()
+            result = results[key]
+        else:
+            result = has_access(obj, permission, user=user, project=project)()
+        if result:
+            allowed.append(obj)
+    return allowed
+
+def filter_by_access(items, permission='read', user=None):
+    '''Return the items (artifacts, or artifact index ids) on which the given
+    user has the permission name, in their original order.
+
+    Index ids are looked up with one query per artifact class and project,
+    and each artifact is checked in the context of its own project, with
+    has_access_many, so results from several projects can be filtered
+    together.
+    '''
+    from allura import model as M
+    items = list(items)
+    ref_ids = [i for i in items if isinstance(i, basestring)]
+    artifacts = M.ArtifactReference.artifacts_by_id(ref_ids) if ref_ids else {}
+    objs = [artifacts.get(i) if isinstance(i, basestring) else i for i in items]
+    by_app_config = defaultdict(list)
+    for obj in objs:
+        if obj is not None:
+            by_app_config[getattr(obj, 'app_config_id', None)].append(obj)
+    app_config_ids = [i for i in by_app_config if i is not None]
+    app_configs = M.AppConfig.query.find(dict(_id={'$in':app_config_ids})).all()
+    projects = M.Project.query.find(dict(_id={'$in':list(set(
+        ac.project_id for ac in app_configs))})).all()
+    projects = dict((p._id, p) for p in projects)
+    project_for_app_config = dict(
+        (ac._id, projects.get(ac.project_id)) for ac in app_configs)
+    allowed = set()
+    for app_config_id, group in by_app_config.iteritems():
+        project = project_for_app_config.get(app_config_id)
+        if app_config_id is not None and project is None:
+            continue
+        if project is not None:
+            project = project.root_project
+        allowed.update(id(obj) for obj in has_access_many(
+            group, permission, user=user, project=project))
+    return [item for item, obj in zip(items, objs)
+            if obj is not None and id(obj) in allowed]
+
 def all_allowed(obj, user_or_role=None, project=None):
     '''
     List all the permission names that a given user or named role
@@ -16,9 +16,16 @@
 #       under the License.
 
 import shlex
+import time
+import logging
+import threading
+from collections import OrderedDict
+
 import pysolr
 from pysolr import SolrError
 
+log = logging.getLogger(__name__)
+
 
 class Solr(object):
     """Solr interface that pushes updates to multiple solr instances.
@@ -29,10 +36,28 @@ class Solr(object):
     Also, accepts default values for `commit` and `commitWithin`
     and passes those values through to each `add` and `delete` call,
     unless explicitly overridden.
+
+    `buffer_size` and `buffer_timeout` control the write-behind buffer used by
+    `add_buffered` and `delete_buffered`: buffered updates are sent to solr in
+    one batch once `buffer_size` documents are waiting, or the oldest one has
+    waited `buffer_timeout` seconds, or `flush` is called.  With the default
+    `buffer_size` of 0, buffered updates are sent right away.
+
+    With `auto_flush` set, the `add_buffered` or `delete_buffered` call that
+    trips a threshold sends the whole buffer itself, and raises if solr fails.
+    taskd turns it off and flushes between tasks instead, so that one task
+    doesn't fail on (or wait for) everyone's updates; the trade-off is that a
+    task can be marked complete before its updates reach solr.
+
+    Updates that fail to be sent stay buffered, to be tried again, up to
+    `buffer_max` documents (10 times `buffer_size` by default).  Past that,
+    solr is taken to be down, and the buffer is dropped rather than left to
+    grow; the ids and queries dropped are logged, for reindexing later.
     """
 
     def __init__(self, push_servers, query_server=None,
-                 commit=True, commitWithin=None, **kw):
+                 commit=True, commitWithin=None,
+                 buffer_size=0, buffer_timeout=0, auto_flush=True, buffer_max=None, **kw):
         self.push_pool = [pysolr.Solr(s, **kw) for s in push_servers]
         if query_server:
             self.query_server = pysolr.Solr(query_server, **kw)
@@ -40,6 +65,16 @@ def __init__(self, push_servers, query_server=None,
             self.query_server = self.push_pool[0]
         self._commit = commit
         self.commitWithin = commitWithin
+        self.buffer_size = buffer_size
+        self.buffer_timeout = buffer_timeout
+        self.auto_flush = auto_flush
+        self.buffer_max = buffer_max or buffer_size * 10
+        # pending updates, in order: ('add', {id: doc}) or ('delete', [query])
+        self._buffer = []
+        self._buffered_docs = 0
+        self._buffer_started = None
+        # buffer is shared by all the tasks running in this process
+        self._buffer_lock = threading.RLock()
 
     def add(self, *args, **kw):
         if 'commit' not in kw:
@@ -68,6 +103,74 @@ def commit(self, *args, **kw):
     def search(self, *args, **kw):
         return self.query_server.search(*args, **kw)
 
+    def add_buffered(self, docs):
+        """Queue `docs` to be added on the next flush.  Later versions of a
+        document replace earlier ones still in the buffer."""
+        with self._buffer_lock:
+            if not self._buffer or self._buffer[-1][0] != 'add':
+                self._buffer.append(('add', OrderedDict()))
+            pending = self._buffer[-1][1]
+            for doc in docs:
+                pending.pop(doc['id'], None)
+                pending[doc['id']] = doc
+            self._buffered_docs += len(docs)
+            self._buffered()
+
+    def delete_buffered(self, q):
+        """Queue a delete-by-query to be run on the next flush, after any
+        adds buffered before it."""
+        with self._buffer_lock:
+            if not self._buffer or self._buffer[-1][0] != 'delete':
+                self._buffer.append(('delete', []))
+            self._buffer[-1][1].append(q)
+            self._buffered_docs += 1
+            self._buffered()
+
+    def _buffered(self):
+        if self._buffer_started is None:
+            self._buffer_started = time.time()
+        if self.buffer_size and self._buffered_docs > self.buffer_max:
+            self._drop_buffer()
+        elif self.auto_flush and self.flush_due():
+            self.flush()
+
+    def _drop_buffer(self):
+        ids, queries = [], []
+        for op, pending in self._buffer:
+            if op == 'add':
+                ids.extend(pending)
+            else:
+                queries.extend(pending)
+        log.error('Dropping %s buffered solr updates that could not be sent; '
+                  'reindex these: ids %s; deletes %s', self._buffered_docs, ids, queries)
+        self._buffer = []
+        self._buffered_docs = 0
+        self._buffer_started = None
+
+    def flush_due(self):
+        """Has the buffer reached its size or time threshold?"""
+        with self._buffer_lock:
+            if not self._buffer:
+                return False
+            if self._buffered_docs >= self.buffer_size:
+                return True
+            return bool(self.buffer_timeout and
+                    time.time() - self._buffer_started >= self.buffer_timeout)
+
+    def flush(self):
+        """Send all buffered updates to solr, in as few requests as possible.
+        If solr fails, the unsent updates stay in the buffer."""
+        with self._buffer_lock:
+            while self._buffer:
+                op, pending = self._buffer[0]
+                if op == 'add':
+                    self.add(pending.values())
+                else:
+                    self.delete(q=' || '.join('(%s)' % q for q in pending))
+                self._buffer.pop(0)
+            self._buffered_docs = 0
+            self._buffer_started = None
+
 
 class MockSOLR(object):
 
@@ -91,6 +194,18 @@ def add(self, objects):
     def commit(self):
         pass
 
+    def add_buffered(self, objects):
+        self.add(objects)
+
+    def delete_buffered(self, q):
+        self.delete(q=q)
+
+    def flush_due(self):
+        return False
+
+    def flush(self):
+        pass
+
     def search(self, q, fq=None, **kw):
         if isinstance(q, unicode):
             q = q.encode('latin-1')
@@ -25,7 +25,7 @@
 from pylons import tmpl_context as c, app_globals as g
 from pylons import request
 from ming import schema as S
-from ming.orm import state, session
+from ming.orm import state, session, mapper
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty
 from ming.orm.declarative import MappedClass
 from ming.utils import LazyProperty
@@ -44,6 +44,14 @@
 
 log = logging.getLogger(__name__)
 
+def _request_ip():
+    '''The address the current request came from, for snapshots'''
+    try:
+        ip_address = request.headers.get('X_FORWARDED_FOR', request.remote_addr)
+        return ip_address.split(',')[0].strip()
+    except:
+        return '0.0.0.0'
+
 class Artifact(MappedClass):
     """
     The base class for anything you want to keep track of.
@@ -366,12 +374,36 @@ class __mongometa__:
     def commit(self, update_stats=True):
         '''Save off a snapshot of the artifact and increment the version #'''
         self.version += 1
-        try:
-            ip_address = request.headers.get('X_FORWARDED_FOR', request.remote_addr)
-            ip_address = ip_address.split(',')[0].strip()
-        except:
-            ip_address = '0.0.0.0'
-        data = dict(
+        ss = self.__mongometa__.history_class(**self._snapshot_data(_request_ip()))
+        session(ss).insert_now(ss, state(ss))
+        log.info('Snapshot version %s of %s',
+                 self.version, self.__class__)
+        if update_stats:
+            self._update_commit_stats()
+        return ss
+
+    @classmethod
+    def commit_many(cls, artifacts, update_stats=True):
+        '''Like commit() on each of artifacts, but save all of their snapshots
+        with a single insert.  The artifacts must all be of this class.
+        Returns the snapshot documents.'''
+        HC = cls.__mongometa__.history_class
+        doc_cls = mapper(HC).collection
+        ip_address = _request_ip()
+        docs = []
+        for a in artifacts:
+            a.version += 1
+            docs.append(doc_cls.make(a._snapshot_data(ip_address)))
+        if docs:
+            session(HC).impl.db[doc_cls.m.collection_name].insert(docs)
+        log.info('Snapshots of %s %s', len(docs), cls)
+        if update_stats:
+            for a in artifacts:
+                a._update_commit_stats()
+        return docs
+
+    def _snapshot_data(self, ip_address):
+        return dict(
             artifact_id=self._id,
             artifact_class='%s.%s' % (
                 self.__class__.__module__,
@@ -384,18 +416,14 @@ def commit(self, update_stats=True):
                 logged_ip=ip_address),
             timestamp=datetime.utcnow(),
             data=state(self).clone())
-        ss = self.__mongometa__.history_class(**data)
-        session(ss).insert_now(ss, state(ss))
-        log.info('Snapshot version %s of %s',
-                 self.version, self.__class__)
-        if update_stats:
-            if self.version > 1:
-                g.statsUpdater.modifiedArtifact(
-                    self.type_s, self.mod_date, self.project, c.user)
-            else :
-                g.statsUpdater.newArtifact(
-                    self.type_s, self.mod_date, self.project, c.user)
-        return ss
+
+    def _update_commit_stats(self):
+        if self.version > 1:
+            g.statsUpdater.modifiedArtifact(
+                self.type_s, self.mod_date, self.project, c.user)
+        else :
+            g.statsUpdater.newArtifact(
+                self.type_s, self.mod_date, self.project, c.user)
 
     def get_version(self, n):
         if n < 0:
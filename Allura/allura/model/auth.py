@@ -30,6 +30,7 @@
 from datetime import timedelta, date, datetime, time
 from pkg_resources import iter_entry_points
 
+import bson
 import iso8601
 import pymongo
 from pylons import tmpl_context as c, app_globals as g
@@ -37,7 +38,7 @@
 
 from ming import schema as S
 from ming import Field, collection
-from ming.orm import session, state
+from ming.orm import session, state, MapperExtension
 from ming.orm import FieldProperty, RelationProperty, ForeignIdProperty
 from ming.orm.declarative import MappedClass
 from ming.orm.ormsession import ThreadLocalORMSession
@@ -695,6 +696,31 @@ class __mongometa__:
         name='user'
         unique_indexes = [ ('user_id', 'project_id', 'name') ]
 
+# A token that changes whenever one of a project's roles does, see
+# allura.lib.security.RoleClosureCache
+project_role_version = collection(
+    'project_role_version', main_doc_session,
+    Field('_id', S.ObjectId()),
+    Field('version', S.ObjectId(if_missing=None)),
+)
+
+class ProjectRoleMapperExtension(MapperExtension):
+    def _changed(self, obj):
+        if obj.project_id is not None:
+            project_role_version.m.update_partial(
+                dict(_id=obj.project_id),
+                {'$set': dict(version=bson.ObjectId())},
+                upsert=True)
+
+    def after_insert(self, obj, st, sess):
+        self._changed(obj)
+
+    def after_update(self, obj, st, sess):
+        self._changed(obj)
+
+    def after_delete(self, obj, st, sess):
+        self._changed(obj)
+
 class ProjectRole(MappedClass):
     """
     Per-project roles, called "Groups" in the UI.
@@ -715,6 +741,7 @@ class __mongometa__:
             ('project_id',),
             ('roles',)
             ]
+        extensions = [ ProjectRoleMapperExtension ]
 
     _id = FieldProperty(S.ObjectId)
     user_id = ForeignIdProperty('User', if_missing=None)
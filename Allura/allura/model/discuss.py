@@ -274,6 +274,72 @@ def post(self, text, message_id=None, parent_id=None,
             self.notify_moderators(post)
         return post
 
+    @classmethod
+    def post_many(cls, messages, notify=True, timestamps=None):
+        '''Post each (thread, text) pair in messages as thread.post(text)
+        would, but without flushing the session for every post: the approved
+        posts' snapshots are saved with a single insert, and the session is
+        flushed once, before each thread and artifact recounts its stats.
+        timestamps, if given, has a timestamp for each message, as for
+        thread.post(text, timestamp=timestamp).  Returns the posts.'''
+        post_class = cls.post_class()
+        posts = []
+        approved = []
+        messages = list(messages)
+        if timestamps is None:
+            timestamps = [None] * len(messages)
+        for (thread, text), timestamp in zip(messages, timestamps):
+            require_access(thread, 'post')
+            artifact = thread.artifact
+            if thread.ref_id and artifact:
+                artifact.subscribe()
+            slug, full_slug = post_class.make_slugs(None, timestamp)
+            kwargs = dict(
+                _id=h.gen_message_id(),
+                discussion_id=thread.discussion_id,
+                full_slug=full_slug,
+                slug=slug,
+                thread_id=thread._id,
+                parent_id=None,
+                text=text,
+                status='pending')
+            if timestamp is not None:
+                kwargs['timestamp'] = timestamp
+            post = post_class(**kwargs)
+            posts.append(post)
+            if not thread.is_spam(post) and has_access(thread, 'unmoderated_post')():
+                approved.append((thread, artifact or thread, post))
+            else:
+                thread.notify_moderators(post)
+        if not approved:
+            return posts
+        author = c.user
+        role_id = author.project_role()._id
+        for thread, artifact, post in approved:
+            post.status = 'ok'
+            security.simple_grant(post.acl, role_id, 'moderate')
+        post_class.commit_many([post for thread, artifact, post in approved])
+        once_moderated = (c.app.config.options.get('PostingPolicy') == 'ApproveOnceModerated'
+                          and author._id != None)
+        for thread, artifact, post in approved:
+            if once_moderated:
+                security.simple_grant(post.acl, role_id, 'unmoderated_post')
+            if notify:
+                post.notify()
+            thread.last_post_date = max(thread.last_post_date, post.mod_date)
+            if post.text:
+                g.director.create_activity(author, 'posted', post, target=artifact,
+                        related_nodes=[post.app_config.project])
+        session(post).flush()
+        recount = {}
+        for thread, artifact, post in approved:
+            recount[id(thread)] = thread
+            if hasattr(artifact, 'update_stats'):
+                recount[id(artifact)] = artifact
+        for obj in recount.itervalues():
+            obj.update_stats()
+        return posts
+
     def notify_moderators(self, post):
         ''' Notify moderators that a post needs approval [#2963] '''
         artifact = self.artifact or self
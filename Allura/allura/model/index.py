@@ -63,6 +63,16 @@
     Index('project_id', 'link'), # used by from_links()  More helpful to have project_id first, for other queries
 )
 
+# Rendered markdown, see allura.lib.markdown_cache
+MarkdownCacheDoc = collection(
+    'markdown_cache', main_doc_session,
+    Field('_id', str),
+    Field('html', S.String()),
+    Field('links', [dict(link=str, url=str)]),
+    Field('timestamp', float),
+    Index('timestamp'),  # used by MongoMarkdownCache.remove_expired()
+)
+
 # Class definitions
 class ArtifactReference(object):
 
@@ -97,6 +107,35 @@ def artifact(self):
             log.exception('Error loading artifact for %s: %r',
                           self._id, aref)
 
+    @classmethod
+    def artifacts_by_id(cls, ref_ids):
+        '''Look up the artifacts referenced by ref_ids, with one query per
+        artifact class and project.  Returns a dict of ref_id -> artifact
+        (None if the artifact is gone).  Refs whose artifacts can't be looked
+        up are left out.'''
+        ref_ids = list(ref_ids)
+        if not ref_ids:
+            return {}
+        groups = defaultdict(list)
+        for ref in cls.query.find(dict(_id={'$in':ref_ids})):
+            aref = ref.artifact_reference
+            groups[(str(aref.cls), aref.project_id)].append(ref)
+        result = {}
+        for (pickled_cls, project_id), refs in groups.iteritems():
+            try:
+                artifact_cls = loads(pickled_cls)
+                with h.push_context(project_id):
+                    artifacts = artifact_cls.query.find(dict(_id={'$in':[
+                        r.artifact_reference.artifact_id for r in refs]})).all()
+            except:
+                log.exception('Error loading artifacts for [%s]',
+                              ', '.join(r._id for r in refs))
+                continue
+            artifacts = dict((a._id, a) for a in artifacts)
+            for r in refs:
+                result[r._id] = artifacts.get(r.artifact_reference.artifact_id)
+        return result
+
 class Shortlink(object):
     '''Collection mapping shorthand_ids for artifacts to ArtifactReferences'''
 
@@ -55,6 +55,8 @@ class MonQTask(MappedClass):
         - args - *args to be sent to the task function
         - kwargs - **kwargs to be sent to the task function
         - result - if the task is complete, the return value. If in error, the traceback.
+        - coalesce_key - for tasks posted with coalescing, identifies which
+          other ready tasks this one can be merged with
     '''
     states = ('ready', 'busy', 'error', 'complete', 'skipped')
     result_types = ('keep', 'forget')
@@ -94,6 +96,7 @@ class __mongometa__:
     args = FieldProperty([])
     kwargs = FieldProperty({None:None})
     result = FieldProperty(None, if_missing=None)
+    coalesce_key = FieldProperty(str, if_missing=None)
 
     def __repr__(self):
         from allura import model as M
@@ -132,8 +135,17 @@ def post(cls,
              kwargs=None,
              result_type='forget',
              priority=10,
-             delay=0):
-        '''Create a new task object based on the current context.'''
+             delay=0,
+             coalesce=None):
+        '''Create a new task object based on the current context.
+
+        If coalesce is given, it is a dict with a 'key' and optional 'query'
+        and 'update' entries.  When a task for the same function, context
+        (ignoring the user), priority and key is still in the 'ready' state,
+        no new task is created: 'update' (a mongo update document, e.g. to
+        merge in the new args) is applied to the waiting task, which is
+        returned instead.  'query' can restrict which waiting tasks qualify.
+        '''
         if args is None: args = ()
         if kwargs is None: kwargs = {}
         task_name = '%s.%s' % (
@@ -151,6 +163,10 @@ def post(cls,
             context['app_config_id']=c.app.config._id
         if getattr(c, 'user', None):
             context['user_id']=c.user._id
+        if coalesce is not None:
+            obj = cls._coalesce(task_name, context, priority, result_type, coalesce)
+            if obj is not None:
+                return obj
         obj = cls(
             state='ready',
             priority=priority,
@@ -161,7 +177,8 @@ def post(cls,
             process=None,
             result=None,
             context=context,
-            time_queue=datetime.utcnow() + timedelta(seconds=delay))
+            time_queue=datetime.utcnow() + timedelta(seconds=delay),
+            coalesce_key=coalesce['key'] if coalesce is not None else None)
         session(obj).flush(obj)
         try:
             if g.amq_conn:
@@ -170,6 +187,28 @@ def post(cls,
             log.warning('Error putting to amq_conn', exc_info=True)
         return obj
 
+    @classmethod
+    def _coalesce(cls, task_name, context, priority, result_type, coalesce):
+        '''Merge into a matching ready task, if there is one.  Returns the
+        merged task, or None.'''
+        query = dict(coalesce.get('query') or {})
+        query.update(
+            state='ready',
+            task_name=task_name,
+            priority=priority,
+            result_type=result_type,
+            coalesce_key=coalesce['key'])
+        for k, v in context.iteritems():
+            if k != 'user_id':
+                query['context.' + k] = v
+        update = coalesce.get('update') or {'$set': dict(coalesce_key=coalesce['key'])}
+        try:
+            return cls.query.find_and_modify(query=query, update=update, new=True)
+        except pymongo.errors.OperationFailure, exc:
+            if 'No matching object found' not in exc.args[0]:
+                raise
+        return None
+
     @classmethod
     def get(cls, process='worker', state='ready', waitfunc=None, only=None):
         '''Get the highest-priority, oldest, ready task and lock it to the
@@ -207,13 +246,63 @@ def get(cls, process='worker', state='ready', waitfunc=None, only=None):
             except StopIteration:
                 return None
 
+    @classmethod
+    def get_batch(cls, process='worker', state='ready', size=1, waitfunc=None, only=None):
+        '''Like get(), but claim up to `size` of the highest-priority, oldest,
+        ready tasks for the current process in a single update.  Returns a
+        (possibly empty) list of tasks, in the order they should be run.
+
+        Tasks claimed this way are 'busy' with no time_start until they are
+        actually called; use release() to hand back any that won't be run.
+        '''
+        sort = [
+                ('priority', ming.DESCENDING),
+                ('time_queue', ming.ASCENDING)]
+        while True:
+            query = dict(state=state)
+            query['time_queue'] = {'$lte': datetime.utcnow()}
+            if only:
+                query['task_name'] = {'$in': only}
+            candidates = cls.query.find(query).sort(sort).limit(size).all()
+            if candidates:
+                ids = [t._id for t in candidates]
+                # other taskd processes may be claiming the same candidates;
+                # the state check makes sure each task is only claimed once
+                cls.query.update(
+                    {'_id': {'$in': ids}, 'state': state},
+                    {'$set': dict(state='busy', process=process, time_start=None)},
+                    multi=True)
+                claimed = cls.query.find(dict(
+                    _id={'$in': ids},
+                    state='busy',
+                    process=process), refresh=True).sort(sort).all()
+                if claimed: return claimed
+            if waitfunc is None:
+                return []
+            try:
+                waitfunc()
+            except StopIteration:
+                return []
+
+    @classmethod
+    def release(cls, process, task_ids=None):
+        '''Put tasks claimed by `process` that were never started back into
+        the 'ready' state, so that another worker can pick them up.  If
+        task_ids is given, only those tasks are released.'''
+        spec = dict(state='busy', process=process, time_start=None)
+        if task_ids is not None:
+            spec['_id'] = {'$in': list(task_ids)}
+        cls.query.update(spec,
+            {'$set': dict(state='ready', process=None)},
+            multi=True)
+
     @classmethod
     def timeout_tasks(cls, older_than):
         '''Mark all busy tasks older than a certain datetime as 'ready' again.
         Used to retry 'stuck' tasks.'''
         spec = dict(state='busy')
         spec['time_start'] = {'$lt':older_than}
-        cls.query.update(spec, {'$set': dict(state='ready')}, multi=True)
+        cls.query.update(spec, {'$set': dict(state='ready', time_start=None)}, multi=True)
 
     @classmethod
     def clear_complete(cls):
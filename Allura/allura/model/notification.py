@@ -32,6 +32,7 @@
 
 '''
 
+import sys
 import logging
 from bson import ObjectId
 from datetime import datetime, timedelta
@@ -41,7 +42,7 @@
 from tg import config
 import pymongo
 import jinja2
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 from ming import schema as S
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty, session
@@ -59,6 +60,11 @@
 log = logging.getLogger(__name__)
 
 MAILBOX_QUIESCENT=None # Re-enable with [#1384]: timedelta(minutes=10)
+# A mailbox claimed by a batched fire_ready that didn't finish in this long
+# (e.g. the process died) can be claimed again
+MAILBOX_FIRING_TIMEOUT=timedelta(hours=1)
+# Most emails to send in one sendmail_batch task
+MAIL_BATCH_SIZE=100
 
 class Notification(MappedClass):
     '''
@@ -236,9 +242,13 @@ def send_simple(self, toaddr):
             in_reply_to=self.in_reply_to,
             text=(self.text or '') + self.footer())
 
-    def send_direct(self, user_id):
-        user = User.query.get(_id=ObjectId(user_id))
-        artifact = self.ref.artifact
+    def send_direct(self, user_id, batch=None):
+        if batch is not None:
+            user = batch.user(user_id)
+            artifact = batch.artifact(self.ref_id)
+        else:
+            user = User.query.get(_id=ObjectId(user_id))
+            artifact = self.ref.artifact
         log.debug('Sending direct notification %s to user %s', self._id, user_id)
         # Don't send if user doesn't have read perms to the artifact
         if user and artifact and \
@@ -246,7 +256,7 @@ def send_direct(self, user_id):
             log.debug("Skipping notification - User %s doesn't have read "
                       "access to artifact %s" % (user_id, str(self.ref_id)))
             return
-        allura.tasks.mail_tasks.sendmail.post(
+        self._sendmail(batch,
             destinations=[str(user_id)],
             fromaddr=self.from_address,
             reply_to=self.reply_to_address,
@@ -257,16 +267,23 @@ def send_direct(self, user_id):
 
     @classmethod
     def send_digest(self, user_id, from_address, subject, notifications,
-                    reply_to_address=None):
+                    reply_to_address=None, batch=None):
         if not notifications: return
         # Filter out notifications for which the user doesn't have read
         # permissions to the artifact.
-        user = User.query.get(_id=ObjectId(user_id))
-        artifact = self.ref.artifact
+        if batch is not None:
+            user = batch.user(user_id)
+        else:
+            user = User.query.get(_id=ObjectId(user_id))
         def perm_check(notification):
+            if batch is not None:
+                artifact = batch.artifact(notification.ref_id)
+            else:
+                artifact = notification.ref.artifact
             return not (user and artifact) or \
                     security.has_access(artifact, 'read', user)()
         notifications = filter(perm_check, notifications)
+        if not notifications: return
 
         log.debug('Sending digest of notifications [%s] to user %s', ', '.join([n._id for n in notifications]), user_id)
         if reply_to_address is None:
@@ -280,7 +297,7 @@ def perm_check(notification):
             text.append(n.text or '-no text-')
         text.append(n.footer())
         text = '\n'.join(text)
-        allura.tasks.mail_tasks.sendmail.post(
+        self._sendmail(batch,
             destinations=[str(user_id)],
             fromaddr=from_address,
             reply_to=reply_to_address,
@@ -289,7 +306,8 @@ def perm_check(notification):
             text=text)
 
     @classmethod
-    def send_summary(self, user_id, from_address, subject, notifications):
+    def send_summary(self, user_id, from_address, subject, notifications,
+                     batch=None):
         if not notifications: return
         log.debug('Sending summary of notifications [%s] to user %s', ', '.join([n._id for n in notifications]), user_id)
         text = [ 'Digest of %s' % subject ]
@@ -301,7 +319,7 @@ def send_summary(self, user_id, from_address, subject, notifications):
             text.append(h.text.truncate(n.text or '-no text-', 128))
         text.append(n.footer())
         text = '\n'.join(text)
-        allura.tasks.mail_tasks.sendmail.post(
+        self._sendmail(batch,
             destinations=[str(user_id)],
             fromaddr=from_address,
             reply_to=from_address,
@@ -309,6 +327,14 @@ def send_summary(self, user_id, from_address, subject, notifications):
             message_id=h.gen_message_id(),
             text=text)
 
+    @classmethod
+    def _sendmail(cls, batch, **kwargs):
+        '''Queue an email with the sendmail task, or add it to the batch'''
+        if batch is not None:
+            batch.sendmail(**kwargs)
+        else:
+            allura.tasks.mail_tasks.sendmail.post(**kwargs)
+
 
 class Mailbox(MappedClass):
     '''
@@ -354,6 +380,12 @@ class __mongometa__:
     queue = FieldProperty([str])
     queue_empty = FieldProperty(bool)
 
+    # set while a batched fire_ready is sending the queue, which it moves
+    # to firing_queue (see _claim)
+    firing_queue = FieldProperty([str])
+    firing_token = FieldProperty(str, if_missing=None)
+    firing_time = FieldProperty(datetime, if_missing=None)
+
     project = RelationProperty('Project')
     app_config = RelationProperty('AppConfig')
 
@@ -450,7 +482,8 @@ def subscribed(
     def deliver(cls, nid, artifact_index_id, topic):
         '''Called in the notification message handler to deliver notification IDs
         to the appropriate mailboxes.  Atomically appends the nids
-        to the appropriate mailboxes.
+        to the appropriate mailboxes, with a single update.  If that fails,
+        falls back to updating the mailboxes one at a time.
         '''
         d = {
             'project_id':c.project._id,
@@ -458,15 +491,27 @@ def deliver(cls, nid, artifact_index_id, topic):
             'artifact_index_id':{'$in':[None, artifact_index_id]},
             'topic':{'$in':[None, topic]}
             }
+        update = {'$push':dict(queue=nid),
+                  '$set':dict(last_modified=datetime.utcnow(),
+                              queue_empty=False),
+                  }
+        # Skip mailboxes that already have the nid, so that a retry after a
+        # partial failure doesn't deliver it twice
+        d['queue'] = {'$ne':nid}
+        try:
+            cls.query.update(d, update, multi=True)
+            log.debug('Delivered notification %s to mailboxes for artifact %s',
+                      nid, artifact_index_id)
+            return
+        except:
+            log.exception(
+                'Error adding notification: %s for artifact %s on project %s to mailboxes, '
+                'retrying one mailbox at a time', nid, artifact_index_id, c.project._id)
         mboxes = cls.query.find(d).all()
         log.debug('Delivering notification %s to mailboxes [%s]', nid, ', '.join([str(m._id) for m in mboxes]))
         for mbox in mboxes:
             try:
-                mbox.query.update(
-                    {'$push':dict(queue=nid),
-                     '$set':dict(last_modified=datetime.utcnow(),
-                                 queue_empty=False),
-                    })
+                cls.query.update(dict(_id=mbox._id, queue={'$ne':nid}), update)
                 # Make sure the mbox doesn't stick around to be flush()ed
                 session(mbox).expunge(mbox)
             except:
@@ -477,11 +522,17 @@ def deliver(cls, nid, artifact_index_id, topic):
                     nid, artifact_index_id, c.project._id, mbox.user_id)
 
     @classmethod
-    def fire_ready(cls):
+    def fire_ready(cls, batch_size=None):
         '''Fires all direct subscriptions with notifications as well as
         all summary & digest subscriptions with notifications that are ready.
         Clears the mailbox queue.
+
+        If batch_size is given (default: the notification.fire_batch_size
+        config setting), mailboxes are claimed and fired batch_size at a
+        time; see _fire_batched.
         '''
+        if batch_size is None:
+            batch_size = asint(config.get('notification.fire_batch_size', 0))
         now = datetime.utcnow()
         # Queries to find all matching subscription objects
         q_direct = dict(
@@ -494,6 +545,9 @@ def fire_ready(cls):
             type={'$in': ['digest', 'summary']},
             next_scheduled={'$lt':now})
 
+        if batch_size:
+            return cls._fire_batched(now, q_direct, q_digest, batch_size)
+
         def find_and_modify_direct_mbox():
             return cls.query.find_and_modify(
                 query=q_direct,
@@ -511,13 +565,7 @@ def find_and_modify_direct_mbox():
                 raise  # re-raise so we don't keep (destructively) trying to process mboxes
 
         for mbox in cls.query.find(q_digest):
-            next_scheduled = now
-            if mbox.frequency.unit == 'day':
-                next_scheduled += timedelta(days=mbox.frequency.n)
-            elif mbox.frequency.unit == 'week':
-                next_scheduled += timedelta(days=7 * mbox.frequency.n)
-            elif mbox.frequency.unit == 'month':
-                next_scheduled += timedelta(days=30 * mbox.frequency.n)
+            next_scheduled = cls._next_scheduled(now, mbox.frequency.n, mbox.frequency.unit)
             mbox = cls.query.find_and_modify(
                 query=dict(_id=mbox._id),
                 update={'$set': dict(
@@ -528,22 +576,150 @@ def find_and_modify_direct_mbox():
                 new=False)
             mbox.fire(now)
 
-    def fire(self, now):
+    @classmethod
+    def _next_scheduled(cls, now, n, unit):
+        next_scheduled = now
+        if unit == 'day':
+            next_scheduled += timedelta(days=n)
+        elif unit == 'week':
+            next_scheduled += timedelta(days=7 * n)
+        elif unit == 'month':
+            next_scheduled += timedelta(days=30 * n)
+        return next_scheduled
+
+    @classmethod
+    def _fire_batched(cls, now, q_direct, q_digest, batch_size):
+        '''Fire the mailboxes matching q_direct and q_digest, claiming up to
+        batch_size of them with each update.  The notifications, users and
+        artifacts of each batch are loaded together, and its emails are
+        queued as sendmail_batch tasks, which send them over one smtp
+        connection.
+
+        Claims left behind by a process that died while firing are taken
+        over first (see _fire_stale); until then those mailboxes aren't
+        claimed again, so their unsent firing_queue is never overwritten.'''
+        token = str(ObjectId())
+        cls._fire_stale(now, token, batch_size)
+        q_unclaimed = dict(firing_token=None)
+        while True:
+            ids = [m._id for m in cls.query.find(dict(q_direct, **q_unclaimed)).limit(batch_size)]
+            if not ids:
+                break
+            cls._fire_batch(now, token, cls._claim(now, token, dict(q_direct, **q_unclaimed), ids))
+        while True:
+            mboxes = cls.query.find(dict(q_digest, **q_unclaimed)).limit(batch_size).all()
+            if not mboxes:
+                break
+            # digest mailboxes are rescheduled as they are claimed, which
+            # takes one update per distinct frequency
+            by_frequency = defaultdict(list)
+            for mbox in mboxes:
+                by_frequency[(mbox.frequency.n, mbox.frequency.unit)].append(mbox._id)
+            claimed = []
+            for (n, unit), ids in by_frequency.iteritems():
+                next_scheduled = cls._next_scheduled(now, n, unit)
+                q = dict(q_digest, **q_unclaimed)
+                q['frequency.n'] = n
+                q['frequency.unit'] = unit
+                claimed += cls._claim(now, token, q, ids, next_scheduled=next_scheduled)
+            cls._fire_batch(now, token, claimed)
+
+    @classmethod
+    def _fire_stale(cls, now, token, batch_size):
+        '''Fire the firing_queue of mailboxes claimed more than
+        MAILBOX_FIRING_TIMEOUT ago and never released, whatever their queue
+        or schedule says.  Notifications delivered since the claim stay in
+        queue, for the usual claims.'''
+        q_stale = dict(
+            firing_token={'$ne': None},
+            firing_time={'$lt':now - MAILBOX_FIRING_TIMEOUT})
+        while True:
+            ids = [m._id for m in cls.query.find(q_stale).limit(batch_size)]
+            if not ids:
+                break
+            cls.query.update(dict(q_stale, _id={'$in': ids}),
+                {'$set': dict(firing_token=token, firing_time=now)},
+                multi=True)
+            mboxes = cls.query.find(dict(_id={'$in': ids}, firing_token=token),
+                                    refresh=True).all()
+            log.warning('Taking over %s stale mailbox claims', len(mboxes))
+            cls._fire_batch(now, token, mboxes)
+
+    @classmethod
+    def _claim(cls, now, token, query, ids, **kwargs):
+        '''Claim the mailboxes with the given ids that still match query, by
+        moving their queues to firing_queue, in a single update.  Notifications
+        delivered from then on go into a new queue.  kwargs are also $set on
+        the claimed mailboxes.  Returns the claimed mailboxes.'''
+        query = dict(query, _id={'$in': ids})
+        cls.query.update(query,
+            {'$rename': dict(queue='firing_queue'),
+             '$set': dict(kwargs,
+                          queue_empty=True,
+                          firing_token=token,
+                          firing_time=now)},
+            multi=True)
+        return cls.query.find(dict(_id={'$in': ids}, firing_token=token),
+                              refresh=True).all()
+
+    @classmethod
+    def _fire_batch(cls, now, token, mboxes):
+        '''Fire the claimed mailboxes, then release them'''
+        if not mboxes:
+            return
+        nids = set()
+        for mbox in mboxes:
+            nids.update(mbox.firing_queue)
+        notifications = Notification.query.find(dict(_id={'$in':list(nids)})).all()
+        notifications = dict((n._id, n) for n in notifications)
+        batch = MailboxBatch(mboxes, notifications.values())
+        error = None
+        for mbox in mboxes:
+            ns = [notifications[nid] for nid in mbox.firing_queue if nid in notifications]
+            if len(ns) != len(mbox.firing_queue):
+                log.error('Mailbox queue error: Mailbox %s queued [%s], found [%s]', str(mbox._id), ', '.join(mbox.firing_queue), ', '.join([n._id for n in ns]))
+            try:
+                mbox.fire(now, notifications=ns, batch=batch)
+            except:
+                log.exception('Error firing mbox: %s with queue: [%s]', str(mbox._id), ', '.join(mbox.firing_queue))
+                # the rest of the batch is already claimed, so finish it
+                # before re-raising
+                error = error or sys.exc_info()
+        try:
+            batch.send()
+        finally:
+            ids = [mbox._id for mbox in mboxes]
+            for mbox in mboxes:
+                session(mbox).expunge(mbox)
+            cls.query.update(
+                dict(_id={'$in': ids}, firing_token=token),
+                {'$unset': dict(firing_queue=1, firing_token=1, firing_time=1)},
+                multi=True)
+        if error:
+            raise error[0], error[1], error[2]
+
+    def fire(self, now, notifications=None, batch=None):
         '''
         Send all notifications that this mailbox has enqueued.
+
+        When firing a batch of mailboxes, their notifications are loaded up
+        front, and the emails go to the MailboxBatch.
         '''
-        notifications = Notification.query.find(dict(_id={'$in':self.queue}))
-        notifications = notifications.all()
-        if len(notifications) != len(self.queue):
-            log.error('Mailbox queue error: Mailbox %s queued [%s], found [%s]', str(self._id), ', '.join(self.queue), ', '.join([n._id for n in notifications]))
-        else:
-            log.debug('Firing mailbox %s notifications [%s], found [%s]', str(self._id), ', '.join(self.queue), ', '.join([n._id for n in notifications]))
+        if notifications is None:
+            notifications = Notification.query.find(dict(_id={'$in':self.queue}))
+            notifications = notifications.all()
+            if len(notifications) != len(self.queue):
+                log.error('Mailbox queue error: Mailbox %s queued [%s], found [%s]', str(self._id), ', '.join(self.queue), ', '.join([n._id for n in notifications]))
+            else:
+                log.debug('Firing mailbox %s notifications [%s], found [%s]', str(self._id), ', '.join(self.queue), ', '.join([n._id for n in notifications]))
+        # only pass batch along when there is one
+        kw = dict(batch=batch) if batch is not None else {}
         if self.type == 'direct':
             ngroups = defaultdict(list)
             for n in notifications:
                 try:
                     if n.topic == 'message':
-                        n.send_direct(self.user_id)
+                        n.send_direct(self.user_id, **kw)
                         # Messages must be sent individually so they can be replied
                         # to individually
                     else:
@@ -560,10 +736,10 @@ def fire(self, now):
             for (subject, from_address, reply_to_address, author_id), ns in ngroups.iteritems():
                 try:
                     if len(ns) == 1:
-                        ns[0].send_direct(self.user_id)
+                        ns[0].send_direct(self.user_id, **kw)
                     else:
                         Notification.send_digest(
-                            self.user_id, from_address, subject, ns, reply_to_address)
+                            self.user_id, from_address, subject, ns, reply_to_address, **kw)
                 except:
                     # log error but keep trying to deliver other notifications,
                     # lest the other notifications (which have already been removed
@@ -574,8 +750,43 @@ def fire(self, now):
         elif self.type == 'digest':
             Notification.send_digest(
                 self.user_id, u'noreply@in.sf.net', 'Digest Email',
-                notifications)
+                notifications, **kw)
         elif self.type == 'summary':
             Notification.send_summary(
                 self.user_id, u'noreply@in.sf.net', 'Digest Email',
-                notifications)
+                notifications, **kw)
+
+
+class MailboxBatch(object):
+    '''The users and artifacts that a batch of mailboxes being fired
+    together need for permission checks, loaded in a few queries, and the
+    emails to send for them.'''
+
+    def __init__(self, mboxes, notifications):
+        from allura import model as M
+        users = User.query.find(dict(_id={'$in':list(set(m.user_id for m in mboxes))})).all()
+        self._users = dict((u._id, u) for u in users)
+        self._artifacts = M.ArtifactReference.artifacts_by_id(
+            set(n.ref_id for n in notifications if n.ref_id))
+        self.messages = []
+
+    def user(self, user_id):
+        return self._users.get(ObjectId(user_id))
+
+    def artifact(self, ref_id):
+        # refs that artifacts_by_id couldn't look up are tried one at a time
+        if ref_id in self._artifacts:
+            return self._artifacts[ref_id]
+        from allura import model as M
+        ref = M.ArtifactReference.query.get(_id=ref_id)
+        return ref.artifact if ref else None
+
+    def sendmail(self, **kwargs):
+        self.messages.append(kwargs)
+
+    def send(self):
+        '''Queue the emails as sendmail_batch tasks'''
+        for i in range(0, len(self.messages), MAIL_BATCH_SIZE):
+            allura.tasks.mail_tasks.sendmail_batch.post(
+                self.messages[i:i + MAIL_BATCH_SIZE])
+        self.messages = []
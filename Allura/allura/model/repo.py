@@ -18,6 +18,8 @@
 import os
 import re
 import sys
+import heapq
+import calendar
 import logging
 from hashlib import sha1
 from itertools import chain
@@ -26,7 +28,9 @@
 from difflib import SequenceMatcher, unified_diff
 import bson
 
+import tg
 from pylons import tmpl_context as c
+from paste.deploy.converters import asint
 import pymongo.errors
 
 from ming import Field, collection, Index
@@ -121,6 +125,13 @@
         'differences',
         [ dict(name=str, lhs_id=str, rhs_id=str)]))
 
+# Files and trees renamed in a commit, computed when first needed
+# DiffCopiesDoc._id = CommitDoc._id
+DiffCopiesDoc = collection(
+    'repo_diffcopies', main_doc_session,
+    Field('_id', str),
+    Field('copies', [dict(old=str, new=str, ratio=float)]))
+
 # List of commit runs (a run is a linear series of single-parent commits)
 # CommitRunDoc.commit_ids = [ CommitDoc._id, ... ]
 CommitRunDoc = collection(
@@ -130,6 +141,164 @@
     Field('commit_ids', [str], index=True),
     Field('commit_times', [datetime]))
 
+# Commit graph index, for walking history without loading the whole graph.
+# generation is the commit's authored time in seconds, bumped where needed to
+# be greater than the generation of all of its parents, so that walking
+# commits by decreasing generation never reaches a commit before one of its
+# descendants.  count is the number of commits reachable from the commit
+# (itself included), or None if it couldn't be computed.  Entries never change
+# once written, except to add repo_ids.
+CommitGraphDoc = collection(
+    'repo_commitgraph', main_doc_session,
+    Field('_id', str),
+    Field('repo_ids', [S.ObjectId()]),
+    Field('parent_ids', [str]),
+    Field('generation', int),
+    Field('count', int, if_missing=None),
+    Index('repo_ids', 'generation'))
+
+class CommitGraph(object):
+    '''The part of the commit graph index (CommitGraphDoc) needed so far.
+    Entries are loaded as a walk reaches them, a whole frontier at a time;
+    given a repo_id, the entries with the next highest generations in that
+    repo are read ahead as well, which is usually what the walk needs next.'''
+
+    def __init__(self, repo_id=None):
+        self.repo_id = repo_id
+        self.nodes = {}
+        self.missing = set()
+
+    def add(self, doc):
+        self.nodes[doc._id] = doc
+
+    def load(self, oids, read_ahead=None):
+        '''Load the entries for oids, returning True if all of them are in
+        the index.  If read_ahead is a generation, also load the QSIZE
+        entries of the repo at or below it.'''
+        todo = set(oid for oid in oids
+                   if oid not in self.nodes and oid not in self.missing)
+        if todo and read_ahead is not None and self.repo_id is not None:
+            q = CommitGraphDoc.m.find(dict(
+                    repo_ids=self.repo_id,
+                    generation={'$lte': read_ahead}))
+            for doc in q.sort('generation', -1).limit(QSIZE):
+                self.nodes.setdefault(doc._id, doc)
+            todo = set(oid for oid in todo if oid not in self.nodes)
+        for chunk in utils.chunked_iter(todo, QSIZE):
+            for doc in CommitGraphDoc.m.find(dict(_id={'$in': list(chunk)})):
+                self.nodes[doc._id] = doc
+        self.missing.update(oid for oid in todo if oid not in self.nodes)
+        return all(oid in self.nodes for oid in oids)
+
+    def _load_parents(self, oid, heap):
+        '''Load the parents of oid, along with those of the rest of the heap'''
+        parent_ids = self.nodes[oid].parent_ids
+        if all(p in self.nodes or p in self.missing for p in parent_ids):
+            return parent_ids
+        frontier = list(parent_ids)
+        for _, other in heap:
+            frontier += self.nodes[other].parent_ids
+        self.load(frontier, read_ahead=self.nodes[oid].generation)
+        return parent_ids
+
+    def walk(self, commit_ids):
+        '''Yield commit_ids and their ancestors, newest first, never yielding
+        a commit before any of its descendants.  Commits that aren't in the
+        index are left out.'''
+        self.load(commit_ids)
+        heap = []
+        seen = set()
+        def push(oid):
+            if oid in seen or oid not in self.nodes: return
+            seen.add(oid)
+            heapq.heappush(heap, (-self.nodes[oid].generation, oid))
+        for oid in commit_ids:
+            push(oid)
+        while heap:
+            _, oid = heapq.heappop(heap)
+            yield oid
+            for parent_id in self._load_parents(oid, heap):
+                push(parent_id)
+
+    def count(self, oid):
+        '''Return the number of commits reachable from oid, or None if oid
+        isn't in the index'''
+        if not self.load([oid]): return None
+        node = self.nodes[oid]
+        if node.count is None:
+            return sum(1 for ci in self.walk([oid]))
+        return node.count
+
+    def new_entry(self, ci):
+        '''Return the CommitGraphDoc for the CommitDoc ci, whose parents must
+        already be in the index or added to this graph'''
+        self.load(ci.parent_ids)
+        parents = [self.nodes[p] for p in ci.parent_ids if p in self.nodes]
+        generation = calendar.timegm(ci.authored['date'].utctimetuple())
+        for parent in parents:
+            generation = max(generation, parent.generation + 1)
+        doc = CommitGraphDoc(dict(
+                _id=ci._id,
+                repo_ids=[],
+                parent_ids=ci.parent_ids,
+                generation=generation,
+                count=None))
+        # if some parents aren't known, neither is the count
+        if len(parents) == len(ci.parent_ids):
+            if not parents:
+                doc.count = 1
+            elif parents[0].count is not None:
+                doc.count = parents[0].count + 1
+                if len(parents) > 1:
+                    doc.count = self._merge_count(doc)
+        return doc
+
+    def _merge_count(self, node):
+        '''Count the commits reachable from a merge: those reachable from
+        its first parent, plus those only reachable from the others.  Only
+        the commits since the merge base(s) need to be walked.'''
+        FIRST, OTHER = 1, 2
+        flags = {}
+        heap = []
+        def paint(oid, flag):
+            old = flags.get(oid, 0)
+            flags[oid] = old | flag
+            if not old:
+                heapq.heappush(heap, (-self.nodes[oid].generation, oid))
+        paint(node.parent_ids[0], FIRST)
+        for oid in node.parent_ids[1:]:
+            paint(oid, OTHER)
+        only_other = 0
+        while any(flags[oid] == OTHER for _, oid in heap):
+            _, oid = heapq.heappop(heap)
+            flag = flags[oid]
+            if flag == OTHER:
+                only_other += 1
+            for parent_id in self._load_parents(oid, heap):
+                if parent_id not in self.nodes:
+                    return None
+                paint(parent_id, flag)
+        return node.count + only_other
+
+def _blob_size(blob):
+    '''The size of blob in bytes, or None if it isn't known'''
+    try:
+        return int(blob.size)
+    except (TypeError, ValueError):
+        return None
+
+def _may_be_similar(size1, size2):
+    '''Whether blobs of these sizes could be similar enough to be a copy.
+    Text has up to 4 bytes per character, so sizes in bytes still bound how
+    similar the texts can be.'''
+    if size1 is None or size2 is None:
+        return True
+    small, large = sorted([size1, size2])
+    if not large:
+        return True
+    factor = 4 * (2 - DIFF_SIMILARITY_THRESHOLD) / DIFF_SIMILARITY_THRESHOLD
+    return large < small * factor
+
 class RepoObject(object):
 
     def __repr__(self): # pragma no cover
@@ -288,83 +457,112 @@ def paged_diffs(self, start=0, end=None):
         di = DiffInfoDoc.m.get(_id=self._id)
         if di is None:
             return Object(added=[], removed=[], changed=[], copied=[], total=0)
+        copies = self._copies(di.differences)
+        copies_by_old = dict((copy['old'], copy) for copy in copies)
+        copy_names = set(copy['new'] for copy in copies)
         added = []
         removed = []
         changed = []
         copied = []
         for change in di.differences[start:end]:
             if change.rhs_id is None:
-                removed.append(change.name)
+                if change.name in copies_by_old:
+                    # a copy is listed on the page of its old name
+                    copied.append(self._copy_diff(copies_by_old[change.name]))
+                else:
+                    removed.append(change.name)
             elif change.lhs_id is None:
-                added.append(change.name)
+                if change.name not in copy_names:
+                    added.append(change.name)
             else:
                 changed.append(change.name)
-        copied = self._diffs_copied(added, removed)
         return Object(
             added=added, removed=removed,
             changed=changed, copied=copied,
             total=len(di.differences))
 
-    def _diffs_copied(self, added, removed):
-        '''Return list with file renames diffs.
-
-        Will change `added` and `removed` lists also.
+    def _copies(self, differences):
+        '''Return the renames in this commit, from the cache or computed'''
+        doc = DiffCopiesDoc.m.get(_id=self._id)
+        if doc is None:
+            doc = DiffCopiesDoc(dict(
+                    _id=self._id,
+                    copies=self._diffs_copied(differences)))
+            doc.m.save(safe=False)
+        return doc.copies
+
+    def _diffs_copied(self, differences):
+        '''Return a list of dict(old, new, ratio) for the files and trees
+        renamed in this commit.
+
+        Objects with the same id are matched first, without reading them.
+        Removed and added blobs are then compared by content, skipping
+        pairs whose sizes are too far apart to be similar; if there are
+        more than scm.diffs.rename_limit of either, this is skipped.
         '''
-        def _blobs_similarity(removed_blob, added):
-            best = dict(ratio=0, name='', blob=None)
-            for added_name in added:
-                added_blob = self.tree.get_obj_by_path(added_name)
-                if not isinstance(added_blob, Blob):
+        removed = [d for d in differences if d.rhs_id is None]
+        added = [d for d in differences if d.lhs_id is None]
+        if not removed or not added:
+            return []
+        copies = []
+        added_by_id = defaultdict(list)
+        for d in added:
+            added_by_id[d.rhs_id].append(d.name)
+        copied_names = set()
+        for d in removed[:]:
+            if added_by_id[d.lhs_id]:
+                new_name = added_by_id[d.lhs_id].pop(0)
+                copies.append(dict(old=d.name, new=new_name, ratio=1.0))
+                copied_names.add(new_name)
+                removed.remove(d)
+        added = [d for d in added if d.name not in copied_names]
+        rename_limit = asint(tg.config.get('scm.diffs.rename_limit', 100))
+        if not removed or not added:
+            return copies
+        if len(removed) > rename_limit or len(added) > rename_limit:
+            log.info('Too many changes in %s to look for renamed files', self._id)
+            return copies
+
+        prev_tree = self.get_parent().tree
+        added_blobs = []
+        for d in added:
+            blob = self.tree.get_obj_by_path(d.name)
+            if isinstance(blob, Blob):
+                added_blobs.append((d.name, blob, _blob_size(blob)))
+        for d in removed:
+            removed_blob = prev_tree.get_obj_by_path(d.name)
+            if not isinstance(removed_blob, Blob):
+                continue
+            removed_size = _blob_size(removed_blob)
+            best = dict(ratio=0, index=None)
+            for i, (added_name, added_blob, added_size) in enumerate(added_blobs):
+                if not _may_be_similar(removed_size, added_size):
                     continue
                 diff = SequenceMatcher(None, removed_blob.text,
                                        added_blob.text)
                 ratio = diff.quick_ratio()
                 if ratio > best['ratio']:
-                    best['ratio'] = ratio
-                    best['name'] = added_name
-                    best['blob'] = added_blob
-
+                    best = dict(ratio=ratio, index=i)
                 if ratio == 1:
                     break  # we'll won't find better similarity than 100% :)
-
             if best['ratio'] > DIFF_SIMILARITY_THRESHOLD:
-                diff = ''
-                if best['ratio'] < 1:
-                    added_blob = best['blob']
-                    rpath = ('a' + removed_blob.path()).encode('utf-8')
-                    apath = ('b' + added_blob.path()).encode('utf-8')
-                    diff = ''.join(unified_diff(list(removed_blob),
-                                                list(added_blob),
-                                                rpath, apath))
-                return dict(new=best['name'],
-                            ratio=best['ratio'], diff=diff)
-
-        def _trees_similarity(removed_tree, added):
-            for added_name in added:
-                added_tree = self.tree.get_obj_by_path(added_name)
-                if not isinstance(added_tree, Tree):
-                    continue
-                if removed_tree._id == added_tree._id:
-                    return dict(new=added_name,
-                                ratio=1, diff='')
-
-        if not removed:
-            return []
-        copied = []
-        prev_commit = self.get_parent()
-        for removed_name in removed[:]:
-            removed_blob = prev_commit.tree.get_obj_by_path(removed_name)
-            rename_info = None
-            if isinstance(removed_blob, Blob):
-                rename_info = _blobs_similarity(removed_blob, added)
-            elif isinstance(removed_blob, Tree):
-                rename_info = _trees_similarity(removed_blob, added)
-            if rename_info is not None:
-                rename_info['old'] = removed_name
-                copied.append(rename_info)
-                removed.remove(rename_info['old'])
-                added.remove(rename_info['new'])
-        return copied
+                added_name, added_blob, added_size = added_blobs.pop(best['index'])
+                copies.append(dict(old=d.name, new=added_name, ratio=best['ratio']))
+        return copies
+
+    def _copy_diff(self, copy):
+        '''Return the copy as shown on the commit page, with the diff of the
+        old and new blobs if they aren't the same'''
+        diff = ''
+        if copy['ratio'] < 1:
+            removed_blob = self.get_parent().tree.get_obj_by_path(copy['old'])
+            added_blob = self.tree.get_obj_by_path(copy['new'])
+            rpath = ('a' + removed_blob.path()).encode('utf-8')
+            apath = ('b' + added_blob.path()).encode('utf-8')
+            diff = ''.join(unified_diff(list(removed_blob),
+                                        list(added_blob),
+                                        rpath, apath))
+        return dict(old=copy['old'], new=copy['new'], ratio=copy['ratio'], diff=diff)
 
     def get_path(self, path, create=True):
         path = path.lstrip('/')
@@ -857,6 +1055,69 @@ def _build(cls, tree):
         model_cache.set(cls, {'path': path, 'commit_id': tree.commit._id}, lcd)
         return lcd
 
+    @classmethod
+    def build_many(cls, commit, paths):
+        '''
+          Find or build the LCDs for the trees at the given paths in commit,
+          returning them by path.  Rather than walking the history once for
+          each tree, the last commits of the entries of all the trees that
+          don't have an LCD yet are found with a single last_commit_ids call.
+
+          Only precompute_lcds uses this.  get() builds a single missing LCD
+          with _build, which starts from the tree's previous LCD and only
+          asks the SCM about its changed entries; that is cheaper than
+          looking up every entry as this does.
+        '''
+        model_cache = getattr(c, 'model_cache', '') or ModelCache()
+        trees = {}
+        for path in paths:
+            path = path.strip('/')
+            try:
+                node = commit.get_path(path)
+            except KeyError:
+                continue
+            if hasattr(node, 'tree_ids'):  # skip blobs
+                trees[path] = node
+        sub_paths = [path for path in trees if path]
+        tree_commit_ids = {}
+        if sub_paths:
+            tree_commit_ids = commit.repo.last_commit_ids(commit, sub_paths)
+            if tree_commit_ids is None:
+                # something strange went wrong; bail out and possibly try again later
+                return {}
+        if '' in trees:
+            tree_commit_ids[''] = cls._last_commit_id(commit, '')
+        result = {}
+        todo = {}
+        for path in trees:
+            commit_id = tree_commit_ids.get(path)
+            if commit_id is None: continue
+            lcd = model_cache.get(cls, {'path': path, 'commit_id': commit_id})
+            if lcd is None:
+                todo[path] = commit_id
+            else:
+                result[path] = lcd
+        entry_paths = [
+            os.path.join(path, node.name)
+            for path in todo
+            for node in chain(trees[path].tree_ids, trees[path].blob_ids, trees[path].other_ids)]
+        last_commit_ids = {}
+        if entry_paths:
+            last_commit_ids = commit.repo.last_commit_ids(commit, entry_paths)
+            if last_commit_ids is None:
+                return result
+        for path, commit_id in todo.iteritems():
+            tree = trees[path]
+            entries = []
+            for node in chain(tree.tree_ids, tree.blob_ids, tree.other_ids):
+                node_commit_id = last_commit_ids.get(os.path.join(path, node.name))
+                if node_commit_id is not None:
+                    entries.append({'name': node.name, 'commit_id': node_commit_id})
+            lcd = cls(commit_id=commit_id, path=path, entries=entries)
+            model_cache.set(cls, {'path': path, 'commit_id': commit_id}, lcd)
+            result[path] = lcd
+        return result
+
     @LazyProperty
     def by_name(self):
         return {n.name: n.commit_id for n in self.entries}
@@ -15,15 +15,19 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
 import logging
+import multiprocessing
 from itertools import chain
 from cPickle import dumps
 from collections import OrderedDict
 
 import bson
+from pymongo.errors import DuplicateKeyError
 
 import tg
 import jinja2
+from paste.deploy.converters import asint
 from pylons import tmpl_context as c, app_globals as g
 
 from ming.base import Object
@@ -31,9 +35,9 @@
 
 from allura.lib import utils
 from allura.lib import helpers as h
-from allura.model.repo import CommitDoc, TreeDoc, TreesDoc, DiffInfoDoc
-from allura.model.repo import LastCommitDoc, CommitRunDoc
-from allura.model.repo import Commit, Tree, LastCommit, ModelCache
+from allura.model.repo import CommitDoc, TreeDoc, TreesDoc, DiffInfoDoc, DiffCopiesDoc
+from allura.model.repo import LastCommitDoc, CommitRunDoc, CommitGraphDoc
+from allura.model.repo import Commit, Tree, LastCommit, ModelCache, CommitGraph
 from allura.model.index import ArtifactReferenceDoc, ShortlinkDoc
 from allura.model.auth import User
 
@@ -61,20 +65,14 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
 
     # Refresh commits
     seen = set()
-    for i, oid in enumerate(commit_ids):
-        repo.refresh_commit_info(oid, seen, not all_commits)
-        if (i+1) % 100 == 0:
-            log.info('Refresh commit info %d: %s', (i+1), oid)
+    for i, oids in enumerate(utils.chunked_iter(commit_ids, QSIZE)):
+        oids = list(oids)
+        repo.refresh_commits_info(oids, seen, not all_commits)
+        log.info('Refresh commit info %d: %s',
+                 min((i+1) * QSIZE, len(commit_ids)), oids[-1])
 
     refresh_commit_repos(all_commit_ids, repo)
 
-    # Refresh child references
-    for i, oid in enumerate(commit_ids):
-        ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
-        refresh_children(ci)
-        if (i+1) % 100 == 0:
-            log.info('Refresh child info %d for parents of %s', (i+1), ci._id)
-
     if repo._refresh_precompute:
         # Refresh commit runs
         commit_run_ids = commit_ids
@@ -85,49 +83,46 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
             last_commit = last_known_commit_id(all_commit_ids, new_commit_ids)
             log.info('Last known commit id: %s', last_commit)
             if not CommitRunDoc.m.find(dict(commit_ids=last_commit)).count():
-                log.info('CommitRun incomplete, rebuilding with all commits')
-                commit_run_ids = all_commit_ids
+                log.info('CommitRun incomplete, adding known commits missing from runs')
+                new_ids = set(commit_run_ids)
+                commit_run_ids = commit_run_ids + commits_without_runs(
+                    [oid for oid in all_commit_ids if oid not in new_ids])
         log.info('Starting CommitRunBuilder for %s', repo.full_fs_path)
         rb = CommitRunBuilder(commit_run_ids)
         rb.run()
         rb.cleanup()
         log.info('Finished CommitRunBuilder for %s', repo.full_fs_path)
 
-    # Refresh trees
-    # Like diffs below, pre-computing trees for some SCMs is too expensive,
-    # so we skip it here, then do it on-demand later.
-    if repo._refresh_precompute:
-        cache = {}
-        for i, oid in enumerate(commit_ids):
-            ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
-            cache = refresh_commit_trees(ci, cache)
-            if (i+1) % 100 == 0:
-                log.info('Refresh commit trees %d: %s', (i+1), ci._id)
-
-    # Compute diffs
-    cache = {}
-    # For some SCMs, we don't want to pre-compute the diffs because that
-    # would be too expensive, so we skip them here and do them on-demand
-    # with caching.
-    if repo._refresh_precompute:
-        for i, oid in enumerate(commit_ids):
-            cid = CommitDoc.m.find(dict(_id=oid), validate=False).next()
-            ci = mapper(Commit).create(cid, dict(instrument=False))
-            ci.set_context(repo)
-            compute_diffs(repo._id, cache, ci)
-            if (i+1) % 100 == 0:
-                log.info('Compute diffs %d: %s', (i+1), ci._id)
-
-    if repo._refresh_precompute:
-        model_cache = ModelCache()
-        lcid_cache = {}
-        for i, oid in enumerate(reversed(commit_ids)):
-            ci = model_cache.get(Commit, dict(_id=oid))
-            ci.set_context(repo)
-            compute_lcds(ci, model_cache, lcid_cache)
-            ThreadLocalORMSession.flush_all()
-            if (i+1) % 100 == 0:
-                log.info('Compute last commit info %d: %s', (i+1), ci._id)
+        # Likewise, add all the commits to the commit graph index if it
+        # doesn't have the last known commit for this repo
+        graph_ids = commit_ids
+        if commit_ids != all_commit_ids:
+            if not CommitGraphDoc.m.find(dict(_id=last_commit, repo_ids=repo._id)).count():
+                log.info('Commit graph incomplete, adding all commits')
+                graph_ids = all_commit_ids
+        refresh_commit_graph(repo, graph_ids)
+        log.info('Refreshed commit graph for %s', repo.full_fs_path)
+
+    # Refresh child references, trees, diffs and last commit data in one
+    # pass, a chunk of commits at a time, oldest first so that each commit's
+    # parents are done before it.
+    # Like diffs, pre-computing trees and last commit data for some SCMs is
+    # too expensive, so we skip them here, then do them on-demand later.
+    pipeline = RefreshPipeline(repo)
+    try:
+        for i, oids in enumerate(utils.chunked_iter(reversed(commit_ids), QSIZE)):
+            pipeline.refresh(list(oids))
+            log.info('Refreshed %d commits, last %s',
+                     min((i+1) * QSIZE, len(commit_ids)), pipeline.last_id)
+    finally:
+        pipeline.close()
+
+    num_trees = asint(tg.config.get('scm.lcd.precompute_trees', 0))
+    if num_trees:
+        head = repo.latest()
+        if head is not None:
+            precompute_lcds(head, num_trees)
+            log.info('Precomputed last commit data for %s', repo.full_fs_path)
 
     if not all_commits and not new_clone:
         for commit in commit_ids:
@@ -145,13 +140,122 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False):
     if notify:
         send_notifications(repo, commit_ids)
 
-def refresh_commit_trees(ci, cache):
-    '''Refresh the list of trees included withn a commit'''
+class RefreshPipeline(object):
+    '''Runs the per-commit stages of a refresh on chunks of commits, which
+    must come oldest first.  The CommitDocs of each chunk are loaded at once,
+    and the TreesDocs and DiffInfoDocs computed for it are written at once.
+
+    If the scm.refresh.processes config setting is more than 1, the trees
+    and diffs of each chunk are computed by a pool of that many processes.
+    '''
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.last_id = None
+        self.tree_cache = {}
+        self.diff_cache = {}
+        self.model_cache = ModelCache()
+        self.lcid_cache = {}
+        self.processes = asint(tg.config.get('scm.refresh.processes', 1))
+        self.pool = None
+        if repo._refresh_precompute and self.processes > 1:
+            # the worker processes are forked with the repo to work on
+            global _pool_repo
+            _pool_repo = repo
+            self.pool = multiprocessing.Pool(self.processes)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def refresh(self, oids):
+        cis = dict(
+            (ci._id, ci)
+            for ci in CommitDoc.m.find(dict(_id={'$in':oids}), validate=False))
+        cis = [cis[oid] for oid in oids if oid in cis]
+        if not cis: return
+        self.last_id = cis[-1]._id
+        for ci in cis:
+            refresh_children(ci)
+        if not self.repo._refresh_precompute: return
+        if self.pool is None:
+            self.tree_cache = _refresh_trees(cis, self.tree_cache)
+            self.diff_cache = _compute_diffs(self.repo, cis, self.diff_cache)
+        else:
+            # trees first, since diffs need the trees of the whole chunk
+            chunks = _split([ci._id for ci in cis], self.processes)
+            self.pool.map(_refresh_trees_worker, chunks)
+            self.pool.map(_compute_diffs_worker, chunks)
+        for ci in cis:
+            ci = self.model_cache.get(Commit, dict(_id=ci._id))
+            ci.set_context(self.repo)
+            compute_lcds(ci, self.model_cache, self.lcid_cache)
+            ThreadLocalORMSession.flush_all()
+
+# set for the pool worker processes forked by RefreshPipeline
+_pool_repo = None
+_pool_tree_cache = {}
+_pool_diff_cache = {}
+
+def _split(items, n):
+    '''Split items into at most n lists of about the same size'''
+    size = (len(items) + n - 1) // n
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+def _refresh_trees(cis, cache):
+    docs = []
+    for ci in cis:
+        cache = refresh_commit_trees(ci, cache, docs)
+    _bulk_save(TreesDoc, docs)
+    return cache
+
+def _compute_diffs(repo, cis, cache):
+    docs = []
+    for cid in cis:
+        ci = mapper(Commit).create(cid, dict(instrument=False))
+        ci.set_context(repo)
+        cache = compute_diffs(repo._id, cache, ci, docs)
+    _bulk_save(DiffInfoDoc, docs)
+    if docs:
+        # renames are found from the diffs, so any found before are stale
+        DiffCopiesDoc.m.remove({'_id': {'$in': [d['_id'] for d in docs]}})
+    return cache
+
+def _refresh_trees_worker(oids):
+    global _pool_tree_cache
+    cis = CommitDoc.m.find(dict(_id={'$in':oids}), validate=False).all()
+    _pool_tree_cache = _refresh_trees(cis, _pool_tree_cache)
+
+def _compute_diffs_worker(oids):
+    global _pool_diff_cache
+    cis = CommitDoc.m.find(dict(_id={'$in':oids}), validate=False).all()
+    _pool_diff_cache = _compute_diffs(_pool_repo, cis, _pool_diff_cache)
+
+def _bulk_save(doc_cls, docs):
+    '''Insert docs in one round trip, leaving any that are already saved as
+    they are.  The docs are derived from immutable commits, so a copy saved
+    by another refresh (of a fork, say) is as good as ours.'''
+    if not docs: return
+    collection = doc_cls.m.session.db[doc_cls.m.collection_name]
+    try:
+        collection.insert(docs, safe=True, continue_on_error=True)
+    except DuplicateKeyError:
+        # another refresh got to some of them first
+        pass
+
+def refresh_commit_trees(ci, cache, docs=None):
+    '''Refresh the list of trees included withn a commit.  If docs is
+    given, the TreesDoc is appended to it instead of being saved.'''
     if ci.tree_id is None: return cache
     trees_doc = TreesDoc(dict(
             _id=ci._id,
             tree_ids = list(trees(ci.tree_id, cache))))
-    trees_doc.m.save(safe=False)
+    if docs is not None:
+        docs.append(trees_doc)
+    else:
+        trees_doc.m.save(safe=False)
     new_cache = dict(
         (oid, cache[oid])
         for oid in trees_doc.tree_ids)
@@ -202,6 +306,41 @@ def refresh_children(ci):
         {'$addToSet': dict(child_ids=ci._id)},
         multi=True)
 
+def refresh_commit_graph(repo, commit_ids):
+    '''Add the given commits, which must be in topological order (heads
+    first), to the commit graph index for repo.  Their parents must already
+    be in the index, or among commit_ids.'''
+    graph = CommitGraph(repo._id)
+    for oids in utils.chunked_iter(reversed(commit_ids), QSIZE):
+        oids = list(oids)
+        graph.load(oids)
+        known = [oid for oid in oids if oid in graph.nodes]
+        if known:
+            CommitGraphDoc.m.update_partial(
+                dict(_id={'$in': known}, repo_ids={'$ne': repo._id}),
+                {'$addToSet': dict(repo_ids=repo._id)},
+                multi=True)
+        cis = dict(
+            (ci._id, ci)
+            for ci in CommitDoc.m.find(
+                dict(_id={'$in': [oid for oid in oids if oid not in graph.nodes]}),
+                validate=False))
+        docs = []
+        for oid in oids:
+            ci = cis.get(oid)
+            if ci is None: continue
+            doc = graph.new_entry(ci)
+            doc.repo_ids = [repo._id]
+            graph.add(doc)
+            docs.append(doc)
+        _bulk_save(CommitGraphDoc, docs)
+        if docs:
+            # a fork's refresh may have saved some of them first, for itself
+            CommitGraphDoc.m.update_partial(
+                dict(_id={'$in': [doc._id for doc in docs]}, repo_ids={'$ne': repo._id}),
+                {'$addToSet': dict(repo_ids=repo._id)},
+                multi=True)
+
 class CommitRunBuilder(object):
     '''Class used to build up linear runs of single-parent commits'''
 
@@ -231,42 +370,48 @@ def run(self):
             run.m.save()
         return self.runs
 
-    def _all_runs(self):
-        '''Find all runs containing this builder's commit IDs'''
-        runs = {}
+    def _touched_runs(self):
+        '''Find the runs built by this builder, and the existing runs they
+        may be merged with or replace: the runs containing their commits or
+        starting with their parent commits, and the runs whose parent commit
+        starts one of them'''
+        runs = dict(self.runs)
         for oids in utils.chunked_iter(self.commit_ids, QSIZE):
-            oids = list(oids)
-            for run in CommitRunDoc.m.find(dict(commit_ids={'$in': oids})):
-                runs[run._id] = run
-            for run in CommitRunDoc.m.find(dict(parent_commit_ids={'$in': oids})):
-                runs[run._id] = run
-        seen_run_ids = set()
-        runs = runs.values()
-        while runs:
-            run = runs.pop()
-            if run._id in seen_run_ids: continue
-            seen_run_ids.add(run._id)
-            yield run
-            for run in CommitRunDoc.m.find(
-                dict(commit_ids={'$in':run.parent_commit_ids})):
-                runs.append(run)
+            for run in CommitRunDoc.m.find(dict(commit_ids={'$in': list(oids)})):
+                runs.setdefault(run._id, run)
+        parent_ids = set()
+        for run in self.runs.itervalues():
+            parent_ids.update(run.parent_commit_ids)
+        for oids in utils.chunked_iter(parent_ids, QSIZE):
+            for run in CommitRunDoc.m.find(dict(_id={'$in': list(oids)})):
+                runs.setdefault(run._id, run)
+        for oids in utils.chunked_iter(self.runs.keys(), QSIZE):
+            for run in CommitRunDoc.m.find(dict(parent_commit_ids={'$in': list(oids)})):
+                runs.setdefault(run._id, run)
+        return runs.values()
 
     def cleanup(self):
-        '''Delete non-maximal runs and merge any new runs with existing runs'''
+        '''Delete non-maximal runs and merge the new runs with the existing
+        runs they continue.  Only the runs next to the new ones are looked
+        at, so this costs the same however much history the repo has.'''
         runs = dict(
             (run['commit_ids'][0], run)
-            for run in self._all_runs())
-        for rid, run in runs.items():
-            p_cis = run['parent_commit_ids']
-            if len(p_cis) != 1: continue
-            parent_run = runs.get(p_cis[0], None)
-            if parent_run is None: continue
-            run['commit_ids'] += parent_run['commit_ids']
-            run['commit_times'] += parent_run['commit_times']
-            run['parent_commit_ids'] = parent_run['parent_commit_ids']
-            run.m.save()
-            parent_run.m.delete()
-            del runs[p_cis[0]]
+            for run in self._touched_runs())
+        for rid in runs.keys():
+            run = runs.get(rid)
+            if run is None: continue  # already merged into another run
+            merged = False
+            while len(run['parent_commit_ids']) == 1:
+                p_ci = run['parent_commit_ids'][0]
+                parent_run = runs.pop(p_ci, None)
+                if parent_run is None or parent_run is run: break
+                run['commit_ids'] += parent_run['commit_ids']
+                run['commit_times'] += parent_run['commit_times']
+                run['parent_commit_ids'] = parent_run['parent_commit_ids']
+                parent_run.m.delete()
+                merged = True
+            if merged:
+                run.m.save()
         for run1 in runs.values():
             # if run1 is a subset of another run, delete it
             if CommitRunDoc.m.find(dict(commit_ids={'$all': run1.commit_ids},
@@ -282,32 +427,38 @@ def cleanup(self):
 
     def merge_runs(self):
         '''Find partial runs that may be merged and merge them'''
-        while True:
-            for run_id, run in self.runs.iteritems():
-                if len(run.parent_commit_ids) != 1:
-                    self.reasons[run_id] = '%d parents' % len(run.parent_commit_ids)
-                    continue
-                p_oid = run.parent_commit_ids[0]
-                p_run_id = self.run_index.get(p_oid)
-                if p_run_id is None:
-                    self.reasons[run_id] = 'parent commit not found'
-                    continue
-                p_run = self.runs.get(p_run_id)
-                if p_run is None:
-                    self.reasons[run_id] = 'parent run not found'
-                    continue
-                if p_run.commit_ids[0] != p_oid:
-                    self.reasons[run_id] = 'parent does not start with parent commit'
-                    continue
+        for run_id in self.runs.keys():
+            run = self.runs.get(run_id)
+            if run is None: continue  # already merged into another run
+            while True:
+                p_run_id = self._parent_run_id(run_id, run)
+                if p_run_id is None: break
+                p_run = self.runs.pop(p_run_id)
                 run.commit_ids += p_run.commit_ids
                 run.commit_times += p_run.commit_times
                 run.parent_commit_ids = p_run.parent_commit_ids
                 for oid in p_run.commit_ids:
                     self.run_index[oid] = run_id
-                break
-            else:
-                break
-            del self.runs[p_run_id]
+
+    def _parent_run_id(self, run_id, run):
+        '''Return the id of the run that run continues, if it can be merged
+        into run, otherwise None (recording why not)'''
+        if len(run.parent_commit_ids) != 1:
+            self.reasons[run_id] = '%d parents' % len(run.parent_commit_ids)
+            return None
+        p_oid = run.parent_commit_ids[0]
+        p_run_id = self.run_index.get(p_oid)
+        if p_run_id is None:
+            self.reasons[run_id] = 'parent commit not found'
+            return None
+        p_run = self.runs.get(p_run_id)
+        if p_run is None:
+            self.reasons[run_id] = 'parent run not found'
+            return None
+        if p_run.commit_ids[0] != p_oid:
+            self.reasons[run_id] = 'parent does not start with parent commit'
+            return None
+        return p_run_id
 
 def trees(id, cache):
     '''Recursively generate the list of trees contained within a given tree ID'''
@@ -331,8 +482,9 @@ def unknown_commit_ids(all_commit_ids):
         result += [ oid for oid in chunk if oid not in known_commit_ids ]
     return result
 
-def compute_diffs(repo_id, tree_cache, rhs_ci):
-    '''compute simple differences between a commit and its first parent'''
+def compute_diffs(repo_id, tree_cache, rhs_ci, docs=None):
+    '''compute simple differences between a commit and its first parent.  If
+    docs is given, the DiffInfoDoc is appended to it instead of being saved.'''
     if rhs_ci.tree_id is None: return tree_cache
 
     def _update_cache(lhs_tree_ids, rhs_tree_ids):
@@ -384,7 +536,11 @@ def _update_cache(lhs_tree_ids, rhs_tree_ids):
     di = DiffInfoDoc(dict(
             _id=rhs_ci._id,
             differences=differences))
-    di.m.save()
+    if docs is not None:
+        docs.append(di)
+    else:
+        di.m.save()
+        DiffCopiesDoc.m.remove(dict(_id=rhs_ci._id))
     return tree_cache
 
 def send_notifications(repo, commit_ids):
@@ -508,6 +664,21 @@ def get_commit_info(commit):
         summary=commit.summary
         )
 
+def commits_without_runs(commit_ids):
+    '''Return the ids of the commits, newest first, that aren't in any
+    CommitRun.  Only commit_ids up to the first chunk of them that are all in
+    runs are looked at, so the cost depends on how many are missing rather
+    than on the size of the repo.'''
+    missing = []
+    for oids in utils.chunked_iter(commit_ids, QSIZE):
+        oids = [oid for oid in oids
+                if not CommitRunDoc.m.find(dict(commit_ids=oid)).count()]
+        if not oids:
+            break
+        missing.extend(oids)
+    return missing
+
+
 def last_known_commit_id(all_commit_ids, new_commit_ids):
     """
     Return the newest "known" (cached in mongo) commit id.
@@ -523,6 +694,23 @@ def last_known_commit_id(all_commit_ids, new_commit_ids):
     return all_commit_ids[all_commit_ids.index(new_commit_ids[0]) - 1]
 
 
+def precompute_lcds(commit, num_trees):
+    '''
+    Build the LastCommit data for the root tree of commit and the directories
+    nearest to it, num_trees trees in all, so that they're ready the first
+    time they're browsed.
+    '''
+    paths = []
+    to_visit = ['']
+    while to_visit and len(paths) < num_trees:
+        path = to_visit.pop(0)
+        paths.append(path)
+        tree = commit.get_path(path)
+        to_visit += [os.path.join(path, node.name) for node in tree.tree_ids]
+    with h.push_config(c, model_cache=ModelCache()):
+        LastCommit.build_many(commit, paths)
+    ThreadLocalORMSession.flush_all()
+
 def compute_lcds(commit, model_cache, lcid_cache):
     '''
     Compute LastCommit data for every Tree node under this tree.
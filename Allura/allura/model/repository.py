@@ -23,17 +23,19 @@
 import logging
 import string
 import re
-from subprocess import Popen
+import time
+import threading
+from subprocess import Popen, PIPE, CalledProcessError
 from difflib import SequenceMatcher
 from hashlib import sha1
 from datetime import datetime
 from collections import defaultdict
-from itertools import izip
+from itertools import izip, islice
 from urlparse import urljoin
 from urllib import quote
 
 import tg
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 from pylons import tmpl_context as c
 from pylons import app_globals as g
 import pymongo.errors
@@ -51,7 +53,7 @@
 from .session import repository_orm_session, project_orm_session
 from .notification import Notification
 from .repo_refresh import refresh_repo, unknown_commit_ids as unknown_commit_ids_repo
-from .repo import CommitRunDoc, QSIZE
+from .repo import CommitRunDoc, CommitGraph, QSIZE
 from .timeline import ActivityObject
 
 log = logging.getLogger(__name__)
@@ -100,6 +102,13 @@ def refresh_commit_info(self, oid, lazy=True): # pragma no cover
         '''Refresh the data in the commit with id oid'''
         raise NotImplementedError, 'refresh_commit_info'
 
+    def refresh_commits_info(self, commit_ids, seen, lazy=True):
+        '''Refresh the data in the commits with the given ids, returning how
+        many were refreshed.  Implementations that can read many commits
+        more cheaply than one at a time should override this.'''
+        return len([oid for oid in commit_ids
+                    if self.refresh_commit_info(oid, seen, lazy)])
+
     def _setup_hooks(self, source_path=None): # pragma no cover
         '''Install a hook in the repository that will ping the refresh url for
         the repo.  Optionally provide a path from which to copy existing hooks.'''
@@ -132,9 +141,11 @@ def commits_count(self, path=None, rev=None):
         '''Return count of the commits related to path'''
         raise NotImplementedError, 'commits_count'
 
-    def tarball(self, revision, path=None):
-        '''Create a tarball for the revision'''
-        raise NotImplementedError, 'tarball'
+    def archive(self, revision, path=None):
+        '''Return an iterator over a zip archive of the revision, with its
+        files in a directory named after the repo's tarball_filename.  The
+        archive should be produced as it is iterated over, not up front.'''
+        raise NotImplementedError, 'archive'
 
     def last_commit_ids(self, commit, paths):
         '''
@@ -306,6 +317,8 @@ def all_commit_ids(self):
         return self._impl.all_commit_ids()
     def refresh_commit_info(self, oid, seen, lazy=True):
         return self._impl.refresh_commit_info(oid, seen, lazy)
+    def refresh_commits_info(self, commit_ids, seen, lazy=True):
+        return self._impl.refresh_commits_info(commit_ids, seen, lazy)
     def open_blob(self, blob):
         return self._impl.open_blob(blob)
     def blob_size(self, blob):
@@ -349,6 +362,11 @@ def log(self, branch='master', offset=0, limit=10):
         return list(self._log(branch, offset, limit))
 
     def commitlog(self, commit_ids, skip=0, limit=sys.maxint):
+        graph = CommitGraph(self._id)
+        if graph.load(commit_ids):
+            return islice(graph.walk(commit_ids), skip,
+                          skip + limit if limit < sys.maxint - skip else None)
+        # Repos refreshed before the commit graph index existed
         seen = set()
         def _visit(commit_id):
             if commit_id in seen: return
@@ -419,6 +437,9 @@ def count(self, branch='master'):
 
     def count_revisions(self, ci):
         from .repo_refresh import CommitRunBuilder
+        result = CommitGraph(self._id).count(ci._id)
+        if result is not None:
+            return result
         result = 0
         # If there's no CommitRunDoc for this commit, the call to
         # commitlog() below will raise a KeyError. Repair the CommitRuns for
@@ -551,10 +572,29 @@ def pending_upstream_merges(self):
     def forks(self):
         return self.query.find({'upstream_repo.name': self.url()}).all()
 
+    def tarball_cache(self, revision, path=None):
+        return TarballCache(
+            self.tarball_path, self.tarball_filename(revision, path),
+            timeout=asint(tg.config.get('scm.repos.tarball.build_timeout', 300)))
+
     def tarball(self, revision, path=None):
+        '''Write the zip archive of the revision to the tarball cache, unless
+        it's already there or being built'''
+        if path:
+            path = path.strip('/')
+        self.tarball_cache(revision, path).build(self._impl.archive(revision, path))
+
+    def tarball_stream(self, revision, path=None):
+        '''Return an iterator over the zip archive of the revision, streamed
+        as it's built.  Unless scm.repos.tarball.stream.cache is false, the
+        archive is also written to the tarball cache on the way (or read
+        from it, if it's already there or being built by someone else).'''
         if path:
             path = path.strip('/')
-        self._impl.tarball(revision, path)
+        chunks = self._impl.archive(revision, path)
+        if not asbool(tg.config.get('scm.repos.tarball.stream.cache', True)):
+            return chunks
+        return self.tarball_cache(revision, path).stream(chunks)
 
 class MergeRequest(VersionedArtifact, ActivityObject):
     statuses=['open', 'merged', 'rejected']
@@ -1346,8 +1386,7 @@ def topological_sort(graph):
     assert not graph, 'Cycle detected'
 
 
-def zipdir(source, zipfile, exclude=None):
-    """Create zip archive using zip binary."""
+def _zip_command(source, zipfile, exclude=None):
     zipbin = tg.config.get('scm.repos.tarball.zip_binary', '/usr/bin/zip')
     source = source.rstrip('/')
     # this is needed to get proper prefixes inside zip-file
@@ -1356,7 +1395,204 @@ def zipdir(source, zipfile, exclude=None):
     command = [zipbin, '-r', zipfile, source_fn]
     if exclude:
         command += ['-x', exclude]
+    return command, working_dir
+
+
+def zipdir(source, zipfile, exclude=None):
+    """Create zip archive using zip binary."""
+    command, working_dir = _zip_command(source, zipfile, exclude)
     Popen(command, cwd=working_dir).communicate()
 
 
+def zipdir_stream(source, exclude=None):
+    """Like zipdir, but yield the zip archive as the zip binary writes it."""
+    command, working_dir = _zip_command(source, '-', exclude)
+    return stream_command(command, cwd=working_dir)
+
+
+def stream_command(command, cwd=None, chunk_size=64 * 1024):
+    """Run command, yielding its output as it's written.  Raises
+    CalledProcessError if the command fails."""
+    proc = Popen(command, cwd=cwd, stdout=PIPE)
+    finished = False
+    try:
+        for chunk in iter(lambda: proc.stdout.read(chunk_size), ''):
+            yield chunk
+        finished = True
+    finally:
+        proc.stdout.close()
+        if not finished and proc.poll() is None:
+            proc.kill()
+        returncode = proc.wait()
+    if returncode:
+        raise CalledProcessError(returncode, command)
+
+
+class TarballCache(object):
+    '''A zip archive of a repo snapshot, cached as <name>.zip in directory.
+
+    The archive is written to <name>.tmp, which is renamed when complete.
+    Whoever creates the .tmp file builds the archive; anyone who wants it in
+    the meantime follows the .tmp file as it grows, rather than building it
+    again.  The builder touches the .tmp file every timeout / 3 seconds, even
+    while it waits on slow chunks, so a .tmp file that hasn't been modified
+    for timeout seconds is taken to be left over from a build that died.'''
+
+    def __init__(self, directory, name, timeout=300, poll_interval=0.5,
+                 chunk_size=64 * 1024):
+        self.filename = os.path.join(directory, name + '.zip')
+        self.tmpfilename = os.path.join(directory, name + '.tmp')
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+
+    def build(self, chunks):
+        '''Write the archive from chunks, unless it's already cached or being
+        built.  Returns True if it was written by this call.'''
+        fp = self._claim()
+        if fp is None:
+            return False
+        for chunk in self._tee(fp, chunks):
+            pass
+        return True
+
+    def stream(self, chunks):
+        '''Yield the archive: from the cache, from the build in progress, or
+        else from chunks, writing it to the cache as it goes.  chunks is
+        only iterated over in the last case.'''
+        while True:
+            try:
+                fp = open(self.filename, 'rb')
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                with fp:
+                    for chunk in self._read(fp):
+                        yield chunk
+                return
+            fp = self._claim()
+            if fp is not None:
+                for chunk in self._tee(fp, chunks):
+                    yield chunk
+                return
+            followed = False
+            for chunk in self._follow():
+                followed = True
+                yield chunk
+            if followed:
+                return
+            # the build finished or failed before we got any of it; try again
+
+    def _read(self, fp):
+        return iter(lambda: fp.read(self.chunk_size), '')
+
+    def _claim(self):
+        '''Create the .tmp file and return it open for writing, or None if
+        the archive is cached or being built'''
+        if os.path.isfile(self.filename):
+            return None
+        directory = os.path.dirname(self.filename)
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            fd = os.open(self.tmpfilename, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            if not self._stale():
+                return None
+            log.warning('Removing stale %s', self.tmpfilename)
+            try:
+                os.remove(self.tmpfilename)
+            except OSError:
+                pass
+            return self._claim()
+        return os.fdopen(fd, 'wb')
+
+    def _stale(self):
+        try:
+            return time.time() - os.stat(self.tmpfilename).st_mtime > self.timeout
+        except OSError:
+            return True
+
+    def _tee(self, fp, chunks):
+        '''Yield chunks, writing them to fp (the .tmp file), which is
+        renamed into place once they have all been written'''
+        complete = False
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(fp, done))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            for chunk in chunks:
+                fp.write(chunk)
+                # followers only see what has been flushed
+                fp.flush()
+                yield chunk
+            complete = True
+        finally:
+            done.set()
+            heartbeat.join()
+            # the .tmp file may have been taken over, if we took too long
+            mine = _inode(self.tmpfilename) == os.fstat(fp.fileno()).st_ino
+            fp.close()
+            if mine and complete:
+                os.rename(self.tmpfilename, self.filename)
+            elif mine:
+                os.remove(self.tmpfilename)
+
+    def _heartbeat(self, fp, done):
+        '''Touch the .tmp file until done is set, so that it isn't taken for
+        stale while the builder is alive'''
+        inode = os.fstat(fp.fileno()).st_ino
+        while not done.wait(self.timeout / 3.0):
+            if _inode(self.tmpfilename) != inode:
+                return
+            try:
+                os.utime(self.tmpfilename, None)
+            except OSError:
+                return
+
+    def _follow(self):
+        '''Yield the .tmp file as it's written, until it's renamed into
+        place.  Yields nothing if there is no build in progress, or if the
+        build fails before writing anything.'''
+        try:
+            fp = open(self.tmpfilename, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        with fp:
+            inode = os.fstat(fp.fileno()).st_ino
+            sent = False
+            while True:
+                chunk = fp.read(self.chunk_size)
+                if chunk:
+                    sent = True
+                    yield chunk
+                    continue
+                if _inode(self.filename) == inode:
+                    # complete; pick up whatever was written since the last read
+                    for chunk in self._read(fp):
+                        yield chunk
+                    return
+                if _inode(self.tmpfilename) != inode or self._stale():
+                    if not sent:
+                        return
+                    raise IOError('Build of %s did not complete' % self.filename)
+                time.sleep(self.poll_interval)
+
+
+def _inode(filename):
+    try:
+        return os.stat(filename).st_ino
+    except OSError:
+        return None
+
+
 Mapper.compile_all()
@@ -0,0 +1,422 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Benchmark repository refresh and browsing against a synthetic history.
+
+Generates a git or svn repository with the requested number of commits,
+branching and tree shape, refreshes it, then browses it (commit log pages,
+last commit data and tree listings), reporting the time, the number of mongo
+queries made through ModelCaches, and (when the server reports them) the
+number of mongo operations for each stage.
+
+The repository is refreshed in the context of an existing repo tool, so run
+this against a scratch database, e.g.::
+
+    paster script development.ini ../Allura/allura/scripts/benchmark_refresh.py -- \\
+        --type git --project test --mount-point src-git --commits 5000
+"""
+
+import os
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+from datetime import datetime
+from collections import defaultdict
+from contextlib import contextmanager
+from subprocess import Popen, PIPE
+
+import tg
+from pylons import tmpl_context as c
+from ming.orm import ThreadLocalORMSession
+
+from allura import model as M
+from allura.lib import helpers as h
+from allura.lib.utils import chunked_list
+from allura.scripts import ScriptTask
+
+log = logging.getLogger(__name__)
+
+AUTHOR = 'Benchmark <benchmark@example.com>'
+START_TIME = 1356998400  # 2013-01-01
+
+
+class BenchmarkRefresh(ScriptTask):
+    @classmethod
+    def parser(cls):
+        parser = argparse.ArgumentParser(description='Refresh and browse a '
+                'synthetic repository, reporting timings and query counts for '
+                'each stage.')
+        parser.add_argument('--type', choices=['git', 'svn'], default='git',
+                help='Type of repository to generate. Default: git')
+        parser.add_argument('--project', default='test',
+                help='Shortname of the project to refresh the repo in. Default: test')
+        parser.add_argument('--mount-point', dest='mount_point', required=True,
+                help='Mount point of a repo tool of the same type in the project')
+        parser.add_argument('--commits', type=int, default=1000,
+                help='Number of commits to generate. Default: 1000')
+        parser.add_argument('--branching', type=float, default=0.05,
+                help='Chance of each commit on master starting a branch, which is '
+                'merged back after a few commits. Default: 0.05')
+        parser.add_argument('--width', type=int, default=5,
+                help='Number of subdirectories and files in each directory. Default: 5')
+        parser.add_argument('--depth', type=int, default=3,
+                help='Number of levels of directories. Default: 3')
+        parser.add_argument('--changes', type=int, default=3,
+                help='Number of files changed by each commit. Default: 3')
+        parser.add_argument('--seed', type=int, default=0,
+                help='Random seed, for generating the same history again. Default: 0')
+        parser.add_argument('--trees', type=int, default=20,
+                help='Number of trees to build last commit data for and list, '
+                'nearest the root first. Default: 20')
+        parser.add_argument('--log-pages', dest='log_pages', type=int, default=10,
+                help='Number of commit log pages to read. Default: 10')
+        parser.add_argument('--dir', default=None,
+                help='Directory to generate the repository in. Default: a temporary directory')
+        parser.add_argument('--keep', action='store_true', default=False,
+                help='Keep the repository and its mongo data when done')
+        return parser
+
+    @classmethod
+    def execute(cls, options):
+        h.set_context(options.project, options.mount_point)
+        if c.app is None or getattr(c.app, 'repo', None) is None:
+            return 'No repo tool at %s in %s' % (options.mount_point, options.project)
+        if c.app.repo.tool.lower() != options.type:
+            return '%s is not a %s repo tool' % (options.mount_point, options.type)
+        base_dir = options.dir or tempfile.mkdtemp(prefix='benchmark-refresh-')
+        name = 'benchmark.git' if options.type == 'git' else 'benchmark'
+        history = synthetic_history(options.commits, options.width, options.depth,
+                                    options.changes, options.branching, options.seed)
+        log.info('Generating %s repository in %s', options.type, base_dir)
+        start = time.time()
+        if options.type == 'git':
+            make_git_repo(os.path.join(base_dir, name), history)
+        else:
+            make_svn_repo(os.path.join(base_dir, name), history)
+        log.info('Generated %d commits in %.1fs', options.commits, time.time() - start)
+
+        repo = c.app.repo.__class__(
+            name=name,
+            fs_path=base_dir.rstrip('/') + '/',
+            url_path='/%s/' % options.project,
+            tool=options.type,
+            status='creating')
+        ThreadLocalORMSession.flush_all()
+        stats = Stats()
+        try:
+            commit_ids = list(repo.all_commit_ids())
+            # the history is the same each time, so clear out any previous run
+            cls._clean(commit_ids)
+            with stats.recording_caches():
+                cls.benchmark_refresh(repo, stats)
+                cls.benchmark_browse(repo, stats, commit_ids, options.trees,
+                                     options.log_pages)
+        finally:
+            if not options.keep:
+                cls._clean(commit_ids)
+                repo.delete()
+                ThreadLocalORMSession.flush_all()
+                shutil.rmtree(base_dir, ignore_errors=True)
+        stats.report()
+
+    @classmethod
+    def benchmark_refresh(cls, repo, stats):
+        from allura.model import repo_refresh as RR
+        impl_class = repo._impl.__class__
+        with stats.instrument(impl_class, 'refresh_commits_info', 'commit info'), \
+                stats.instrument(RR, 'refresh_commit_repos', 'commit repos'), \
+                stats.instrument(RR.CommitRunBuilder, 'run', 'commit runs'), \
+                stats.instrument(RR.CommitRunBuilder, 'cleanup', 'commit runs'), \
+                stats.instrument(RR, 'refresh_commit_graph', 'commit graph'), \
+                stats.instrument(RR.RefreshPipeline, 'refresh', 'trees, diffs, lcds'), \
+                stats.instrument(RR, 'precompute_lcds', 'precompute lcds'), \
+                stats.instrument(repo.__class__, 'count_revisions', 'count revisions'), \
+                h.push_config(tg.config, **{'scm.new_refresh': 'true'}):
+            with stats.stage('refresh (total)'):
+                repo.refresh(notify=False)
+                ThreadLocalORMSession.flush_all()
+
+    @classmethod
+    def benchmark_browse(cls, repo, stats, commit_ids, num_trees, log_pages):
+        head = repo.latest()
+        if head is None:
+            return
+        ThreadLocalORMSession.close_all()
+        for page in range(log_pages):
+            with stats.stage('commitlog page'):
+                if not list(repo.commitlog([head._id], page * 25, 25)):
+                    break
+        trees = cls._trees(head, num_trees)
+        # build the last commit data from scratch
+        for ids in chunked_list(commit_ids, 3000):
+            M.repo.LastCommitDoc.m.remove({'commit_id': {'$in': ids}})
+        ThreadLocalORMSession.close_all()
+        for tree in trees:
+            with stats.stage('LastCommit.get (build)'):
+                M.repo.LastCommit.get(tree)
+                ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        for tree in trees:
+            with stats.stage('Tree.ls'):
+                tree.ls()
+
+    @classmethod
+    def _trees(cls, commit, num_trees):
+        '''The first num_trees trees of commit, breadth first'''
+        trees = []
+        todo = [commit.tree]
+        while todo and len(trees) < num_trees:
+            tree = todo.pop(0)
+            trees.append(tree)
+            todo.extend(tree[o.name] for o in tree.tree_ids)
+        return trees
+
+    @classmethod
+    def _clean(cls, commit_ids):
+        for ids in chunked_list(commit_ids, 3000):
+            tree_ids = [tree_id
+                        for doc in M.repo.TreesDoc.m.find({'_id': {'$in': ids}})
+                        for tree_id in doc.get('tree_ids', [])]
+            for tree_ids_chunk in chunked_list(tree_ids, 300000):
+                M.repo.TreeDoc.m.remove({'_id': {'$in': tree_ids_chunk}})
+            for doc_cls in (M.repo.CommitDoc, M.repo.TreesDoc, M.repo.DiffInfoDoc,
+                            M.repo.DiffCopiesDoc, M.repo.CommitGraphDoc):
+                doc_cls.m.remove({'_id': {'$in': ids}})
+            M.repo.LastCommitDoc.m.remove({'commit_id': {'$in': ids}})
+            M.repo.CommitRunDoc.m.remove({'commit_ids': {'$in': ids}})
+
+
+class Stats(object):
+    '''Time, ModelCache queries and mongo operations, by stage.  Stages may
+    be nested, e.g. the stages of a refresh within the whole refresh.'''
+
+    def __init__(self):
+        self.stages = []
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.cache_queries = defaultdict(int)
+        self.db_ops = {}
+        self._active = []  # (name, caches created) of the stages running
+
+    @contextmanager
+    def stage(self, name):
+        if name not in self.calls:
+            self.stages.append(name)
+        caches = []
+        self._active.append(caches)
+        ops = db_ops()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.time() - start
+            self.calls[name] += 1
+            self._active.pop()
+            self.cache_queries[name] += sum(cache.num_queries() for cache in caches)
+            if ops is not None:
+                self.db_ops[name] = self.db_ops.get(name, 0) + db_ops() - ops
+
+    @contextmanager
+    def instrument(self, owner, attr, name):
+        '''Count calls to owner.attr (a module function, or a method if owner
+        is a class) as stage name'''
+        if isinstance(owner, type):
+            defined_in = [k for k in owner.__mro__ if attr in k.__dict__][0]
+            orig = defined_in.__dict__[attr]
+        else:
+            defined_in = owner
+            orig = getattr(owner, attr)
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return orig(*args, **kwargs)
+        setattr(owner, attr, timed)
+        try:
+            yield
+        finally:
+            if defined_in is owner:
+                setattr(owner, attr, orig)
+            else:
+                delattr(owner, attr)
+
+    @contextmanager
+    def recording_caches(self):
+        '''Count the queries of the ModelCaches created in each stage'''
+        from allura.model import repo, repo_refresh
+        orig = repo.ModelCache
+        active = self._active
+        class RecordingModelCache(orig):
+            def __init__(self, *args, **kwargs):
+                super(RecordingModelCache, self).__init__(*args, **kwargs)
+                for caches in active:
+                    caches.append(self)
+        repo.ModelCache = repo_refresh.ModelCache = RecordingModelCache
+        try:
+            yield
+        finally:
+            repo.ModelCache = repo_refresh.ModelCache = orig
+
+    def report(self):
+        print '%-28s %6s %10s %10s %14s %10s' % (
+            'stage', 'calls', 'seconds', 'per call', 'cache queries', 'mongo ops')
+        for name in self.stages:
+            calls = self.calls[name]
+            print '%-28s %6d %10.3f %10.4f %14d %10s' % (
+                name, calls, self.seconds[name], self.seconds[name] / calls,
+                self.cache_queries[name], self.db_ops.get(name, 'n/a'))
+
+
+def db_ops():
+    '''The number of queries, getmores and writes the mongo server has done,
+    or None if it doesn't say (e.g. mim)'''
+    try:
+        status = M.repo.CommitDoc.m.session.db.command('serverStatus')
+        counters = status['opcounters']
+    except Exception:
+        return None
+    return sum(counters.get(k, 0)
+               for k in ('query', 'getmore', 'insert', 'update', 'delete'))
+
+
+def synthetic_history(num_commits, width, depth, changes, branching, seed):
+    '''Yield the commits of a synthetic history, as dicts with id (its index),
+    branch, parent ids, time, and files ({path: content}).  The first commit
+    adds a tree of width subdirectories and width files per directory, depth
+    levels deep; the rest change a few of those files.  Branches are merged
+    back into master by a commit that takes the branch's changes.'''
+    rnd = random.Random(seed)
+    paths = _tree_paths(width, depth)
+
+    def change(n):
+        return dict((path, '%s\nrevision %d\n' % (path, n))
+                    for path in rnd.sample(paths, min(changes, len(paths))))
+
+    def commit(n, branch, parents, files):
+        return dict(id=n, branch=branch, parents=parents, files=files,
+                    time=START_TIME + n * 60)
+
+    yield commit(0, 'master', [], dict((path, '%s\n' % path) for path in paths))
+    tip, n, branches = 0, 1, 0
+    while n < num_commits:
+        if rnd.random() < branching and num_commits - n > 2:
+            branches += 1
+            branch = 'branch-%d' % branches
+            branch_tip, branch_files = tip, {}
+            for i in range(rnd.randint(1, 5)):
+                if num_commits - n < 2: break
+                files = change(n)
+                branch_files.update(files)
+                yield commit(n, branch, [branch_tip], files)
+                branch_tip, n = n, n + 1
+                if rnd.random() < 0.5 and num_commits - n > 1:
+                    # master moves on meanwhile
+                    yield commit(n, 'master', [tip], change(n))
+                    tip, n = n, n + 1
+            yield commit(n, 'master', [tip, branch_tip], branch_files)
+        else:
+            yield commit(n, 'master', [tip], change(n))
+        tip, n = n, n + 1
+
+
+def _tree_paths(width, depth):
+    dirs = ['']
+    for level in range(depth):
+        dirs += ['%sdir%d/' % (d, i) for d in dirs if d.count('/') == level
+                 for i in range(width)]
+    return sorted('%sfile%d.txt' % (d, i) for d in dirs for i in range(width))
+
+
+def make_git_repo(path, history):
+    '''Create a bare git repo at path from history, with git fast-import'''
+    Popen(['git', 'init', '--quiet', '--bare', path]).communicate()
+    p = Popen(['git', 'fast-import', '--quiet'], cwd=path, stdin=PIPE)
+    for ci in history:
+        date = '%d +0000' % ci['time']
+        message = 'Commit %d on %s\n' % (ci['id'], ci['branch'])
+        p.stdin.write('commit refs/heads/%s\nmark :%d\n' % (ci['branch'], ci['id'] + 1))
+        p.stdin.write('author %s %s\ncommitter %s %s\n' % (AUTHOR, date, AUTHOR, date))
+        p.stdin.write('data %d\n%s' % (len(message), message))
+        if ci['parents']:
+            p.stdin.write('from :%d\n' % (ci['parents'][0] + 1))
+        for parent in ci['parents'][1:]:
+            p.stdin.write('merge :%d\n' % (parent + 1))
+        for file_path, content in sorted(ci['files'].iteritems()):
+            p.stdin.write('M 100644 inline %s\ndata %d\n%s\n' % (
+                file_path, len(content), content))
+        p.stdin.write('\n')
+    p.stdin.close()
+    if p.wait():
+        raise Exception('git fast-import failed')
+
+
+def make_svn_repo(path, history):
+    '''Create an svn repo at path from history, by loading a generated dump.
+    master is trunk and other branches are copies in branches/; merges are
+    plain commits to trunk.'''
+    Popen(['svnadmin', 'create', path]).communicate()
+    p = Popen(['svnadmin', 'load', '--quiet', path], stdin=PIPE, stdout=PIPE)
+    p.stdin.write('SVN-fs-dump-format-version: 2\n\n')
+    revs = {}
+    branches = set()
+    for ci in history:
+        revno = revs[ci['id']] = len(revs) + 1
+        message = 'Commit %d on %s\n' % (ci['id'], ci['branch'])
+        date = datetime.utcfromtimestamp(ci['time']).strftime('%Y-%m-%dT%H:%M:%S.000000Z')
+        props = _svn_props([('svn:log', message), ('svn:author', 'benchmark'),
+                            ('svn:date', date)])
+        p.stdin.write('Revision-number: %d\nProp-content-length: %d\n'
+                      'Content-length: %d\n\n%s\n' % (revno, len(props), len(props), props))
+        if ci['branch'] == 'master':
+            root = 'trunk'
+        else:
+            root = 'branches/' + ci['branch']
+            if ci['branch'] not in branches:
+                # the first commit on the branch copies trunk
+                branches.add(ci['branch'])
+                p.stdin.write('Node-path: %s\nNode-kind: dir\nNode-action: add\n'
+                              'Node-copyfrom-rev: %d\nNode-copyfrom-path: trunk\n\n\n' % (
+                                  root, revs[ci['parents'][0]]))
+        action = 'change'
+        if not ci['parents']:
+            action = 'add'
+            dirs = set(['trunk', 'branches'])
+            for file_path in ci['files']:
+                parts = file_path.split('/')[:-1]
+                dirs.update('trunk/' + '/'.join(parts[:i + 1]) for i in range(len(parts)))
+            for d in sorted(dirs):
+                p.stdin.write('Node-path: %s\nNode-kind: dir\nNode-action: add\n\n\n' % d)
+        for file_path, content in sorted(ci['files'].iteritems()):
+            p.stdin.write('Node-path: %s/%s\nNode-kind: file\nNode-action: %s\n'
+                          'Text-content-length: %d\nContent-length: %d\n\n%s\n\n' % (
+                              root, file_path, action, len(content), len(content), content))
+    p.stdin.close()
+    p.stdout.read()
+    if p.wait():
+        raise Exception('svnadmin load failed')
+
+
+def _svn_props(props):
+    '''Format revision properties for an svn dump'''
+    return ''.join('K %d\n%s\nV %d\n%s\n' % (len(k), k, len(v), v)
+                   for k, v in props) + 'PROPS-END\n'
+
+
+if __name__ == '__main__':
+    BenchmarkRefresh.main()
@@ -112,10 +112,20 @@ def execute(cls, options):
                                 log.info("Deleting %i DiffInfoDoc docs...", i)
                                 M.repo.DiffInfoDoc.m.remove({"_id": {"$in": ci_ids_chunk}})
 
+                            i = M.repo.DiffCopiesDoc.m.find({"_id": {"$in": ci_ids_chunk}}).count()
+                            if i:
+                                log.info("Deleting %i DiffCopiesDoc docs...", i)
+                                M.repo.DiffCopiesDoc.m.remove({"_id": {"$in": ci_ids_chunk}})
+
                             i = M.repo.CommitRunDoc.m.find({"commit_ids": {"$in": ci_ids_chunk}}).count()
                             if i:
                                 log.info("Deleting %i CommitRunDoc docs...", i)
                                 M.repo.CommitRunDoc.m.remove({"commit_ids": {"$in": ci_ids_chunk}})
+
+                            i = M.repo.CommitGraphDoc.m.find({"_id": {"$in": ci_ids_chunk}}).count()
+                            if i:
+                                log.info("Deleting %i CommitGraphDoc docs...", i)
+                                M.repo.CommitGraphDoc.m.remove({"_id": {"$in": ci_ids_chunk}})
                         del ci_ids
 
                     try:
@@ -26,18 +26,30 @@
 
 log = logging.getLogger(__name__)
 
-@task
+# don't let coalesced add_artifacts tasks grow past this many ref_ids
+COALESCE_MAX_REFS = 1000
+
+def _coalesce_add_artifacts(ref_ids, update_solr=True, update_refs=True):
+    '''Merge small add_artifacts posts into a waiting task, unioning the ref_ids'''
+    if len(ref_ids) > COALESCE_MAX_REFS // 10:
+        return None
+    return dict(
+        key='solr=%s refs=%s' % (update_solr, update_refs),
+        query={'args.0.%d' % (COALESCE_MAX_REFS - len(ref_ids)): {'$exists': False}},
+        update={'$addToSet': {'args.0': {'$each': list(ref_ids)}}})
+
+@task(coalesce=_coalesce_add_artifacts)
 def add_artifacts(ref_ids, update_solr=True, update_refs=True):
     '''Add the referenced artifacts to SOLR and shortlinks'''
     from allura import model as M
-    from allura.lib.search import find_shortlinks, solarize
+    from allura.lib.search import solarize_with_shortlinks
     exceptions = []
     solr_updates = []
     with _indexing_disabled(M.session.artifact_orm_session._get()):
         for ref in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})):
             try:
                 artifact = ref.artifact
-                s = solarize(artifact)
+                s, shortlinks = solarize_with_shortlinks(artifact)
                 if s is None:
                     continue
                 if update_solr:
@@ -45,12 +57,11 @@ def add_artifacts(ref_ids, update_solr=True, update_refs=True):
                 if update_refs:
                     if isinstance(artifact, M.Snapshot):
                         continue
-                    ref.references = [
-                        link.ref_id for link in find_shortlinks(s['text']) ]
+                    ref.references = [link.ref_id for link in shortlinks]
             except Exception:
                 log.error('Error indexing artifact %s', ref._id)
                 exceptions.append(sys.exc_info())
-        g.solr.add(solr_updates)
+        g.solr.add_buffered(solr_updates)
 
     if len(exceptions) == 1:
         raise exceptions[0][0], exceptions[0][1], exceptions[0][2]
@@ -62,12 +73,61 @@ def del_artifacts(ref_ids):
     from allura import model as M
     if not ref_ids: return
     solr_query = 'id:({0})'.format(' || '.join(ref_ids))
-    g.solr.delete(q=solr_query)
+    g.solr.delete_buffered(solr_query)
     M.ArtifactReference.query.remove(dict(_id={'$in':ref_ids}))
     M.Shortlink.query.remove(dict(ref_id={'$in':ref_ids}))
 
 @task
+def reindex_app(app_config_id, query=None, chunk_size=1000):
+    '''Create the artifact references and shortlinks for the artifacts of an
+    app, and add them to SOLR.  For after bulk changes that were made with
+    artifact indexing disabled.  Only the artifacts matching query (say,
+    dict(import_id=...)) are reindexed, if it's given; otherwise all of them
+    are, which takes as long as the app is big.'''
+    from allura import model as M
+    from allura.lib import utils
+    query = dict(query or {}, app_config_id=app_config_id)
+    for cls in _artifact_classes():
+        # chunked_find keeps its place in the query it's given
+        for artifacts in utils.chunked_find(cls, dict(query), pagesize=chunk_size):
+            ref_ids = []
+            for a in artifacts:
+                try:
+                    M.ArtifactReference.from_artifact(a)
+                    M.Shortlink.from_artifact(a)
+                except Exception:
+                    log.exception('Making ArtifactReference/Shortlink from %s', a)
+                    continue
+                ref_ids.append(a.index_id())
+            M.main_orm_session.flush()
+            try:
+                add_artifacts(ref_ids)
+            except CompoundError, err:
+                log.exception('Error indexing artifacts:\n%r', err)
+                log.error('%s', err.format_error())
+            M.main_orm_session.flush()
+            M.main_orm_session.clear()
+            M.artifact_orm_session.clear()
+    g.solr.flush()
+
+def _artifact_classes():
+    '''One mapped Artifact class per collection; querying it also finds the
+    polymorphic subclasses stored in the same collection.'''
+    from ming.orm import Mapper
+    from allura import model as M
+    classes = {}
+    for m in Mapper.all_mappers():
+        cls = m.mapped_class
+        if not issubclass(cls, M.Artifact) or not m.collection.m.collection_name:
+            continue
+        key = m.collection.m.session, m.collection.m.collection_name
+        if key not in classes or issubclass(classes[key], cls):
+            classes[key] = cls
+    return classes.values()
+
+@task(coalesce=lambda: dict(key='commit'))
 def commit():
+    g.solr.flush()
     g.solr.commit()
 
 @contextmanager
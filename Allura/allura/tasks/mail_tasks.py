@@ -132,6 +132,17 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
         addrs_html, fromaddr, reply_to, subject, message_id,
         in_reply_to, html_msg)
 
+@task
+def sendmail_batch(messages):
+    '''Send several emails, each given as a dict of sendmail() arguments.
+    They all go out over this process's smtp connection.'''
+    for kwargs in messages:
+        try:
+            sendmail(**kwargs)
+        except:
+            # keep going, so one bad message doesn't hold up the others
+            log.exception('Error sending mail %s', kwargs.get('message_id'))
+
 @task
 def sendsimplemail(
     fromaddr,
@@ -61,7 +61,7 @@ def reclone(*args, **kwargs):
             app_config_id=c.app.config._id))
     clone(*args, **kwargs)
 
-@task
+@task(coalesce=lambda **kwargs: dict(key='refresh'))
 def refresh(**kwargs):
     from allura import model as M
     log = logging.getLogger(__name__)
@@ -24,7 +24,7 @@
 from datetime import datetime
 
 from pylons import tmpl_context as c
-from nose.tools import assert_raises
+from nose.tools import assert_raises, assert_equal
 from nose import with_setup
 
 from ming.orm.ormsession import ThreadLocalORMSession
@@ -158,6 +158,24 @@ def test_versioning():
     assert ss.text != pg.text
     assert pg.history().count() == 3
 
+@with_setup(setUp, tearDown)
+def test_commit_many():
+    pages = [WM.Page(title='TestPage%s' % i) for i in range(3)]
+    for pg in pages:
+        pg.commit()
+    ThreadLocalORMSession.flush_all()
+    for i, pg in enumerate(pages):
+        pg.text = 'text %s' % i
+    docs = WM.Page.commit_many(pages)
+    ThreadLocalORMSession.flush_all()
+    assert_equal([d.version for d in docs], [2, 2, 2])
+    for i, pg in enumerate(pages):
+        assert pg.version == 2
+        ss = pg.get_version(2)
+        assert ss.text == 'text %s' % i
+        assert ss.author.username == c.user.username
+        assert pg.get_version(1).text != ss.text
+
 @with_setup(setUp, tearDown)
 def test_messages():
     m = Checkmessage()
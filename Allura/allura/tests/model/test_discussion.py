@@ -121,6 +121,30 @@ def test_thread_methods():
     assert len(t.find_posts()) == 0
     t.delete()
 
+@with_setup(setUp, tearDown)
+def test_thread_post_many():
+    d = M.Discussion(shortname='test', name='test')
+    t0 = M.Thread.new(discussion_id=d._id, subject='Thread 0')
+    t1 = M.Thread.new(discussion_id=d._id, subject='Thread 1')
+    posts = M.Thread.post_many([(t0, 'first'), (t1, 'second'), (t0, 'third')],
+                               notify=False)
+    assert_equal([p.text for p in posts], ['first', 'second', 'third'])
+    assert_equal([p.status for p in posts], ['ok'] * 3)
+    assert_equal([p.thread_id for p in posts], [t0._id, t1._id, t0._id])
+    assert_equal(posts[0].version, 1)
+    assert_equal(posts[0].get_version(1).text, 'first')
+    # same counts as thread.post would leave
+    assert_equal(t0.num_replies, 1)
+    assert_equal(t1.num_replies, 0)
+    assert_equal(d.num_topics, 2)
+    assert_equal(d.num_posts, 3)
+    ThreadLocalORMSession.flush_all()
+    assert_equal(t0.post_count, 2)
+    assert_equal(t1.post_count, 1)
+    when = datetime(2013, 1, 2, 3, 4, 5)
+    posts = M.Thread.post_many([(t1, 'fourth')], notify=False, timestamps=[when])
+    assert_equal(posts[0].timestamp, when)
+
 @with_setup(setUp, tearDown)
 def test_thread_new():
     with mock.patch('allura.model.discuss.h.nonce') as nonce:
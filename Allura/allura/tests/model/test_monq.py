@@ -38,3 +38,54 @@ def test_basic_task():
     assert task
     task()
     assert task.result == 'I[5, 6]', task.result
+
+@with_setup(setUp)
+def test_get_batch():
+    for i in range(5):
+        M.MonQTask.post(pprint.pformat, ([i],))
+    M.MonQTask.post(pprint.pformat, (['high'],), priority=20)
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(process='host pid 1', size=3)
+    assert len(tasks) == 3, tasks
+    assert tasks[0].args == ['high'], tasks[0].args
+    assert all(t.state == 'busy' and t.process == 'host pid 1' for t in tasks)
+    assert M.MonQTask.query.find(dict(state='ready')).count() == 3
+    # the rest go to the next worker
+    tasks = M.MonQTask.get_batch(process='host pid 2', size=10)
+    assert len(tasks) == 3, tasks
+    assert M.MonQTask.get_batch(process='host pid 2', size=10) == []
+
+@with_setup(setUp)
+def test_release():
+    for i in range(3):
+        M.MonQTask.post(pprint.pformat, ([i],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(process='host pid 1', size=3)
+    tasks[0]()
+    ThreadLocalORMSession.flush_all()
+    M.MonQTask.release('host pid 1')
+    ThreadLocalORMSession.close_all()
+    assert M.MonQTask.query.find(dict(state='ready')).count() == 2
+    assert M.MonQTask.query.find(dict(state='complete')).count() == 1
+
+@with_setup(setUp)
+def test_coalesce():
+    coalesce = dict(key='k', update={'$addToSet': {'args.0': {'$each': [2]}}})
+    task1 = M.MonQTask.post(pprint.pformat, ([1],), coalesce=coalesce)
+    task2 = M.MonQTask.post(pprint.pformat, ([2],), coalesce=coalesce)
+    assert task1._id == task2._id
+    assert M.MonQTask.query.find().count() == 1
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    task = M.MonQTask.query.get(_id=task1._id)
+    assert task.args == [[1, 2]], task.args
+    # different key, or no coalescing at all
+    M.MonQTask.post(pprint.pformat, ([3],), coalesce=dict(key='other'))
+    M.MonQTask.post(pprint.pformat, ([4],))
+    assert M.MonQTask.query.find().count() == 3
+    # busy tasks are never merged into
+    task = M.MonQTask.get()
+    task = M.MonQTask.post(pprint.pformat, ([5],), coalesce=coalesce)
+    assert M.MonQTask.query.find().count() == 4
@@ -118,6 +118,21 @@ def test_delivery(self):
         assert len(mbox.queue) == 1
         assert not mbox.queue_empty
 
+    def test_deliver_bulk(self):
+        self._subscribe()
+        user2 = M.User.query.get(username='test-user-2')
+        self._subscribe(user=user2)
+        M.Mailbox.deliver('nid1', self.pg.index_id(), 'metadata')
+        # delivering the same notification again is a no-op
+        M.Mailbox.deliver('nid1', self.pg.index_id(), 'metadata')
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        mboxes = M.Mailbox.query.find().all()
+        assert_equal(len(mboxes), 2)
+        for mbox in mboxes:
+            assert_equal(mbox.queue, ['nid1'])
+            assert not mbox.queue_empty
+
     def test_email(self):
         self._subscribe()  # as current user: test-admin
         user2 = M.User.query.get(username='test-user-2')
@@ -147,6 +162,57 @@ def test_email(self):
         assert email_tasks[0].kwargs['text'].startswith('Home modified by Test Admin')
         assert 'you indicated interest in ' in email_tasks[0].kwargs['text']
 
+    def test_fire_batched(self):
+        self._subscribe()
+        user2 = M.User.query.get(username='test-user-2')
+        self._subscribe(user=user2)
+        n = self._post_notification()
+        M.Mailbox.deliver(n._id, self.pg.index_id(), 'metadata')
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        M.Mailbox.fire_ready(batch_size=1)
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        for mbox in M.Mailbox.query.find():
+            assert mbox.queue_empty
+            assert_equal(mbox.firing_queue, [])
+            assert_equal(mbox.firing_token, None)
+        # one mailbox per batch, so one sendmail_batch task each
+        tasks = M.MonQTask.query.find(dict(
+            task_name='allura.tasks.mail_tasks.sendmail_batch')).all()
+        assert_equal(len(tasks), 2)
+        destinations = sorted(t.args[0][0]['destinations'][0] for t in tasks)
+        assert_equal(destinations, sorted([str(c.user._id), str(user2._id)]))
+
+    def test_fire_batched_stale_claim(self):
+        self._subscribe()
+        n1 = self._post_notification()
+        M.Mailbox.deliver(n1._id, self.pg.index_id(), 'metadata')
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        # the firing process dies between claiming the mailbox and firing it
+        with mock.patch.object(M.Mailbox, '_fire_batch', side_effect=SystemExit):
+            self.assertRaises(SystemExit, M.Mailbox.fire_ready, batch_size=10)
+        mbox = M.Mailbox.query.get()
+        assert_equal(mbox.firing_queue, [n1._id])
+        assert mbox.queue_empty
+        # a notification arrives meanwhile, and the claim times out
+        n2 = self._post_notification()
+        M.Mailbox.deliver(n2._id, self.pg.index_id(), 'metadata')
+        M.Mailbox.query.update(dict(_id=mbox._id), {'$set': dict(
+            firing_time=mbox.firing_time - M.notification.MAILBOX_FIRING_TIMEOUT * 2)})
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        with mock.patch.object(M.Mailbox, 'fire', autospec=True) as fire:
+            M.Mailbox.fire_ready(batch_size=10)
+        fired = [n._id for call in fire.call_args_list for n in call[1]['notifications']]
+        assert_equal(fired, [n1._id, n2._id])
+        ThreadLocalORMSession.close_all()
+        mbox = M.Mailbox.query.get()
+        assert_equal(mbox.firing_token, None)
+        assert_equal(mbox.firing_queue, [])
+        assert mbox.queue_empty
+
     def test_permissions(self):
         # Notification should only be delivered if user has read perms on the
         # artifact. The perm check happens just before the mail task is
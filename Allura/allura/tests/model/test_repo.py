@@ -55,6 +55,66 @@ def test_hex(self):
         assert_equal(hex, hex2)
 
 
+class TestRefreshPipeline(unittest.TestCase):
+
+    def setUp(self):
+        setup_basic_test()
+
+    def test_split(self):
+        assert_equal(M.repo_refresh._split(range(5), 2), [[0, 1, 2], [3, 4]])
+        assert_equal(M.repo_refresh._split(range(2), 4), [[0], [1]])
+
+    def test_bulk_save(self):
+        # docs already saved, by another refresh say, are left alone
+        M.repo.TreesDoc(dict(_id='ci1', tree_ids=['t1'])).m.save()
+        M.repo_refresh._bulk_save(M.repo.TreesDoc, [
+                M.repo.TreesDoc(dict(_id='ci2', tree_ids=['t2'])),
+                M.repo.TreesDoc(dict(_id='ci1', tree_ids=['other']))])
+        assert_equal(M.repo.TreesDoc.m.get(_id='ci1').tree_ids, ['t1'])
+        assert_equal(M.repo.TreesDoc.m.get(_id='ci2').tree_ids, ['t2'])
+        M.repo_refresh._bulk_save(M.repo.TreesDoc, [])
+
+
+class TestCommitGraph(unittest.TestCase):
+
+    def setUp(self):
+        setup_basic_test()
+        self.repo = mock.Mock(_id=ObjectId())
+        # a <- b <- d <- e, and a <- c <- d, with c's clock behind a's
+        for oid, parent_ids, hour in [
+                ('a', [], 1), ('b', ['a'], 2), ('c', ['a'], 0),
+                ('d', ['b', 'c'], 4), ('e', ['d'], 5)]:
+            M.repo.CommitDoc(dict(
+                    _id=oid,
+                    parent_ids=parent_ids,
+                    authored=dict(name='a', email='a@example.com',
+                                  date=datetime(2013, 1, 1, hour)))).m.insert()
+        M.repo_refresh.refresh_commit_graph(self.repo, ['e', 'd', 'c', 'b', 'a'])
+
+    def test_generation(self):
+        graph = M.repo.CommitGraph()
+        graph.load(['a', 'c'])
+        assert_equal(graph.nodes['c'].generation, graph.nodes['a'].generation + 1)
+
+    def test_walk(self):
+        graph = M.repo.CommitGraph(self.repo._id)
+        assert_equal(list(graph.walk(['e'])), ['e', 'd', 'b', 'c', 'a'])
+        assert_equal(list(graph.walk(['b', 'c'])), ['b', 'c', 'a'])
+
+    def test_count(self):
+        graph = M.repo.CommitGraph(self.repo._id)
+        counts = dict((oid, graph.count(oid)) for oid in 'abcde')
+        assert_equal(counts, dict(a=1, b=2, c=2, d=4, e=5))
+        assert_equal(graph.count('missing'), None)
+
+    def test_refresh_again(self):
+        other_repo_id = ObjectId()
+        M.repo_refresh.refresh_commit_graph(mock.Mock(_id=other_repo_id), ['b', 'a'])
+        assert_equal(M.repo.CommitGraphDoc.m.find().count(), 5)
+        assert_equal(M.repo.CommitGraphDoc.m.get(_id='a').repo_ids,
+                     [self.repo._id, other_repo_id])
+
+
 class RepoImplTestBase(object):
 
     def test_commit_run(self):
@@ -231,6 +291,23 @@ def test_subdir_lcd_prev_commit(self):
         self.assertEqual(lcd.by_name['file1'], commit3._id)
         self.assertEqual(lcd.by_name['file2'], commit2._id)
 
+    def test_build_many(self):
+        commit1 = self._add_commit('Commit 1', ['file1', 'dir1/file1'])
+        commit2 = self._add_commit('Commit 2', ['file1', 'dir1/file1', 'dir1/file2'], ['dir1/file2'], [commit1])
+        commit3 = self._add_commit('Commit 3', ['file1', 'dir1/file1', 'dir1/file2', 'file2'], ['file2'], [commit2])
+        lcids = self.repo.last_commit_ids
+        self.repo.last_commit_ids = mock.Mock(side_effect=lcids)
+        lcds = M.repo.LastCommit.build_many(commit3, ['', 'dir1'])
+        # one call for the trees, and one for all their entries
+        assert_equal(self.repo.last_commit_ids.call_count, 2)
+        assert_equal(sorted(lcds), ['', 'dir1'])
+        assert_equal(lcds[''].commit_id, commit3._id)
+        assert_equal(lcds[''].by_name, {
+                'file1': commit1._id, 'dir1': commit2._id, 'file2': commit3._id})
+        assert_equal(lcds['dir1'].commit_id, commit2._id)
+        assert_equal(lcds['dir1'].by_name, {
+                'file1': commit1._id, 'file2': commit2._id})
+
     def test_subdir_lcd_always_empty(self):
         commit1 = self._add_commit('Commit 1', ['file1', 'dir1'])
         commit2 = self._add_commit('Commit 2', ['file1', 'file2'], ['file2'], [commit1])
@@ -15,6 +15,10 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
+import Queue
+import tempfile
+
 from nose.tools import assert_raises, assert_in
 from datadiff.tools import assert_equal
 from ming.orm import ThreadLocalORMSession
@@ -23,7 +27,8 @@
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.command import base, script, set_neighborhood_features, \
-                           create_neighborhood, show_models, taskd_cleanup
+                           create_neighborhood, show_models, taskd_cleanup, \
+                           reindex_all
 from allura import model as M
 from forgeblog import model as BM
 from allura.lib.exceptions import InvalidNBFeatureValueError
@@ -257,6 +262,31 @@ def test_forsaken_tasks(self):
         assert task.result == '', task.result
         assert cmd.error_tasks == []
 
+    def test_unstarted_tasks(self):
+        # claimed by a dead taskd, but never started
+        task = Mock(state='busy', process='host pid 1111', result='', time_start=None)
+        self.cmd_class._busy_tasks = lambda x: [task]
+        self.cmd_class._taskd_pids = lambda x: ['2222']
+
+        cmd = self.cmd_class('taskd_command')
+        cmd.run([test_config, 'fake.log'])
+        assert task.state == 'ready', task.state
+        assert task.process is None, task.process
+        assert cmd.released_tasks == [task]
+        assert cmd.error_tasks == []
+
+        # claimed by a running taskd, waiting for a free slot
+        task = Mock(state='busy', process='host pid 2222', result='', time_start=None)
+        self.cmd_class._busy_tasks = lambda x: [task]
+        self.cmd_class._check_task = lambda x, p, t: 'FAIL'
+
+        cmd = self.cmd_class('taskd_command')
+        cmd.run([test_config, 'fake.log'])
+        # nothing should change
+        assert task.state == 'busy', task.state
+        assert cmd.suspicious_tasks == []
+        assert cmd.error_tasks == []
+
     def test_stuck_taskd(self):
         # does not stuck
         cmd = self.cmd_class('taskd_command')
@@ -276,6 +306,20 @@ def test_stuck_taskd(self):
         cmd._kill_stuck_taskd.assert_called_with('1111')
         assert cmd.stuck_pids == ['1111'], cmd.stuck_pids
 
+    @patch('allura.command.taskd_cleanup.os')
+    def test_kill_stuck_taskd(self, os):
+        started = Mock(state='busy', process='host pid 1111', result='', time_start=1)
+        unstarted = Mock(state='busy', process='host pid 1111', result='', time_start=None)
+        self.cmd_class._busy_tasks = lambda x, pid=None: [started, unstarted]
+        cmd = self.cmd_class('taskd_command')
+        cmd.error_tasks, cmd.released_tasks = [], []
+        self.old_kill_stuck_taskd(cmd, '1111')
+        assert started.state == 'error', started.state
+        assert unstarted.state == 'ready', unstarted.state
+        assert unstarted.process is None, unstarted.process
+        assert cmd.error_tasks == [started]
+        assert cmd.released_tasks == [unstarted]
+
     def test_suspicious_tasks(self):
         # task1 is lost
         task1 = Mock(state='busy', process='host pid 1111', result='', _id=1)
@@ -320,6 +364,44 @@ def test_status_log_retries():
     assert cmd._taskd_status.mock_calls == expected_calls
 
 
+class TestReindexAllCommand(object):
+
+    def setUp(self):
+        self.cmd = reindex_all.ReindexAllCommand('reindex-all')
+        self.cmd.options = Mock(chunk_size=2, refs=False,
+                checkpoint=tempfile.mktemp(prefix='reindex-all-test-'))
+
+    def tearDown(self):
+        if os.path.exists(self.cmd.options.checkpoint):
+            os.remove(self.cmd.options.checkpoint)
+
+    def test_checkpoint(self):
+        assert_equal(self.cmd._load_checkpoint(), None)
+        ranges = [dict(start=None, end='m', last=None, done=False),
+                  dict(start='m', end=None, last=None, done=False)]
+        self.cmd._save_checkpoint(ranges)
+        progress = Queue.Queue()
+        progress.put((0, 'c', False))
+        progress.put((1, 'x', True))
+        self.cmd._update_progress(ranges, progress)
+        assert_equal(self.cmd._load_checkpoint(), [
+            dict(start=None, end='m', last='c', done=False),
+            dict(start='m', end=None, last='x', done=True)])
+
+    @patch.object(reindex_all, 'add_artifacts')
+    @patch.object(reindex_all.utils, 'chunked_find')
+    def test_index_range(self, chunked_find, add_artifacts):
+        chunked_find.return_value = [[Mock(_id='d'), Mock(_id='e')], [Mock(_id='f')]]
+        progress = Queue.Queue()
+        self.cmd._index_range(1, dict(start='a', end='m', last='c', done=False), progress)
+        assert_equal(chunked_find.call_args[0][1], {'_id': {'$gt': 'c', '$lt': 'm'}})
+        assert_equal(add_artifacts.call_args_list, [
+            call(['d', 'e'], update_solr=True, update_refs=False),
+            call(['f'], update_solr=True, update_refs=False)])
+        assert_equal([progress.get_nowait() for i in range(3)],
+                     [(1, 'e', False), (1, 'f', False), (1, 'f', True)])
+
+
 class TestBackgroundCommand(object):
 
     cmd = 'allura.command.show_models.ReindexCommand'
@@ -22,8 +22,11 @@
 from allura.tests import decorators as td
 from allura.tests import TestController
 
-from allura.lib.security import Credentials, all_allowed, has_access
+from allura.lib.security import Credentials, all_allowed, has_access, has_access_many
+from allura.lib.security import filter_by_access
+from allura.lib.security import role_closure_cache
 from allura import model as M
+from allura.lib import helpers as h
 from forgewiki import model as WM
 
 
@@ -136,3 +139,57 @@ def test_weird_allow_vs_deny(self):
         assert has_access(wiki, 'post', test_user)()
         assert has_access(wiki, 'unmoderated_post', test_user)()
         assert_equal(all_allowed(wiki, test_user), set(['read', 'post', 'unmoderated_post']))
+
+    @td.with_wiki
+    def test_role_closure_cache(self):
+        wiki = c.project.app_instance('wiki')
+        project_id = c.project.root_project._id
+        member_role = M.ProjectRole.by_name('Member')
+        test_user = M.User.by_username('test-user')
+        cred = Credentials.get()
+        cred.clear()
+        assert member_role._id not in cred.reaching_ids(test_user._id, project_id)
+        assert not has_access(wiki, 'create', test_user)()
+        # a new request gets the roles from the shared cache
+        cred.clear()
+        version = cred.role_version(project_id)
+        assert_equal(role_closure_cache.get(test_user._id, project_id, version),
+                     cred.reaching_ids(test_user._id, project_id))
+        # changing a role invalidates the cached roles of its project
+        _add_to_group(test_user, member_role)
+        assert cred.role_version(project_id) != version
+        assert_equal(role_closure_cache.get(test_user._id, project_id, cred.role_version(project_id)), None)
+        assert member_role._id in cred.reaching_ids(test_user._id, project_id)
+        assert has_access(wiki, 'create', test_user)()
+
+    @td.with_wiki
+    def test_has_access_many(self):
+        wiki = c.project.app_instance('wiki')
+        with h.push_config(c, app=wiki):
+            pages = [WM.Page.upsert('page%s' % i) for i in range(3)]
+        ThreadLocalODMSession.flush_all()
+        auth_role = M.ProjectRole.by_name('*authenticated')
+        anon_role = M.ProjectRole.by_name('*anonymous')
+        test_user = M.User.by_username('test-user')
+        _deny(pages[1], auth_role, 'read')
+        _deny(pages[1], anon_role, 'read')
+        assert_equal(has_access_many(pages, 'read', test_user), [pages[0], pages[2]])
+        assert_equal(has_access_many(pages, 'create', test_user), [])
+        assert_equal(has_access_many(pages + [wiki, None], 'read', test_user),
+                     [pages[0], pages[2], wiki])
+
+    @td.with_wiki
+    def test_filter_by_access(self):
+        wiki = c.project.app_instance('wiki')
+        with h.push_config(c, app=wiki):
+            pages = [WM.Page.upsert('page%s' % i) for i in range(3)]
+            ThreadLocalODMSession.flush_all()
+            for page in pages:
+                M.ArtifactReference.from_artifact(page)
+        anon_role = M.ProjectRole.by_name('*anonymous')
+        _deny(pages[0], anon_role, 'read')
+        anon = M.User.anonymous()
+        ids = [p.index_id() for p in pages] + ['no-such-artifact']
+        assert_equal(filter_by_access(ids, user=anon), ids[1:3])
+        assert_equal(filter_by_access(pages, user=anon), pages[1:])
+        assert_equal(filter_by_access(pages, 'delete', user=anon), [])
@@ -104,6 +104,18 @@ def test_add_artifacts(self):
         a = _TestArtifact.query.get(_shorthand_id='t3')
         assert len(a.backrefs) == 5, a.backrefs
 
+    def test_add_artifacts_coalesce(self):
+        M.MonQTask.query.remove({})
+        index_tasks.add_artifacts.post(['a', 'b'])
+        index_tasks.add_artifacts.post(['b', 'c'])
+        index_tasks.add_artifacts.post(['d'], update_refs=False)
+        index_tasks.add_artifacts.post(['x%d' % i for i in range(500)])
+        tasks = M.MonQTask.query.find().sort('_id').all()
+        assert_equal(len(tasks), 3)
+        M.task_orm_session.clear()
+        task = M.MonQTask.query.get(_id=tasks[0]._id)
+        assert_equal(sorted(task.args[0]), ['a', 'b', 'c'])
+
     @td.with_wiki
     @mock.patch('allura.tasks.index_tasks.g.solr')
     def test_del_artifacts(self, solr):
@@ -118,10 +130,10 @@ def test_del_artifacts(self, solr):
         M.main_orm_session.clear()
         new_shortlinks = M.Shortlink.query.find().count()
         assert old_shortlinks + 5 == new_shortlinks, 'Shortlinks not created'
-        assert solr.add.call_count == 1
+        assert solr.add_buffered.call_count == 1
         sort_key = operator.itemgetter('id')
         assert_equal(
-                sorted(solr.add.call_args[0][0], key=sort_key),
+                sorted(solr.add_buffered.call_args[0][0], key=sort_key),
                 sorted([search.solarize(ref.artifact) for ref in arefs],
                         key=sort_key))
         index_tasks.del_artifacts(ref_ids)
@@ -130,7 +142,7 @@ def test_del_artifacts(self, solr):
         new_shortlinks = M.Shortlink.query.find().count()
         assert old_shortlinks == new_shortlinks, 'Shortlinks not deleted'
         solr_query = 'id:({0})'.format(' || '.join(ref_ids))
-        solr.delete.assert_called_once_with(q=solr_query)
+        solr.delete_buffered.assert_called_once_with(solr_query)
 
 
 class TestMailTasks(unittest.TestCase):
@@ -165,6 +177,22 @@ def test_send_email_ascii_with_user_lookup(self):
             # html
             assert_in('<div class="markdown_content"><p>This is a test</p></div>', body)
 
+    def test_sendmail_batch(self):
+        messages = [dict(
+                fromaddr=u'noreply@sf.net',
+                destinations=[addr],
+                text=u'This is a test',
+                reply_to=u'noreply@sf.net',
+                subject=u'Test subject',
+                message_id=h.gen_message_id())
+            for addr in ('bad', 'blah@blah.com', 'foo@bar.com')]
+        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+            mail_tasks.sendmail_batch(messages)
+            # the invalid address is skipped, the others are still sent
+            assert_equal(_client.sendmail.call_count, 2)
+            rcpts = [call[0][1] for call in _client.sendmail.call_args_list]
+            assert_equal(rcpts, [['blah@blah.com'], ['foo@bar.com']])
+
     def test_send_email_nonascii(self):
         with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
             mail_tasks.sendmail(
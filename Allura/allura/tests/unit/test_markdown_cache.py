@@ -0,0 +1,119 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import unittest
+
+import mock
+from nose.tools import assert_equal
+
+from allura.lib.markdown_cache import MarkdownCache, MemoryMarkdownCache, MongoMarkdownCache
+
+
+class TestMemoryMarkdownCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = MemoryMarkdownCache(max_entries=2)
+        self.md = mock.Mock(render_context=(('wiki', True),))
+        self.md.treeprocessors = {'links': mock.Mock(lookups={}, cacheable=True)}
+        self.render = mock.Mock(side_effect=lambda s: u'<p>%s</p>' % s)
+
+    @mock.patch('allura.lib.markdown_cache.c')
+    def test_convert(self, c):
+        c.project = c.app = None
+        assert_equal(self.cache.convert(self.md, 'foo', self.render), '<p>foo</p>')
+        assert_equal(self.cache.convert(self.md, 'foo', self.render), '<p>foo</p>')
+        assert_equal(self.render.call_count, 1)
+        # different context
+        self.md.render_context = ()
+        self.cache.convert(self.md, 'foo', self.render)
+        assert_equal(self.render.call_count, 2)
+
+    @mock.patch('allura.lib.markdown_cache.c')
+    def test_macros_not_cached(self, c):
+        c.project = c.app = None
+        self.cache.convert(self.md, '[[projects]]', self.render)
+        self.cache.convert(self.md, '[[projects]]', self.render)
+        assert_equal(self.render.call_count, 2)
+        assert_equal(len(self.cache._entries), 0)
+
+    def test_lru(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        assert_equal(self.cache._entries.keys(), ['a', 'c'])
+
+    @mock.patch('allura.lib.markdown_cache.time')
+    @mock.patch('allura.model.Shortlink.from_links')
+    def test_current_links(self, from_links, time):
+        time.time.return_value = 100
+        entry = dict(html='', timestamp=50, links=[
+            dict(link='[foo]', url='/p/test/wiki/foo/'),
+            dict(link='[bar]', url=None)])
+        foo = mock.Mock(url='/p/test/wiki/foo/')
+        from_links.return_value = {'[foo]': foo, '[bar]': None}
+        assert_equal(self.cache._current_links(entry), {'[foo]': foo, '[bar]': None})
+        # link target moved
+        foo.url = '/p/test/wiki/foo2/'
+        assert_equal(self.cache._current_links(entry), None)
+        # link target created
+        foo.url = '/p/test/wiki/foo/'
+        from_links.return_value['[bar]'] = mock.Mock(url='/p/test/wiki/bar/')
+        assert_equal(self.cache._current_links(entry), None)
+        # expired
+        self.cache.ttl = 10
+        assert_equal(self.cache._current_links(dict(entry, links=[])), None)
+
+    @mock.patch('allura.lib.markdown_cache.c')
+    @mock.patch('allura.model.Shortlink.from_links')
+    def test_hit_restores_links(self, from_links, c):
+        c.project = c.app = None
+        foo = mock.Mock(url='/p/test/wiki/foo/')
+        from_links.return_value = {'[foo]': foo}
+        links = self.md.treeprocessors['links']
+        def render(source):
+            links.lookups['[foo]'] = foo.url
+            return u'<p>foo</p>'
+        self.cache.convert(self.md, '[foo]', render)
+        links.lookups = {}
+        links.alinks = []
+        self.cache.convert(self.md, '[foo]', render)
+        assert_equal(links.lookups, {'[foo]': '/p/test/wiki/foo/'})
+        assert_equal(links.alinks, [foo])
+
+
+@mock.patch('allura.lib.markdown_cache.time')
+@mock.patch('allura.model.MarkdownCacheDoc')
+def test_mongo_remove_expired(MarkdownCacheDoc, time):
+    time.time.return_value = 1000
+    cache = MongoMarkdownCache(ttl=100, cleanup_interval=60)
+    cache.set('a', dict(html='', links=[], timestamp=1000))
+    assert not MarkdownCacheDoc.m.remove.called
+    time.time.return_value = 1061
+    cache.set('b', dict(html='', links=[], timestamp=1061))
+    MarkdownCacheDoc.m.remove.assert_called_once_with(dict(timestamp={'$lt': 961}))
+    cache.set('c', dict(html='', links=[], timestamp=1061))
+    assert_equal(MarkdownCacheDoc.m.remove.call_count, 1)
+
+
+def test_from_config():
+    assert_equal(MarkdownCache.from_config({}), None)
+    cache = MarkdownCache.from_config({
+        'markdown_cache.backend': 'memory',
+        'markdown_cache.max_entries': '5'})
+    assert_equal(cache.max_entries, 5)
+    assert_equal(cache.ttl, None)
@@ -15,7 +15,11 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
+import shutil
+import time
 import datetime
+import tempfile
 import unittest
 from mock import patch, Mock, MagicMock, call
 from nose.tools import assert_equal
@@ -24,7 +28,7 @@
 
 from allura import model as M
 from allura.controllers.repository import topo_sort
-from allura.model.repository import zipdir
+from allura.model.repository import zipdir, TarballCache
 from alluratest.controller import setup_unit_test
 
 class TestCommitRunBuilder(unittest.TestCase):
@@ -73,6 +77,23 @@ def test_reversed(self):
             crb.cleanup()
         self.assertEqual(M.repo.CommitRunDoc.m.count(), 1)
 
+    def test_fill_gap(self):
+        for ci in self.commits:
+            if ci._id == '5': continue
+            crb = M.repo_refresh.CommitRunBuilder([ci._id])
+            crb.run()
+            crb.cleanup()
+        self.assertEqual(M.repo.CommitRunDoc.m.count(), 2)
+        head_first = [ci._id for ci in reversed(self.commits)]
+        missing = M.repo_refresh.commits_without_runs(head_first)
+        self.assertEqual(missing, ['5'])
+        crb = M.repo_refresh.CommitRunBuilder(missing)
+        crb.run()
+        crb.cleanup()
+        runs = M.repo.CommitRunDoc.m.find().all()
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(runs[0].commit_ids, head_first)
+
 class TestTopoSort(unittest.TestCase):
     def test_commit_dates_out_of_order(self):
         """Commits should be sorted by their parent/child relationships,
@@ -300,3 +321,66 @@ def test_zipdir(tg, popen):
     src = '/fake/path/to/repo/'
     zipdir(src, zipfile, exclude='file.txt')
     popen.assert_called_once_with(['/bin/zip', '-r', zipfile, 'repo', '-x', 'file.txt'], cwd='/fake/path/to')
+
+
+class TestTarballCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = TarballCache(os.path.join(self.dir, 'repo'), 'snapshot',
+                                  timeout=5, poll_interval=0.01, chunk_size=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_build(self):
+        assert self.cache.build(iter(['ab', 'cd']))
+        assert_equal(open(self.cache.filename).read(), 'abcd')
+        assert not os.path.exists(self.cache.tmpfilename)
+        assert not self.cache.build(iter(['xx']))
+        assert_equal(open(self.cache.filename).read(), 'abcd')
+
+    def test_build_fails(self):
+        def chunks():
+            yield 'ab'
+            raise IOError('boom')
+        self.assertRaises(IOError, self.cache.build, chunks())
+        assert not os.path.exists(self.cache.filename)
+        assert not os.path.exists(self.cache.tmpfilename)
+
+    def test_stream(self):
+        assert_equal(''.join(self.cache.stream(iter(['ab', 'cd']))), 'abcd')
+        assert_equal(open(self.cache.filename).read(), 'abcd')
+        chunks = Mock()
+        assert_equal(''.join(self.cache.stream(chunks)), 'abcd')
+        assert not chunks.method_calls
+
+    def test_stream_follows_build(self):
+        os.makedirs(os.path.dirname(self.cache.filename))
+        with open(self.cache.tmpfilename, 'wb') as fp:
+            fp.write('ab')
+        stream = self.cache.stream(iter(['xx']))
+        assert_equal(stream.next(), 'ab')
+        with open(self.cache.tmpfilename, 'ab') as fp:
+            fp.write('cd')
+        os.rename(self.cache.tmpfilename, self.cache.filename)
+        assert_equal(''.join(stream), 'cd')
+
+    def test_stream_stale_build(self):
+        os.makedirs(os.path.dirname(self.cache.filename))
+        with open(self.cache.tmpfilename, 'wb') as fp:
+            fp.write('ab')
+        os.utime(self.cache.tmpfilename, (0, 0))
+        assert_equal(''.join(self.cache.stream(iter(['cd']))), 'cd')
+        assert_equal(open(self.cache.filename).read(), 'cd')
+
+    def test_slow_build_not_stale(self):
+        self.cache.timeout = 0.3
+        def chunks():
+            yield 'ab'
+            # nothing written for longer than timeout, but the builder is alive
+            time.sleep(0.5)
+            assert not self.cache._stale()
+            yield 'cd'
+        assert self.cache.build(chunks())
+        assert_equal(open(self.cache.filename).read(), 'abcd')
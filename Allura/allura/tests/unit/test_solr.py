@@ -25,7 +25,7 @@
 from allura.tests import decorators as td
 from alluratest.controller import setup_basic_test
 from allura.lib.solr import Solr
-from allura.lib.search import solarize, search_app
+from allura.lib.search import solarize, solarize_with_shortlinks, search_app, pooled_markdown
 
 class TestSolr(unittest.TestCase):
 
@@ -89,6 +89,82 @@ def test_search(self, pysolr):
         solr.search('bar', kw='kw')
         solr.query_server.search.assert_called_once_with('bar', kw='kw')
 
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_add_buffered(self, pysolr):
+        solr = Solr(['server1'], commit=False, commitWithin='10000', buffer_size=3)
+        solr.add_buffered([{'id': 'a', 'v': 1}, {'id': 'b'}])
+        assert_equal(pysolr.Solr().add.call_count, 0)
+        solr.add_buffered([{'id': 'a', 'v': 2}])
+        pysolr.Solr().add.assert_called_once_with(
+            [{'id': 'b'}, {'id': 'a', 'v': 2}], commit=False, commitWithin='10000')
+        pysolr.reset_mock()
+        solr.flush()
+        assert_equal(pysolr.Solr().add.call_count, 0)
+
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_flush_keeps_order(self, pysolr):
+        solr = Solr(['server1'], commit=False, buffer_size=100)
+        solr.add_buffered([{'id': 'a'}])
+        solr.delete_buffered('id:a')
+        solr.delete_buffered('id:b')
+        solr.add_buffered([{'id': 'b'}])
+        solr.flush()
+        assert_equal(pysolr.Solr().mock_calls, [
+            mock.call.add([{'id': 'a'}], commit=False),
+            mock.call.delete(q='(id:a) || (id:b)', commit=False),
+            mock.call.add([{'id': 'b'}], commit=False),
+        ])
+
+    @mock.patch('allura.lib.solr.time')
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_flush_timeout(self, pysolr, time):
+        solr = Solr(['server1'], commit=False, buffer_size=100, buffer_timeout=5)
+        time.time.return_value = 100
+        solr.add_buffered([{'id': 'a'}])
+        assert not solr.flush_due()
+        time.time.return_value = 105
+        assert solr.flush_due()
+        solr.add_buffered([{'id': 'b'}])
+        pysolr.Solr().add.assert_called_once_with([{'id': 'a'}, {'id': 'b'}], commit=False)
+        assert not solr.flush_due()
+
+    @mock.patch('allura.lib.solr.log')
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_buffer_max(self, pysolr, log):
+        solr = Solr(['server1'], commit=False, buffer_size=2, buffer_max=3)
+        pysolr.Solr().add.side_effect = Exception('solr is down')
+        self.assertRaises(Exception, solr.add_buffered, [{'id': 'a'}, {'id': 'b'}])
+        self.assertRaises(Exception, solr.add_buffered, [{'id': 'c'}])
+        assert solr.flush_due()
+        solr.delete_buffered('id:d')
+        # solr's down; don't keep piling up updates
+        assert not solr.flush_due()
+        assert_equal(log.error.call_args[0][1:], (4, ['a', 'b', 'c'], ['id:d']))
+        pysolr.Solr().add.side_effect = None
+        solr.add_buffered([{'id': 'e'}])
+        solr.flush()
+        pysolr.Solr().add.assert_called_with([{'id': 'e'}], commit=False)
+
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_no_auto_flush(self, pysolr):
+        solr = Solr(['server1'], commit=False, buffer_size=1, auto_flush=False)
+        solr.add_buffered([{'id': 'a'}])
+        assert_equal(pysolr.Solr().add.call_count, 0)
+        assert solr.flush_due()
+        solr.flush()
+        pysolr.Solr().add.assert_called_once_with([{'id': 'a'}], commit=False)
+
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_flush_failure_keeps_buffer(self, pysolr):
+        solr = Solr(['server1'], commit=False, buffer_size=100)
+        solr.add_buffered([{'id': 'a'}])
+        pysolr.Solr().add.side_effect = Exception('solr is down')
+        self.assertRaises(Exception, solr.flush)
+        pysolr.Solr().add.side_effect = None
+        pysolr.reset_mock()
+        solr.flush()
+        pysolr.Solr().add.assert_called_once_with([{'id': 'a'}], commit=False)
+
 
 class TestSolarize(unittest.TestCase):
 
@@ -118,6 +194,21 @@ def test_html_in_text(self):
         obj.index.return_value = {'text': '&lt;script&gt;alert(1)&lt;/script&gt;'}
         assert_equal(solarize(obj), {'text': '<script>alert(1)</script>'})
 
+    def test_with_shortlinks(self):
+        obj = mock.MagicMock()
+        obj.index.return_value = {'text': '# Header [foo]'}
+        assert_equal(solarize_with_shortlinks(obj), ({'text': 'Header [foo]'}, []))
+        assert_equal(solarize_with_shortlinks(None), (None, []))
+
+    def test_markdown_pool(self):
+        with pooled_markdown() as md1:
+            pass
+        with pooled_markdown() as md2:
+            with pooled_markdown() as md3:
+                pass
+        assert md1 is md2
+        assert md1 is not md3
+
 
 class TestSearch_app(unittest.TestCase):
 
@@ -148,6 +239,29 @@ def test_basic(self, req, url_fn):
         ))
 
     @td.with_wiki
+    @mock.patch('allura.lib.search.filter_by_access')
+    @mock.patch('allura.lib.search.g.solr.search')
+    @mock.patch('allura.lib.search.url')
+    @mock.patch('allura.lib.search.request')
+    def test_filter_by_access(self, req, url_fn, solr_search, filter_by_access):
+        req.GET = dict()
+        req.path = '/test/wiki/search'
+        url_fn.side_effect = ['the-score-url', 'the-date-url']
+        results = mock.Mock(hits=2, docs=[
+                {'id': 'a', 'type_s': 'WikiPage'},
+                {'id': 'b', 'type_s': 'WikiPage'},
+            ], highlighting={})
+        results.__iter__ = lambda self: iter(results.docs)
+        solr_search.return_value = results
+        filter_by_access.return_value = ['b']
+        with h.push_context('test', 'wiki', neighborhood='Projects'):
+            resp = search_app(q='foo bar')
+        filter_by_access.assert_called_once_with(['a', 'b'])
+        assert_equal([doc['id'] for doc in resp['results']], ['b'])
+        assert_equal(resp['count'], 2)
+
+    @td.with_wiki
+    @mock.patch('allura.lib.search.filter_by_access', lambda ids: ids)
     @mock.patch('allura.lib.search.g.solr.search')
     @mock.patch('allura.lib.search.url')
     @mock.patch('allura.lib.search.request')
@@ -131,6 +131,7 @@
     task = allura.command.taskd:TaskCommand
     models = allura.command:ShowModelsCommand
     reindex = allura.command:ReindexCommand
+    reindex-all = allura.command.reindex_all:ReindexAllCommand
     ensure_index = allura.command:EnsureIndexCommand
     script = allura.command:ScriptCommand
     set-tool-access = allura.command:SetToolAccessCommand
@@ -27,7 +27,7 @@
 from formencode import validators
 from webob import exc
 
-from allura.lib.security import require_access, has_access, require_authenticated
+from allura.lib.security import require_access, has_access, has_access_many, require_authenticated
 from allura.lib.search import search_app
 from allura.lib import helpers as h
 from allura.lib.utils import AntiSpam
@@ -74,7 +74,7 @@ def index(self, new_forum=False, **kw):
         forums = model.Forum.query.find(dict(
                         app_config_id=c.app.config._id,
                         parent_id=None, deleted=False)).all()
-        forums = [f for f in forums if h.has_access(f, 'read')()]
+        forums = has_access_many(forums, 'read')
         return dict(forums=forums,
                     announcements=announcements,
                     hide_forum=(not new_forum))
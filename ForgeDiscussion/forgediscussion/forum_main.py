@@ -34,7 +34,7 @@
 from allura.app import Application, ConfigOption, SitemapEntry, DefaultAdminController
 from allura.lib import helpers as h
 from allura.lib.decorators import require_post
-from allura.lib.security import require_access, has_access
+from allura.lib.security import require_access, has_access, has_access_many
 
 # Local imports
 from forgediscussion import model as DM
@@ -146,12 +146,11 @@ def sidebar_menu(self):
             forums = DM.Forum.query.find(dict(
                             app_config_id=c.app.config._id,
                             parent_id=None, deleted=False))
-            for f in forums:
-                if has_access(f,'read')():
-                    if f.url() in request.url and h.has_access(f, 'moderate')():
-                        moderate_link = SitemapEntry('Moderate', "%smoderate/" % f.url(), ui_icon=g.icons['pencil'],
-                        small = DM.ForumPost.query.find({'discussion_id':f._id, 'status':{'$ne': 'ok'}}).count())
-                    forum_links.append(SitemapEntry(f.name, f.url(), small=f.num_topics))
+            for f in has_access_many(forums, 'read'):
+                if f.url() in request.url and h.has_access(f, 'moderate')():
+                    moderate_link = SitemapEntry('Moderate', "%smoderate/" % f.url(), ui_icon=g.icons['pencil'],
+                    small = DM.ForumPost.query.find({'discussion_id':f._id, 'status':{'$ne': 'ok'}}).count())
+                forum_links.append(SitemapEntry(f.name, f.url(), small=f.num_topics))
             url = c.app.url + 'create_topic/'
             url = h.urlquote(url + c.forum.shortname if getattr(c, 'forum', None) and c.forum else url)
             l.append(SitemapEntry('Create Topic', url, ui_icon=g.icons['plus']))
@@ -16,6 +16,7 @@
 #       under the License.
 
 import os
+import re
 import sys
 import shutil
 import string
@@ -25,6 +26,7 @@
 from collections import namedtuple
 from datetime import datetime
 from glob import glob
+from subprocess import Popen, PIPE
 import gzip
 
 import tg
@@ -33,7 +35,7 @@
 from pylons import app_globals as g
 from pylons import tmpl_context as c
 from pymongo.errors import DuplicateKeyError
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 from ming.base import Object
 from ming.orm import Mapper, session, mapper
@@ -41,11 +43,14 @@
 
 from allura.lib import helpers as h
 from allura.lib import utils
-from allura.model.repository import topological_sort
+from allura.model.repository import topological_sort, stream_command
 from allura import model as M
 
 log = logging.getLogger(__name__)
 
+# "Name <email> timestamp tz" in commit author and committer headers
+ACTOR_RE = re.compile(r'^(.*)<(.*)> (\d+) [+-]?\d+$')
+
 gitdb.util.mman = gitdb.util.mman.__class__(
     max_open_handles=128)
 
@@ -247,6 +252,100 @@ def refresh_commit_info(self, oid, seen, lazy=True):
         self.refresh_tree_info(ci.tree, seen, lazy)
         return True
 
+    def refresh_commits_info(self, commit_ids, seen, lazy=True):
+        '''Refresh many commits at once, reading the commit and tree objects
+        from git's persistent cat-file --batch process rather than through
+        GitPython objects, and saving the docs in bulk.'''
+        from allura.model.repo import CommitDoc, TreeDoc
+        commit_ids = list(commit_ids)
+        known = set(ci._id for ci in CommitDoc.m.find(
+                dict(_id={'$in': commit_ids})))
+        if lazy:
+            commit_ids = [oid for oid in commit_ids if oid not in known]
+        new_docs, updated_docs, tree_docs = [], [], {}
+        for oid in commit_ids:
+            hexsha, type_name, size, data = self._git.git.get_object_data(oid)
+            doc = self._parse_commit(data)
+            if oid in known:
+                updated_docs.append((oid, doc))
+            else:
+                doc['_id'] = oid
+                new_docs.append(doc)
+            self._read_trees(doc['tree_id'], seen, lazy, tree_docs)
+        for oid, doc in updated_docs:
+            CommitDoc.m.update_partial(dict(_id=oid), {'$set': doc})
+        if new_docs:
+            try:
+                _collection(CommitDoc).insert(
+                    [CommitDoc.make(d) for d in new_docs],
+                    safe=True, continue_on_error=True)
+            except DuplicateKeyError:
+                # another refresh got to some of them first
+                pass
+        if tree_docs:
+            # trees are content-addressed, and shared with forks: never
+            # replace one that is already saved
+            try:
+                _collection(TreeDoc).insert(
+                    [TreeDoc.make(d) for d in tree_docs.itervalues()],
+                    safe=True, continue_on_error=True)
+            except DuplicateKeyError:
+                # another refresh got to some of them first
+                pass
+        return len(commit_ids)
+
+    def _parse_commit(self, data):
+        '''Build the CommitDoc fields from a raw git commit object'''
+        headers, _, message = data.partition('\n\n')
+        doc = dict(parent_ids=[], child_ids=[],
+                   message=h.really_unicode(message))
+        for line in headers.split('\n'):
+            if line.startswith(' '):
+                continue  # continuation of a multi-line header, e.g. gpgsig
+            key, _, value = line.partition(' ')
+            if key == 'tree':
+                doc['tree_id'] = value
+            elif key == 'parent':
+                doc['parent_ids'].append(value)
+            elif key == 'author':
+                doc['authored'] = self._parse_actor(value)
+            elif key == 'committer':
+                doc['committed'] = self._parse_actor(value)
+        return doc
+
+    def _parse_actor(self, value):
+        m = ACTOR_RE.match(value)
+        if m is None:
+            return Object(name=h.really_unicode(value), email=u'',
+                          date=datetime.utcfromtimestamp(0))
+        name, email, timestamp = m.groups()
+        return Object(
+            name=h.really_unicode(name.strip()),
+            email=h.really_unicode(email),
+            date=datetime.utcfromtimestamp(int(timestamp)))
+
+    def _read_trees(self, tree_id, seen, lazy, docs):
+        '''Read tree_id and its subtrees into docs (tree_id -> TreeDoc
+        fields), skipping trees already in seen if lazy'''
+        to_visit = [tree_id]
+        while to_visit:
+            tree_id = to_visit.pop()
+            binsha = tree_id.decode('hex')
+            if tree_id in docs or (lazy and binsha in seen): continue
+            seen.add(binsha)
+            doc = docs[tree_id] = dict(
+                _id=tree_id, tree_ids=[], blob_ids=[], other_ids=[])
+            hexsha, type_name, size, data = self._git.git.get_object_data(tree_id)
+            for mode, name, oid in _tree_entries(data):
+                if mode == '160000':
+                    continue  # submodule
+                obj = Object(name=h.really_unicode(name), id=oid)
+                if mode == '40000':
+                    to_visit.append(oid)
+                    doc['tree_ids'].append(obj)
+                else:
+                    doc['blob_ids'].append(obj)
+
     def refresh_tree_info(self, tree, seen, lazy=True):
         from allura.model.repo import TreeDoc
         if lazy and tree.binsha in seen: return
@@ -322,6 +421,50 @@ def _setup_hooks(self, source_path=None):
             fp.write(text)
         os.chmod(fn, 0755)
 
+    def last_commit_ids(self, commit, paths):
+        '''
+        Return a mapping {path: commit_id} of the _id of the last
+        commit to touch each path, starting from the given commit.
+
+        The first-parent history is read from a single git log, which is
+        stopped as soon as every path has been found.  Paths not found
+        within scm.git.last_commit_ids.max_depth commits, or if git fails,
+        are left to the generic walk through the commits' diffs.
+        '''
+        todo = set(path.strip('/') for path in paths)
+        result = {}
+        max_depth = asint(tg.config.get('scm.git.last_commit_ids.max_depth', 1000))
+        proc = Popen(
+            ['git', 'log', '--first-parent', '-m', '--name-only', '-z',
+             '--format=%x01%H', '--max-count=%d' % max_depth, commit._id, '--'],
+            cwd=self._repo.full_fs_path, stdout=PIPE)
+        try:
+            depth = 0
+            for ci_id, changed in _log_paths(proc.stdout):
+                depth += 1
+                for path in changed:
+                    # the path and all the directories above it were changed
+                    while True:
+                        if path in todo:
+                            result[path] = ci_id
+                            todo.discard(path)
+                        if not path: break
+                        path = os.path.dirname(path)
+                if not todo: break
+            else:
+                if proc.wait() == 0 and 0 < depth < max_depth:
+                    # reached the first commit; like the generic walk, give
+                    # it any paths that are left
+                    result.update((path, ci_id) for path in todo)
+                    todo = set()
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        if todo:
+            result.update(super(GitImplementation, self).last_commit_ids(commit, todo))
+        return result
+
     def _object(self, oid):
         evens = oid[::2]
         odds = oid[1::2]
@@ -344,24 +487,52 @@ def compute_tree_new(self, commit, tree_path='/'):
         tree = self.refresh_tree_info(ci.tree, set())
         return tree._id
 
-    def tarball(self, commit, path=None):
-        if not os.path.exists(self._repo.tarball_path):
-            os.makedirs(self._repo.tarball_path)
+    def archive(self, commit, path=None):
         archive_name = self._repo.tarball_filename(commit)
-        filename = os.path.join(self._repo.tarball_path, '%s%s' % (archive_name, '.zip'))
-        tmpfilename = os.path.join(self._repo.tarball_path, '%s%s' % (archive_name, '.tmp'))
-        try:
-            with open(tmpfilename, 'wb') as archive_file:
-                self._git.archive(archive_file, format='zip', treeish=commit, prefix=archive_name + '/')
-            os.rename(tmpfilename, filename)
-        finally:
-            if os.path.exists(tmpfilename):
-                os.remove(tmpfilename)
+        return stream_command(
+            ['git', 'archive', '--format=zip', '--prefix=%s/' % archive_name, commit],
+            cwd=self._repo.full_fs_path)
 
     def is_empty(self):
         return not self._git or len(self._git.heads) == 0
 
 
+def _log_paths(stream, chunk_size=4096):
+    '''Parse the output of git log -z --name-only --format=%x01%H into
+    (commit_id, [path, ...]) pairs, as it's read'''
+    buf = ''
+    commit_id, paths = None, []
+    while True:
+        data = stream.read(chunk_size)
+        tokens = (buf + data).split('\0')
+        buf = tokens.pop() if data else ''
+        for token in tokens:
+            token = token.lstrip('\n')
+            if token.startswith('\x01'):
+                if commit_id is not None:
+                    yield commit_id, paths
+                commit_id, paths = token[1:], []
+            elif token:
+                paths.append(h.really_unicode(token))
+        if not data: break
+    if commit_id is not None:
+        yield commit_id, paths
+
+
+def _tree_entries(data):
+    '''Yield (mode, name, hexsha) for each entry of a raw git tree object'''
+    i = 0
+    while i < len(data):
+        sp = data.index(' ', i)
+        nul = data.index('\0', sp)
+        yield data[i:sp], data[sp+1:nul], data[nul+1:nul+21].encode('hex')
+        i = nul + 21
+
+
+def _collection(doc_cls):
+    return doc_cls.m.session.db[doc_cls.m.collection_name]
+
+
 class _OpenedGitBlob(object):
     CHUNK_SIZE=4096
 
@@ -347,6 +347,17 @@ def test_tarball(self):
         r = self.app.get('/p/test/src-git/ci/master/tarball_status')
         assert '{"status": "ready"}' in r
 
+    def test_tarball_stream(self):
+        ci = self._get_ci()
+        with h.push_config(tg.config, **{'scm.repos.tarball.stream': 'true'}):
+            r = self.app.get(ci + 'tree/')
+            assert '/p/test/src-git/ci/master/tarball_stream' in r
+            r = self.app.get('/p/test/src-git/ci/master/tarball')
+            assert r.location.endswith('/p/test/src-git/ci/master/tarball_stream'), r.location
+            r = self.app.get('/p/test/src-git/ci/master/tarball_stream')
+            assert_equal(r.content_type, 'application/zip')
+        self.app.get('/p/test/src-git/ci/master/tarball_stream', status=404)
+
     def test_tarball_link_in_subdirs(self):
         '''Go to repo subdir and check 'Download Snapshot' link'''
         self.setup_testgit_index_repo()
@@ -230,6 +230,42 @@ def test_log(self):
             assert str(entry.authored)
             assert entry.message
 
+    def test_last_commit_ids(self):
+        ci = self.repo.commit('HEAD')
+        assert_equal(self.repo.last_commit_ids(ci, ['README']), {'README': ci._id})
+        ci = self.repo.commit('6a45885ae7347f1cac5103b0050cc1be6a1496c8')
+        assert_equal(self.repo.last_commit_ids(ci, ['/a/b/c/', 'a']), {
+                'a/b/c': '6a45885ae7347f1cac5103b0050cc1be6a1496c8',
+                'a': '6a45885ae7347f1cac5103b0050cc1be6a1496c8'})
+
+    def test_last_commit_ids_max_depth(self):
+        ci = self.repo.commit('HEAD')
+        with h.push_config(tg.config, **{'scm.git.last_commit_ids.max_depth': '1'}):
+            with mock.patch.object(M.RepositoryImplementation, 'last_commit_ids') as lcids:
+                lcids.return_value = {'a': 'deadbeef'}
+                result = self.repo.last_commit_ids(ci, ['README', 'a'])
+        lcids.assert_called_once_with(ci, set(['a']))
+        assert_equal(result, {'README': ci._id, 'a': 'deadbeef'})
+
+    def test_refresh_commits_info(self):
+        ci_ids = list(self.repo.all_commit_ids())
+        def docs(doc_cls):
+            return dict((d._id, dict(d)) for d in doc_cls.m.find())
+        # one commit at a time, through GitPython
+        M.repo.CommitDoc.m.remove({})
+        M.repo.TreeDoc.m.remove({})
+        for oid in ci_ids:
+            self.repo._impl.refresh_commit_info(oid, set(), False)
+        commits, trees = docs(M.repo.CommitDoc), docs(M.repo.TreeDoc)
+        # in bulk, through cat-file --batch
+        M.repo.CommitDoc.m.remove({})
+        M.repo.TreeDoc.m.remove({})
+        assert_equal(self.repo.refresh_commits_info(ci_ids, set(), True), len(ci_ids))
+        assert_equal(docs(M.repo.CommitDoc), commits)
+        assert_equal(docs(M.repo.TreeDoc), trees)
+        # lazy refresh skips commits that are already known
+        assert_equal(self.repo.refresh_commits_info(ci_ids, set(), True), 0)
+
     def test_commit(self):
         entry = self.repo.commit('HEAD')
         assert str(entry.authored.name) == 'Rick Copeland', entry.authored
@@ -24,10 +24,13 @@
 import subprocess
 from subprocess import Popen, PIPE
 from hashlib import sha1
+from collections import defaultdict
 from cStringIO import StringIO
 from datetime import datetime
+from urllib import quote
 import tempfile
 from shutil import rmtree
+from xml.etree import cElementTree as ET
 
 import tg
 import pysvn
@@ -42,7 +45,7 @@
 from allura import model as M
 from allura.lib import helpers as h
 from allura.model.auth import User
-from allura.model.repository import zipdir
+from allura.model.repository import zipdir_stream
 
 log = logging.getLogger(__name__)
 
@@ -439,6 +442,115 @@ def refresh_commit_info(self, oid, seen_object_ids, lazy=True):
         di.m.save()
         return True
 
+    def refresh_commits_info(self, commit_ids, seen, lazy=True):
+        '''Refresh many revisions at once, reading them from one svn log -v
+        --xml run per range of revisions instead of a log and an info2 per
+        changed path per revision, and saving the docs in bulk.  Revisions
+        the log doesn't fully describe are refreshed one at a time.'''
+        from allura.model.repo import CommitDoc, DiffInfoDoc
+        commit_ids = list(commit_ids)
+        known = set(ci._id for ci in CommitDoc.m.find(
+                dict(_id={'$in': commit_ids})))
+        if lazy:
+            commit_ids = [oid for oid in commit_ids if oid not in known]
+        entries = {}
+        for first, last in _ranges(sorted(self._revno(oid) for oid in commit_ids)):
+            try:
+                for entry in self._log_xml(first, last):
+                    entries[entry['revno']] = entry
+            except (OSError, SyntaxError, SVNCalledProcessError):
+                log.warning('Error reading svn log -r%s:%s of %r, refreshing '
+                            'those revisions one at a time',
+                            first, last, self._repo, exc_info=True)
+        new_docs, diff_docs, fallback = [], [], []
+        for oid in commit_ids:
+            entry = entries.get(self._revno(oid))
+            if entry is None or not all(p['kind'] in ('file', 'dir')
+                                        for p in entry['paths']):
+                # older servers don't report the kinds of changed paths
+                fallback.append(oid)
+                continue
+            doc = self._commit_doc(oid, entry)
+            if oid in known:
+                CommitDoc.m.update_partial(dict(_id=oid), {'$set': doc})
+            else:
+                new_docs.append(dict(doc, _id=oid))
+            diff_docs.append(self._diff_info_doc(oid, entry))
+        if new_docs:
+            try:
+                _collection(CommitDoc).insert(
+                    [CommitDoc.make(d) for d in new_docs],
+                    safe=True, continue_on_error=True)
+            except DuplicateKeyError:
+                # another refresh got to some of them first
+                pass
+        if diff_docs:
+            try:
+                _collection(DiffInfoDoc).insert(
+                    [DiffInfoDoc.make(d) for d in diff_docs],
+                    safe=True, continue_on_error=True)
+            except DuplicateKeyError:
+                # another refresh got to some of them first
+                pass
+        for oid in fallback:
+            self.refresh_commit_info(oid, seen, lazy)
+        return len(commit_ids)
+
+    def _log_xml(self, first, last):
+        '''Yield the log entries of revisions first through last, parsed from
+        svn log -v --xml as it's read'''
+        cmd = ['svn', 'log', '-v', '--xml', '--non-interactive',
+               '-r', '%d:%d' % (first, last), self._url]
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        try:
+            for entry in _parse_log_xml(p.stdout):
+                yield entry
+        finally:
+            p.stdout.close()
+            stderr = p.stderr.read()
+            if p.wait() != 0:
+                raise SVNCalledProcessError(cmd, p.returncode, None, stderr)
+
+    def _commit_doc(self, oid, entry):
+        '''The CommitDoc fields for a revision, as refresh_commit_info would
+        set them'''
+        user = Object(
+            name=h.really_unicode(entry['author'] or '--none--'),
+            email='',
+            date=entry['date'])
+        doc = dict(
+            tree_id=None,
+            committed=user,
+            authored=user,
+            message=h.really_unicode(entry['message'] if entry['message'] is not None else '--none--'),
+            parent_ids=[],
+            child_ids=[])
+        if entry['revno'] > 1:
+            doc['parent_ids'] = [ self._oid(entry['revno'] - 1) ]
+        return doc
+
+    def _diff_info_doc(self, oid, entry):
+        '''The DiffInfoDoc for a revision, with the ids refresh_commit_info
+        would get from info2 made from the changed paths' kinds instead'''
+        differences = []
+        for path in entry['paths']:
+            # info2 reports the (escaped) url the ids are made from
+            url_path = quote(path['path'].encode('utf-8'), safe="/!$&'()*+,;=:@~")
+            if path['kind'] == 'dir':
+                obj_id = self._tree_oid(oid, url_path)
+            else:
+                obj_id = self._blob_oid(oid, url_path)
+            rhs_id = lhs_id = None
+            if path['action'] in ('A', 'M', 'R'):
+                rhs_id = obj_id
+            if entry['revno'] > 1 and path['action'] in ('D', 'M', 'R'):
+                lhs_id = obj_id
+            differences.append(dict(
+                    name=path['path'],
+                    lhs_id=lhs_id,
+                    rhs_id=rhs_id))
+        return dict(_id=oid, differences=differences)
+
     def compute_tree_new(self, commit, tree_path='/'):
         from allura.model import repo as RM
         tree_path = '/' + tree_path.strip('/')  # always leading slash, never trailing
@@ -617,33 +729,31 @@ def last_commit_ids(self, commit, paths):
         commit to touch each path, starting from the given commit.
 
         Since SVN Diffs are computed on-demand, we can't walk the
-        commit tree to find these.  However, we can ask SVN for it
-        with a single call, so it shouldn't be too expensive.
-
-        NB: This assumes that all paths are direct children of a
-        single common parent path (i.e., you are only asking for
-        a subset of the nodes of a single tree, one level deep).
+        commit tree to find these.  However, we can ask SVN for the
+        nodes of each tree with a single call, so it shouldn't be too
+        expensive.
         '''
-        if len(paths) == 1:
-            tree_path = '/' + os.path.dirname(paths[0].strip('/'))
-        else:
-            tree_path = '/' + os.path.commonprefix(paths).strip('/')  # always leading slash, never trailing
-        paths = [path.strip('/') for path in paths]
+        by_tree = defaultdict(set)
+        for path in paths:
+            path = path.strip('/')
+            # always leading slash, never trailing
+            by_tree['/' + os.path.dirname(path)].add(path)
         rev = self._revision(commit._id)
-        try:
-            infos = self._svn.info2(
-                self._url + tree_path,
-                revision=rev,
-                depth=pysvn.depth.immediates)
-        except pysvn.ClientError:
-            log.exception('Error computing tree for: %s: %s(%s)',
-                          self._repo, commit, tree_path)
-            return None
         entries = {}
-        for path, info in infos[1:]:
-            path = os.path.join(tree_path, path).strip('/')
-            if path in paths:
-                entries[path] = self._oid(info.last_changed_rev.number)
+        for tree_path, tree_paths in by_tree.iteritems():
+            try:
+                infos = self._svn.info2(
+                    self._url + tree_path,
+                    revision=rev,
+                    depth=pysvn.depth.immediates)
+            except pysvn.ClientError:
+                log.exception('Error computing tree for: %s: %s(%s)',
+                              self._repo, commit, tree_path)
+                return None
+            for path, info in infos[1:]:
+                path = os.path.join(tree_path, path).strip('/')
+                if path in tree_paths:
+                    entries[path] = self._oid(info.last_changed_rev.number)
         return entries
 
     def _path_to_root(self, path, rev=None):
@@ -667,26 +777,19 @@ def _path_to_root(self, path, rev=None):
             return 'trunk'
         return ''
 
-    def tarball(self, commit, path=None):
+    def archive(self, commit, path=None):
         path = self._path_to_root(path, commit)
-        if not os.path.exists(self._repo.tarball_path):
-            os.makedirs(self._repo.tarball_path)
         archive_name = self._repo.tarball_filename(commit, path)
-        dest = os.path.join(self._repo.tarball_path, archive_name)
-        filename = os.path.join(self._repo.tarball_path, '%s%s' % (archive_name, '.zip'))
-        tmpfilename = os.path.join(self._repo.tarball_path, '%s%s' % (archive_name, '.tmp'))
-        rmtree(dest, ignore_errors=True)
-        path = os.path.join(self._url, path)
+        exportdir = tempfile.mkdtemp(prefix='svn-archive-')
         try:
-            self._svn.export(path,
+            dest = os.path.join(exportdir, archive_name)
+            self._svn.export(os.path.join(self._url, path),
                              dest,
                              revision=pysvn.Revision(pysvn.opt_revision_kind.number, commit))
-            zipdir(dest, tmpfilename)
-            os.rename(tmpfilename, filename)
+            for chunk in zipdir_stream(dest):
+                yield chunk
         finally:
-            rmtree(dest, ignore_errors=True)
-            if os.path.exists(tmpfilename):
-                os.remove(tmpfilename)
+            rmtree(exportdir, ignore_errors=True)
 
     def is_empty(self):
         try:
@@ -699,4 +802,43 @@ def is_empty(self):
                 raise
 
 
+
+def _ranges(revnos):
+    '''Split sorted revision numbers into (first, last) runs of consecutive
+    numbers'''
+    ranges = []
+    for revno in revnos:
+        if ranges and ranges[-1][1] == revno - 1:
+            ranges[-1][1] = revno
+        else:
+            ranges.append([revno, revno])
+    return [tuple(r) for r in ranges]
+
+
+def _parse_log_xml(stream):
+    '''Parse svn log -v --xml output into dicts with revno, author, date,
+    message and paths (dicts with path, action and kind) keys, without
+    holding the whole log in memory'''
+    for event, elem in ET.iterparse(stream):
+        if elem.tag != 'logentry':
+            continue
+        date = elem.findtext('date')
+        if date:
+            date = datetime.strptime(date, '%Y-%m-%dT%H:%M:%S.%fZ')
+        yield dict(
+            revno=int(elem.get('revision')),
+            author=elem.findtext('author'),
+            date=date or None,
+            message=elem.findtext('msg'),
+            paths=[dict(path=h.really_unicode(p.text),
+                        action=p.get('action'),
+                        kind=p.get('kind'))
+                   for p in elem.findall('paths/path')])
+        elem.clear()
+
+
+def _collection(doc_cls):
+    return doc_cls.m.session.db[doc_cls.m.collection_name]
+
+
 Mapper.compile_all()
@@ -22,6 +22,7 @@
 from itertools import count, product
 from datetime import datetime
 from zipfile import ZipFile
+from cStringIO import StringIO
 
 from collections import defaultdict
 from pylons import tmpl_context as c, app_globals as g
@@ -42,7 +43,7 @@
 from allura.tests.model.test_repo import RepoImplTestBase
 
 from forgesvn import model as SM
-from forgesvn.model.svn import svn_path_exists
+from forgesvn.model.svn import svn_path_exists, _parse_log_xml, _ranges
 from forgesvn.tests import with_svn
 from allura.tests.decorators import with_tool
 
@@ -297,6 +298,23 @@ def test_svn_path_exists(self):
         assert svn_path_exists("file://%s" % repo_path)
         assert not svn_path_exists("file://%s/badpath" % repo_path)
 
+    def test_refresh_commits_info(self):
+        oids = [self.repo._impl._oid(revno) for revno in range(1, 6)]
+        def docs():
+            return (
+                dict((ci._id, (ci.message, ci.committed.name, ci.parent_ids))
+                     for ci in M.repo.CommitDoc.m.find(dict(_id={'$in': oids}))),
+                dict((di._id, sorted(di.differences))
+                     for di in M.repo.DiffInfoDoc.m.find(dict(_id={'$in': oids}))))
+        for oid in oids:
+            self.repo._impl.refresh_commit_info(oid, set(), lazy=False)
+        expected = docs()
+        M.repo.CommitDoc.m.remove(dict(_id={'$in': oids[2:]}))
+        M.repo.DiffInfoDoc.m.remove(dict(_id={'$in': oids}))
+        assert_equal(self.repo._impl.refresh_commits_info(oids, set(), lazy=False), 5)
+        assert_equal(docs(), expected)
+        assert_equal(self.repo._impl.refresh_commits_info(oids, set()), 0)
+
     def test_count_revisions(self):
         ci = mock.Mock(_id='deadbeef:100')
         self.assertEqual(self.repo.count_revisions(ci), 100)
@@ -977,5 +995,58 @@ def open_blob(blob):
         assert ci.diffs.copied[1]['ratio'] < 1, ci.diffs.copied[1]['ratio']
         assert '+++' in ci.diffs.copied[1]['diff'], ci.diffs.copied[1]['diff']
 
+    def test_diffs_copies_by_id(self):
+        M.repo.DiffInfoDoc(dict(_id=self.ci._id, differences=[
+                    dict(name='a', lhs_id='x', rhs_id=None),
+                    dict(name='b', lhs_id=None, rhs_id='x'),
+                    dict(name='c', lhs_id='y', rhs_id=None),
+                    dict(name='d', lhs_id=None, rhs_id='z')])).m.save()
+        # renames with the same id are found without comparing content
+        with h.push_config(tg.config, **{'scm.diffs.rename_limit': '0'}):
+            diffs = self.ci.paged_diffs()
+        assert_equal(diffs.copied, [dict(old='a', new='b', ratio=1, diff='')])
+        assert_equal(diffs.removed, ['c'])
+        assert_equal(diffs.added, ['d'])
+        assert_equal(diffs.total, 4)
+        # and the copies are cached
+        assert_equal(len(M.repo.DiffCopiesDoc.m.get(_id=self.ci._id).copies), 1)
+        with mock.patch.object(M.repo.Commit, '_diffs_copied') as diffs_copied:
+            assert_equal(self.ci.paged_diffs(start=2).copied, [])
+        assert not diffs_copied.called
+
     def test_context(self):
         self.ci.context()
+
+
+def test_parse_log_xml():
+    entries = list(_parse_log_xml(StringIO('''<?xml version="1.0" encoding="UTF-8"?>
+<log>
+<logentry revision="5">
+<author>rick446</author>
+<date>2010-10-08T15:19:37.532106Z</date>
+<paths>
+<path kind="dir" copyfrom-path="/a" copyfrom-rev="4" action="A">/b</path>
+<path kind="file" action="M">/README</path>
+</paths>
+<msg>Copy a to b</msg>
+</logentry>
+<logentry revision="6">
+<paths>
+<path kind="" action="D">/b</path>
+</paths>
+<msg></msg>
+</logentry>
+</log>''')))
+    assert_equal(entries, [
+        dict(revno=5, author='rick446',
+             date=datetime(2010, 10, 8, 15, 19, 37, 532106),
+             message='Copy a to b',
+             paths=[dict(path='/b', action='A', kind='dir'),
+                    dict(path='/README', action='M', kind='file')]),
+        dict(revno=6, author=None, date=None, message='',
+             paths=[dict(path='/b', action='D', kind='')])])
+
+
+def test_ranges():
+    assert_equal(_ranges([]), [])
+    assert_equal(_ranges([1, 2, 3, 5, 7, 8]), [(1, 3), (5, 5), (7, 8)])
@@ -0,0 +1,54 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import sys
+
+from pylons import tmpl_context as c
+
+from allura.command import base
+from allura.lib import helpers as h
+from forgetracker.export_support import ExportSupport
+
+
+class ExportTickets(base.Command):
+    """Exports the tickets of a tracker as line-delimited JSON, one ticket
+    per line, with their comments and attachment metadata.  The output can
+    be loaded with tracker-import.
+
+    Usage:
+
+    paster tracker-export ../Allura/development.ini neighborhood project mount_point [output_file]
+
+    Writes to stdout if no output file is given.
+    """
+    group_name = 'ForgeTracker'
+    min_args = 4
+    max_args = 5
+    usage = '<ini file> <neighborhood> <project> <mount point> [<output file>]'
+    summary = 'Export the tickets of a tracker as line-delimited JSON'
+    parser = base.Command.standard_parser(verbose=True)
+
+    def command(self):
+        self.basic_setup()
+        h.set_context(self.args[2], self.args[3], neighborhood=self.args[1])
+        exporter = ExportSupport(c.app.config)
+        if len(self.args) > 4:
+            with open(self.args[4], 'w') as fp:
+                count = exporter.export(fp)
+        else:
+            count = exporter.export(sys.stdout)
+        base.log.info('Exported %s tickets', count)
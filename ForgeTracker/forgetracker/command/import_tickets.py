@@ -0,0 +1,73 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import os
+import json
+
+from pylons import tmpl_context as c
+from ming.orm import ThreadLocalORMSession
+
+from allura.command import base
+from allura import model as M
+from allura.lib import helpers as h
+from forgetracker.import_support import ImportSupport
+
+
+class ImportTickets(base.Command):
+    """Imports tickets from a file of line-delimited JSON, as written by
+    tracker-export.  The file is read as it is imported, tickets are
+    written in batches, and the tracker is reindexed once at the end.
+
+    Usage:
+
+    paster tracker-import ../Allura/development.ini neighborhood project mount_point input_file
+    """
+    group_name = 'ForgeTracker'
+    min_args = 5
+    max_args = 5
+    usage = '<ini file> <neighborhood> <project> <mount point> <input file>'
+    summary = 'Import tickets from a file of line-delimited JSON'
+    parser = base.Command.standard_parser(verbose=True)
+    parser.add_option('--user', dest='user', default='root',
+                      help='user to import as (default: %default)')
+    parser.add_option('--user-map', dest='user_map_file', metavar='JSON_FILE',
+                      help='map usernames in the file to Allura usernames')
+    parser.add_option('--create-users', action='store_true', dest='create_users',
+                      help='create placeholders for unknown users')
+    parser.add_option('--import-id', dest='import_id',
+                      help='import id to mark the tickets with (default: the file name)')
+
+    def command(self):
+        self.basic_setup()
+        h.set_context(self.args[2], self.args[3], neighborhood=self.args[1])
+        c.user = M.User.by_username(self.options.user)
+        options = {}
+        if self.options.user_map_file:
+            with open(self.options.user_map_file) as fp:
+                options['user_map'] = json.load(fp)
+        if self.options.create_users:
+            options['create_users'] = True
+        path = self.args[4]
+        import_id = self.options.import_id or os.path.basename(path)
+        with open(path) as fp:
+            result = ImportSupport().perform_stream_import(
+                fp, json.dumps(options), import_id=import_id)
+        for warning in result['warnings']:
+            base.log.warning(warning)
+        for error in result['errors']:
+            base.log.error(error)
+        ThreadLocalORMSession.flush_all()
@@ -0,0 +1,129 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import json
+import logging
+
+from allura import model as M
+from allura.lib import helpers as h
+from allura.lib import utils
+
+from forgetracker import model as TM
+
+log = logging.getLogger(__name__)
+
+
+class ExportSupport(object):
+    '''Exports a tracker as line-delimited JSON: one ticket per line, with
+    its comments and the metadata of its attachments, in the format that
+    ImportSupport.perform_stream_import reads.
+
+    Tickets are read BATCH_SIZE at a time, with one query per batch for
+    their threads, comments, attachments and users, and dropped from the
+    session once written, so memory use doesn't grow with the tracker.
+    '''
+
+    BATCH_SIZE = 500
+
+    def __init__(self, app_config):
+        self.app_config = app_config
+        # user _id => username
+        self.usernames = {}
+
+    def export(self, fp):
+        '''Write the tickets to fp.  Returns how many there were.'''
+        count = 0
+        for ticket in self.iter_tickets():
+            fp.write(json.dumps(ticket) + '\n')
+            count += 1
+        return count
+
+    def iter_tickets(self):
+        query = dict(app_config_id=self.app_config._id, deleted=False)
+        for tickets in utils.chunked_find(TM.Ticket, query, pagesize=self.BATCH_SIZE,
+                                          sort_key='ticket_num'):
+            comments = self.comments_for(tickets)
+            attachments = self.attachments_for(tickets)
+            self.load_usernames(
+                [t.reported_by_id for t in tickets] +
+                [t.assigned_to_id for t in tickets] +
+                [p.author_id for posts in comments.itervalues() for p in posts])
+            for t in tickets:
+                yield self.ticket_dict(t, comments.get(t._id, []), attachments.get(t._id, []))
+            log.info('Exported tickets up to #%s', tickets[-1].ticket_num)
+            M.artifact_orm_session.clear()
+
+    def comments_for(self, tickets):
+        '''Returns ticket _id => its comments, oldest first'''
+        tickets_by_ref = dict((t.index_id(), t) for t in tickets)
+        threads = dict(
+            (thread._id, tickets_by_ref[thread.ref_id])
+            for thread in M.Thread.query.find(dict(ref_id={'$in': tickets_by_ref.keys()})))
+        comments = {}
+        posts = M.Post.query.find(dict(thread_id={'$in': threads.keys()}, status='ok'))
+        for post in posts.sort('timestamp'):
+            comments.setdefault(threads[post.thread_id]._id, []).append(post)
+        return comments
+
+    def attachments_for(self, tickets):
+        '''Returns ticket _id => its attachments'''
+        attachments = {}
+        for att in TM.TicketAttachment.query.find(dict(
+                app_config_id=self.app_config._id,
+                artifact_id={'$in': [t._id for t in tickets]},
+                type='attachment')):
+            attachments.setdefault(att.artifact_id, []).append(att)
+        return attachments
+
+    def load_usernames(self, user_ids):
+        user_ids = set(user_ids) - set(self.usernames) - set([None])
+        if user_ids:
+            for u in M.User.query.find(dict(_id={'$in': list(user_ids)})):
+                self.usernames[u._id] = u.username
+
+    @staticmethod
+    def format_date(dt):
+        return dt.strftime('%Y-%m-%dT%H:%M:%SZ') if dt else None
+
+    def ticket_dict(self, ticket, comments, attachments):
+        d = dict(
+            id=ticket.ticket_num,
+            summary=ticket.summary,
+            description=ticket.description,
+            status=ticket.status,
+            keywords=' '.join(ticket.labels),
+            submitter=self.usernames.get(ticket.reported_by_id),
+            assigned_to=self.usernames.get(ticket.assigned_to_id),
+            date=self.format_date(ticket.created_date),
+            date_updated=self.format_date(ticket.mod_date),
+            comments=[dict(
+                    submitter=self.usernames.get(post.author_id),
+                    date=self.format_date(post.timestamp),
+                    comment=post.text)
+                for post in comments],
+            attachments=[dict(
+                    filename=att.filename,
+                    url=h.absurl(ticket.url() + 'attachment/' + h.urlquote(att.filename)),
+                    size=att.length)
+                for att in attachments])
+        # custom fields go by their names without the leading underscore,
+        # which the importer puts back
+        for name, value in ticket.custom_fields.iteritems():
+            if name.startswith('_'):
+                name = name[1:]
+            d.setdefault(name, value)
+        return d
@@ -28,6 +28,8 @@
 
 # Pyforge-specific imports
 from allura import model as M
+from allura.lib import utils
+from allura.tasks import index_tasks
 
 # Local imports
 from forgetracker import model as TM
@@ -85,6 +87,8 @@ def tell(self):
 class ImportSupport(object):
 
     ATTACHMENT_SIZE_LIMIT = 1024*1024
+    # tickets written per flush
+    BATCH_SIZE = 500
 
     def __init__(self):
         # Map JSON interchange format fields to Ticket fields
@@ -109,6 +113,11 @@ def __init__(self):
         self.warnings = []
         self.errors = []
         self.options = {}
+        self.import_id = None
+        # username => user _id (or None), for get_user_id
+        self.user_ids = {}
+        # numbers of the tickets made since the last flush
+        self.pending_ticket_nums = set()
 
 
     def init_options(self, options_json):
@@ -132,10 +141,10 @@ def parse_date(date_string):
 
     def get_user_id(self, username):
         username = self.options['user_map'].get(username, username)
-        u = M.User.by_username(username)
-        if u:
-            return u._id
-        return None
+        if username not in self.user_ids:
+            u = M.User.by_username(username)
+            self.user_ids[username] = u and u._id
+        return self.user_ids[username]
 
     def custom(self, ticket, field, value):
         field = '_' + field
@@ -167,29 +176,38 @@ def make_artifact(self, ticket_dict):
                 remapped[new_f] = conv(v)
 
         ticket_num = ticket_dict['id']
-        existing_ticket = TM.Ticket.query.get(app_config_id=c.app.config._id,
-                                          ticket_num=ticket_num)
+        existing_ticket = ticket_num in self.pending_ticket_nums or \
+            TM.Ticket.query.get(app_config_id=c.app.config._id, ticket_num=ticket_num)
         if existing_ticket:
+            # write out last_ticket_num before taking the next one
+            ThreadLocalORMSession.flush_all()
             ticket_num = c.app.globals.next_ticket_num()
             self.warnings.append('Ticket #%s: Ticket with this id already exists, using next available id: %s' % (ticket_dict['id'], ticket_num))
         else:
             if c.app.globals.last_ticket_num < ticket_num:
                 c.app.globals.last_ticket_num = ticket_num
-                ThreadLocalORMSession.flush_all()
+        self.pending_ticket_nums.add(ticket_num)
 
         ticket = TM.Ticket(
             app_config_id=c.app.config._id,
             custom_fields=dict(),
             ticket_num=ticket_num,
-            import_id=c.api_token.api_key)
+            import_id=self.import_id)
         ticket.update(remapped)
         return ticket
 
-    def make_comment(self, thread, comment_dict):
-        ts = self.parse_date(comment_dict['date'])
-        comment = thread.post(text=comment_dict['comment'], timestamp=ts)
-        comment.author_id = self.get_user_id(comment_dict['submitter'])
-        comment.import_id = c.api_token.api_key
+    def make_comments(self, comments):
+        '''Post comments, a list of (thread, comment_dict) pairs, together'''
+        posts = M.Thread.post_many(
+            [(thread, comment_dict['comment']) for thread, comment_dict in comments],
+            timestamps=[self.parse_date(comment_dict['date']) for thread, comment_dict in comments])
+        for post, (thread, comment_dict) in zip(posts, comments):
+            post.author_id = self.get_user_id(comment_dict['submitter'])
+            post.import_id = thread.import_id = self.import_id
+        # so that reindex_app finds their snapshots too
+        M.PostHistory.query.update(
+            dict(artifact_id={'$in': [post._id for post in posts]}),
+            {'$set': dict(import_id=self.import_id)}, multi=True)
 
     def make_attachment(self, org_ticket_id, ticket_id, att_dict):
         import urllib2
@@ -277,29 +295,72 @@ def perform_import(self, doc, options, **post_data):
             self.errors.append('Only single tracker import is supported')
             return self.errors, self.warnings
 
-        log.info('Import id: %s', c.api_token.api_key)
+        self.import_id = c.api_token.api_key
+        log.info('Import id: %s', self.import_id)
 
         artifacts = project_doc['trackers'][tracker_names[0]]['artifacts']
+        self.import_artifacts(artifacts)
+
+        return {'status': True, 'errors': self.errors, 'warnings': self.warnings}
 
+    def perform_stream_import(self, fp, options, import_id=None):
+        '''Import the tickets in fp, a file of line-delimited JSON with one
+        ticket per line (in the same format as the artifacts of a
+        perform_import document).  The file is read as the tickets are
+        imported, so it is never all in memory.'''
+        log.info('stream import called: %s', options)
+        self.init_options(options)
+        self.validate_user_mapping()
+
+        self.import_id = import_id or c.api_token.api_key
+        log.info('Import id: %s', self.import_id)
+
+        self.import_artifacts(json.loads(line) for line in fp if line.strip())
+
+        return {'status': True, 'errors': self.errors, 'warnings': self.warnings}
+
+    def import_artifacts(self, artifacts):
+        '''Import artifacts (any iterable of ticket dicts), BATCH_SIZE at a
+        time.  Nothing is indexed while they are written; the tickets, threads
+        and comments of this import (by import_id) are indexed by one task
+        once they're all in.'''
+        session = M.session.artifact_orm_session._get()
+        session.disable_artifact_index = session.skip_mod_date = True
+        try:
+            for batch in utils.chunked_iter(artifacts, self.BATCH_SIZE):
+                self.import_batch(list(batch))
+        finally:
+            session.disable_artifact_index = session.skip_mod_date = False
+        c.app.globals.invalidate_bin_counts()
+        index_tasks.reindex_app.post(c.app.config._id, dict(import_id=self.import_id))
+
+    def import_batch(self, artifacts):
         if self.option('create_users'):
             users = self.collect_users(artifacts)
             unknown_users = self.find_unknown_users(users)
-            self.make_user_placeholders(unknown_users)
+            if unknown_users:
+                self.make_user_placeholders(unknown_users)
 
-        M.session.artifact_orm_session._get().skip_mod_date = True
+        tickets = []
         for a in artifacts:
             comments = a.pop('comments', [])
             attachments = a.pop('attachments', [])
-#            log.info(a)
             t = self.make_artifact(a)
-            for c_entry in comments:
-                self.make_comment(t.discussion_thread, c_entry)
+            tickets.append((t, comments))
             for a_entry in attachments:
                 try:
                     self.make_attachment(a['id'], t._id, a_entry)
                 except Exception, e:
                     self.warnings.append('Could not import attachment, skipped: %s' % e)
             log.info('Imported ticket: %d', t.ticket_num)
-        c.app.globals.invalidate_bin_counts()
-
-        return {'status': True, 'errors': self.errors, 'warnings': self.warnings}
+        # threads find their tickets through artifact references, which
+        # aren't made while indexing is off; posting needs them
+        ThreadLocalORMSession.flush_all()
+        for t, comments in tickets:
+            M.ArtifactReference.from_artifact(t)
+        self.make_comments([(t.discussion_thread, c_entry)
+                            for t, comments in tickets for c_entry in comments])
+        ThreadLocalORMSession.flush_all()
+        # the batch is written; don't keep its artifacts around
+        M.artifact_orm_session.clear()
+        self.pending_ticket_nums = set()
@@ -27,22 +27,23 @@
 from pylons import tmpl_context as c, app_globals as g
 from pprint import pformat
 
-from ming import schema
+from ming import schema, mim
 from ming.utils import LazyProperty
-from ming.orm import Mapper, session
+from ming.orm import Mapper, mapper, session
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty
 from ming.orm.declarative import MappedClass
 
 from allura.model import (Artifact, VersionedArtifact, Snapshot,
                           project_orm_session, BaseAttachment, VotableArtifact, AppConfig, Mailbox, User)
-from allura.model import User, Feed, Thread, Notification, ProjectRole
+from allura.model import User, Feed, Thread, Post, Notification, ProjectRole
 from allura.model import ACE, ALL_PERMISSIONS, DENY_ALL
 from allura.model.timeline import ActivityObject
 
 from allura.lib import security
-from allura.lib.search import search_artifact, SearchError
+from allura.lib.search import search_artifact, count_artifacts, SearchError
 from allura.lib import utils
 from allura.lib import helpers as h
+from allura.lib.zarkov_helpers import zero_fill_time_series, to_utc_timestamp
 from allura.tasks import mail_tasks
 
 from forgetracker.plugins import ImportIdConverter
@@ -56,6 +57,35 @@
 def get_default_for_solr_type(solr_type):
     return SOLR_TYPE_DEFAULTS.get(solr_type, u'')
 
+def _count_if(condition):
+    '''An aggregation $group accumulator counting the documents for which
+    condition is true'''
+    return {'$sum': {'$cond': [condition, 1, 0]}}
+
+def _status_in(names):
+    # there's no $in in aggregation expressions
+    if not names:
+        return False
+    return {'$or': [{'$eq': ['$status', name]} for name in sorted(names)]}
+
+def _aggregate(collection, pipeline):
+    '''Run an aggregation and return its result documents'''
+    return collection.aggregate(pipeline).get('result', [])
+
+def _aggregate_one(collection, pipeline):
+    '''Run an aggregation that groups to at most one document, and return
+    it (or an empty dict)'''
+    result = _aggregate(collection, pipeline)
+    return result[0] if result else {}
+
+def _time_series(buckets, period, begin, end):
+    '''Zero-filled [[timestamp, count], ...] from $group results keyed by
+    y, m and (for daily periods) d'''
+    series = [[to_utc_timestamp(datetime(b['_id']['y'], b['_id']['m'], b['_id'].get('d', 1))),
+               b['count']]
+              for b in buckets]
+    return zero_fill_time_series(series, period, begin, end)
+
 config = utils.ConfigProxy(
     common_suffix='forgemail.domain',
     new_solr='solr.use_new_types')
@@ -102,6 +132,16 @@ def next_ticket_num(cls):
         session(cls).expunge(gbl)
         return gbl.last_ticket_num
 
+    @classmethod
+    def next_ticket_nums(cls, count):
+        '''Reserve count consecutive ticket numbers, and return them'''
+        gbl = cls.query.find_and_modify(
+            query=dict(app_config_id=c.app.config._id),
+            update={'$inc': { 'last_ticket_num': count}},
+            new=True)
+        session(cls).expunge(gbl)
+        return range(gbl.last_ticket_num - count + 1, gbl.last_ticket_num + 1)
+
     @property
     def all_status_names(self):
         return ' '.join([self.open_status_names, self.closed_status_names])
@@ -156,15 +196,27 @@ def get_custom_field_solr_type(self, field_name):
         return None
 
     def update_bin_counts(self):
-        # Refresh bin counts
-        self._bin_counts_data = []
-        for b in Bin.query.find(dict(
-                app_config_id=self.app_config_id)):
-            if b.terms and '$USER' in b.terms:
-                continue  # skip queries with $USER variable, hits will be inconsistent for them
-            r = search_artifact(Ticket, b.terms, rows=0, short_timeout=False)
-            hits = r is not None and r.hits or 0
-            self._bin_counts_data.append(dict(summary=b.summary, hits=hits))
+        # Refresh bin counts, with one faceted search for all the bins
+        bins = [b for b in Bin.query.find(dict(app_config_id=self.app_config_id))
+                # skip queries with $USER variable, hits will be inconsistent for them
+                if not (b.terms and '$USER' in b.terms)]
+        queries = [b.terms for b in bins if b.terms]
+        try:
+            hits = dict(zip(queries, count_artifacts(Ticket, queries)))
+        except SearchError:
+            # one bad query fails the whole request, so count them one
+            # by one to get the rest right
+            log.info('Faceted bin count failed for %s, counting bins separately',
+                     self.app_config_id, exc_info=True)
+            hits = {}
+            for q in queries:
+                try:
+                    r = search_artifact(Ticket, q, rows=0, short_timeout=False)
+                    hits[q] = r is not None and r.hits or 0
+                except SearchError:
+                    log.info('Ticket bin search %r failed', q, exc_info=True)
+        self._bin_counts_data = [dict(summary=b.summary, hits=hits.get(b.terms, 0))
+                                 for b in bins]
         self._bin_counts_expire = \
             datetime.utcnow() + timedelta(minutes=60)
         self._bin_counts_invalidated = None
@@ -178,19 +230,153 @@ def bin_count(self, name):
             if d['summary'] == name: return d
         return dict(summary=name, hits=0)
 
+    def milestone_counts(self, user=None):
+        '''Count the tickets in each milestone that user can read, and how
+        many of them are closed.  Returns a dict of 'field:milestone' =>
+        dict(name, hits, closed), for all the milestone fields.'''
+        field_names = [fld.name for fld in self.milestone_fields]
+        if not field_names:
+            return {}
+        return self._count_milestones({}, field_names, user)
+
     def milestone_count(self, name):
         fld_name, m_name = name.split(':', 1)
         d = dict(name=name, hits=0, closed=0)
         if not (fld_name and m_name):
             return d
-        mongo_query = {'custom_fields.%s' % fld_name: m_name}
-        r = Ticket.query.find(dict(
-            mongo_query, app_config_id=c.app.config._id, deleted=False))
-        tickets = [t for t in r if security.has_access(t, 'read')]
-        d['hits'] = len(tickets)
-        d['closed'] = sum(1 for t in tickets
-                          if t.status in c.app.globals.set_of_closed_status_names)
-        return d
+        query = {'custom_fields.%s' % fld_name: m_name}
+        return self._count_milestones(query, [fld_name]).get(name, d)
+
+    def _count_milestones(self, query, field_names, user=None):
+        # One aggregation grouping the tickets by acl, closed or not, and
+        # milestones, rather than loading them.  Read access only depends on
+        # the acl (the tickets all share a parent), so it is checked once per
+        # distinct acl; all the public tickets share the empty one.
+        query = dict(query, app_config_id=self.app_config_id, deleted=False)
+        collection = session(Ticket).impl.db[mapper(Ticket).collection.m.collection_name]
+        closed_names = self.set_of_closed_status_names
+        if isinstance(collection, mim.Collection):
+            groups = self._group_milestones(collection, query, field_names)
+        else:
+            group_id = {'acl': '$acl', 'closed': _status_in(closed_names)}
+            for i, f in enumerate(field_names):
+                group_id['m%s' % i] = '$custom_fields.%s' % f
+            groups = _aggregate(collection, [
+                {'$match': query},
+                {'$group': {
+                    '_id': group_id,
+                    'hits': {'$sum': 1},
+                    'ticket_id': {'$first': '$_id'}}}])
+        by_acl = {}
+        for group in groups:
+            acl = tuple((ace['access'], ace['role_id'], ace['permission'])
+                        for ace in group['_id'].get('acl') or [])
+            by_acl.setdefault(acl, (group['ticket_id'], []))[1].append(group)
+        result = {}
+        for ticket_id, acl_groups in by_acl.itervalues():
+            ticket = Ticket.query.get(_id=ticket_id)
+            if not (ticket and security.has_access(ticket, 'read', user=user)()):
+                continue
+            for group in acl_groups:
+                for i, f in enumerate(field_names):
+                    m_name = group['_id'].get('m%s' % i)
+                    if m_name:
+                        key = '%s:%s' % (f, m_name)
+                        d = result.setdefault(key, dict(name=key, hits=0, closed=0))
+                        d['hits'] += group['hits']
+                        if group['_id']['closed']:
+                            d['closed'] += group['hits']
+        return result
+
+    def _group_milestones(self, collection, query, field_names):
+        '''The $group of _count_milestones, for mim, which can't aggregate'''
+        closed_names = self.set_of_closed_status_names
+        groups = {}
+        for doc in collection.find(query, ['status', 'acl', 'custom_fields']):
+            custom_fields = doc.get('custom_fields') or {}
+            group_id = dict(acl=doc.get('acl') or [],
+                            closed=doc.get('status') in closed_names)
+            for i, f in enumerate(field_names):
+                group_id['m%s' % i] = custom_fields.get(f)
+            group = groups.setdefault(repr(sorted(group_id.items())),
+                                      dict(_id=group_id, hits=0, ticket_id=doc['_id']))
+            group['hits'] += 1
+        return groups.values()
+
+    def stats(self, since=()):
+        '''Ticket and comment counts for this tracker, with one aggregation
+        over its tickets and one over its comments.
+
+        Returns a dict with the number of tickets (total, open and closed
+        exclude deleted tickets), the number of comments, and
+        tickets_since and comments_since: lists of how many tickets and
+        comments were created at or after each datetime in since.
+        '''
+        db = session(Ticket).impl.db
+        group = {
+            '_id': None,
+            'total': _count_if({'$eq': ['$deleted', False]}),
+            'open': _count_if({'$and': [
+                {'$eq': ['$deleted', False]},
+                _status_in(self.set_of_open_status_names)]}),
+            'closed': _count_if({'$and': [
+                {'$eq': ['$deleted', False]},
+                _status_in(self.set_of_closed_status_names)]}),
+        }
+        for i, when in enumerate(since):
+            group['since_%s' % i] = _count_if({'$gte': ['$created_date', when]})
+        tickets = _aggregate_one(db[Ticket.__mongometa__.name], [
+            {'$match': {'app_config_id': self.app_config_id}},
+            {'$group': group}])
+
+        app_config = AppConfig.query.get(_id=self.app_config_id)
+        group = {'_id': None, 'count': {'$sum': 1}}
+        for i, when in enumerate(since):
+            group['since_%s' % i] = _count_if({'$gte': ['$timestamp', when]})
+        comments = _aggregate_one(db[Post.__mongometa__.name], [
+            {'$match': {'discussion_id': app_config.discussion_id}},
+            {'$group': group}])
+
+        return dict(
+            total=tickets.get('total', 0),
+            open=tickets.get('open', 0),
+            closed=tickets.get('closed', 0),
+            comments=comments.get('count', 0),
+            tickets_since=[tickets.get('since_%s' % i, 0) for i in range(len(since))],
+            comments_since=[comments.get('since_%s' % i, 0) for i in range(len(since))])
+
+    def stats_series(self, begin, end, period='date'):
+        '''Tickets opened and closed per day (period='date') or per month
+        (period='month') from begin to end inclusive, in the same form as
+        the zarkov tracker series: dict(opened=[[timestamp, count], ...],
+        closed=[...]), zero-filled, with millisecond UTC timestamps.
+
+        Tickets closed before closed_date was tracked count as closed at
+        their last modification.
+        '''
+        if period == 'month':
+            begin = begin.replace(day=1)
+            bucket = {'y': {'$year': '$when'}, 'm': {'$month': '$when'}}
+        else:
+            bucket = {'y': {'$year': '$when'}, 'm': {'$month': '$when'},
+                      'd': {'$dayOfMonth': '$when'}}
+        begin = datetime(begin.year, begin.month, begin.day)
+        end = datetime(end.year, end.month, end.day)
+        when = {'$gte': begin, '$lt': end + timedelta(days=1)}
+        collection = session(Ticket).impl.db[Ticket.__mongometa__.name]
+        match = {'app_config_id': self.app_config_id, 'deleted': False}
+        opened = collection.aggregate([
+            {'$match': dict(match, created_date=when)},
+            {'$project': {'when': '$created_date'}},
+            {'$group': {'_id': bucket, 'count': {'$sum': 1}}}])
+        closed = collection.aggregate([
+            {'$match': dict(match, status={'$in': list(self.set_of_closed_status_names)})},
+            {'$project': {'when': {'$ifNull': ['$closed_date', '$mod_date']}}},
+            {'$match': {'when': when}},
+            {'$group': {'_id': bucket, 'count': {'$sum': 1}}}])
+        return dict(
+            opened=_time_series(opened.get('result', []), period, begin, end),
+            closed=_time_series(closed.get('result', []), period, begin, end))
 
     def invalidate_bin_counts(self):
         '''Force expiry of bin counts and queue them to be updated.'''
@@ -236,9 +422,24 @@ def move_tickets(self, ticket_ids, destination_tracker_id):
         original_ticket_nums = {t._id: t.ticket_num for t in tickets}
         users = User.query.find({'_id': {'$in': filtered.keys()}}).all()
         moved_tickets = {}
-        for ticket in tickets:
-            moved = ticket.move(tracker, notify=False)
+        moves = []
+        with h.push_context(tracker.project_id, app_config_id=tracker._id):
+            ticket_nums = Globals.next_ticket_nums(len(tickets))
+        for ticket, ticket_num in zip(tickets, ticket_nums):
+            moved, message = ticket._move(tracker, ticket_num=ticket_num)
             moved_tickets[moved._id] = moved
+            moves.append((moved, message))
+        with h.push_context(tracker.project_id, app_config_id=tracker._id):
+            threads = [t.discussion_thread for t, message in moves]
+            posts = Thread.post_many(
+                [(thread, message) for thread, (t, message) in zip(threads, moves)],
+                notify=False)
+            for thread, post, (t, message) in zip(threads, posts, moves):
+                # as Thread.add_post does
+                if not thread.first_post_id:
+                    thread.first_post_id = post._id
+                Feed.post(t, title=post.subject, description=post.text,
+                          link=post.url_paginated())
         mail = dict(
             fromaddr = str(c.user.email_address_header()),
             reply_to = str(c.user.email_address_header()),
@@ -394,6 +595,7 @@ class __mongometa__:
             'ticket_num',
             'app_config_id',
             ('app_config_id', 'custom_fields._milestone'),
+            ('app_config_id', 'acl.access'),
             'import_id',
             ]
         unique_indexes = [
@@ -401,6 +603,8 @@ class __mongometa__:
             ]
 
     type_s = 'Ticket'
+    # ticket numbers per boolean query in the solr read filter
+    FQ_CHUNK_SIZE = 500
     _id = FieldProperty(schema.ObjectId)
     created_date = FieldProperty(datetime, if_missing=datetime.utcnow)
 
@@ -411,6 +615,7 @@ class __mongometa__:
     assigned_to_id = ForeignIdProperty(User, if_missing=None)
     milestone = FieldProperty(str, if_missing='')
     status = FieldProperty(str, if_missing='')
+    closed_date = FieldProperty(datetime, if_missing=None)
     custom_fields = FieldProperty({str:None})
 
     reported_by = RelationProperty(User, via='reported_by_id')
@@ -590,10 +795,61 @@ def _set_private(self, bool_flag):
     private = property(_get_private, _set_private)
 
     def commit(self):
+        self._update_closed_date()
         VersionedArtifact.commit(self)
-        monitoring_email = self.app.config.options.get('TicketMonitoringEmail')
+        hist = None
         if self.version > 1:
             hist = TicketHistory.query.get(artifact_id=self._id, version=self.version-1)
+        self._committed(hist)
+
+    @classmethod
+    def commit_many(cls, tickets, messages=None, notify=False):
+        '''Commit changes made to many tickets at once, as ticket.commit()
+        would for each of them.  If messages (a dict of ticket _id =>
+        text) is given, each message is first posted to its ticket's
+        discussion thread.
+
+        Threads are looked up, and ticket and post snapshots saved, in
+        bulk; nothing is flushed, so the tickets are indexed together when
+        the session is next flushed.
+        '''
+        if not tickets:
+            return
+        if messages:
+            ref_ids = dict((t.index_id(), t) for t in tickets)
+            threads = dict(
+                (ref_ids[t.ref_id]._id, t)
+                for t in Thread.query.find(dict(ref_id={'$in': ref_ids.keys()})))
+            Thread.post_many(
+                [(threads.get(t._id) or t.discussion_thread, messages[t._id])
+                 for t in tickets if t._id in messages],
+                notify=notify)
+        for t in tickets:
+            t._update_closed_date()
+        super(Ticket, cls).commit_many(tickets)
+        prior = [t for t in tickets if t.version > 1]
+        hists = {}
+        if prior:
+            for hist in TicketHistory.query.find(dict(
+                    artifact_id={'$in': [t._id for t in prior]},
+                    version={'$in': list(set(t.version - 1 for t in prior))})):
+                hists[hist.artifact_id, hist.version] = hist
+        for t in tickets:
+            t._committed(hists.get((t._id, t.version - 1)))
+
+    def _update_closed_date(self):
+        # when the ticket was last closed, for the stats series
+        if self.status in c.app.globals.set_of_closed_status_names:
+            if self.closed_date is None:
+                self.closed_date = datetime.utcnow()
+        else:
+            self.closed_date = None
+
+    def _committed(self, hist):
+        '''Log, subscribe, notify and add feed items for a commit, given
+        the snapshot of the previous version'''
+        monitoring_email = self.app.config.options.get('TicketMonitoringEmail')
+        if self.version > 1:
             old = hist.data
             changes = ['Ticket %s has been modified: %s' % (
                     self.ticket_num, self.summary),
@@ -724,6 +980,14 @@ def _move_attach(self, attachments, attach_metadata, app_config):
 
     def move(self, app_config, notify=True):
         '''Move ticket from current tickets app to tickets app with given app_config'''
+        ticket, message = self._move(app_config)
+        with h.push_context(ticket.project_id, app_config_id=app_config._id):
+            ticket.discussion_thread.add_post(text=message, notify=notify)
+        return ticket
+
+    def _move(self, app_config, ticket_num=None):
+        '''Move the ticket, using ticket_num if it is given and still free.
+        Returns the moved ticket and the message to post about it.'''
         app = app_config.project.app_instance(app_config)
         prior_url = self.url()
         prior_app = self.app
@@ -770,8 +1034,9 @@ def move(self, app_config, notify=True):
 
         # move ticket. ensure unique ticket_num
         while True:
-            with h.push_context(app_config.project_id, app_config_id=app_config._id):
-                ticket_num = app.globals.next_ticket_num()
+            if ticket_num is None:
+                with h.push_context(app_config.project_id, app_config_id=app_config._id):
+                    ticket_num = app.globals.next_ticket_num()
             self.ticket_num = ticket_num
             self.app_config_id = app_config._id
             new_url = app_config.url() + str(self.ticket_num) + '/'
@@ -783,6 +1048,7 @@ def move(self, app_config, notify=True):
                 if 'duplicate' in err.args[0]:
                     log.warning('Try to create duplicate ticket %s when moving from %s' % (new_url, prior_url))
                     session(self).expunge(self)
+                    ticket_num = None
                     continue
 
         attach_metadata['type'] = 'thumbnail'
@@ -810,9 +1076,7 @@ def move(self, app_config, notify=True):
         if messages:
             message += '\n\nCan\'t be converted:\n\n'
         message += '\n'.join(messages)
-        with h.push_context(ticket.project_id, app_config_id=app_config._id):
-            ticket.discussion_thread.add_post(text=message, notify=notify)
-        return ticket
+        return ticket, message
 
     def __json__(self):
         return dict(super(Ticket,self).__json__(),
@@ -831,15 +1095,106 @@ def __json__(self):
             custom_fields=self.custom_fields)
 
     @classmethod
-    def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, deleted=False, **kw):
+    def _private_access(cls, app_config, user):
+        '''Find the private tickets of app_config that user can read.  Returns
+        a list of their (_id, ticket_num), and whether there are any private
+        tickets user can't read.
+
+        Only private tickets have DENY entries in their acl; any other
+        ticket can be read by whoever can read the tracker.  Read access
+        only depends on the acl (the tickets all share a parent), so it is
+        checked once per distinct acl, and only the tickets under a readable
+        acl are loaded.
+        '''
+        collection = session(cls).impl.db[mapper(cls).collection.m.collection_name]
+        query = {'app_config_id': app_config._id, 'acl.access': ACE.DENY}
+        in_mim = isinstance(collection, mim.Collection)
+        if in_mim:
+            # mim can't aggregate
+            groups = {}
+            for doc in collection.find(query, ['acl']):
+                groups.setdefault(repr(doc['acl']), dict(_id=doc['acl'], ticket_id=doc['_id']))
+            groups = groups.values()
+        else:
+            groups = _aggregate(collection, [
+                {'$match': query},
+                {'$group': {'_id': '$acl', 'ticket_id': {'$first': '$_id'}}}])
+        project = app_config.project.root_project
+        readable_acls, unreadable = [], False
+        for group in groups:
+            ticket = cls.query.get(_id=group['ticket_id'])
+            if ticket and security.has_access(ticket, 'read', user, project)():
+                readable_acls.append(group['_id'])
+            else:
+                unreadable = True
+        if not readable_acls:
+            return [], unreadable
+        if in_mim:
+            docs = [doc for doc in collection.find(query, ['ticket_num', 'acl'])
+                    if doc['acl'] in readable_acls]
+        else:
+            docs = collection.find(dict(query, acl={'$in': readable_acls}), ['ticket_num'])
+        return [(doc['_id'], doc['ticket_num']) for doc in docs], unreadable
+
+    @classmethod
+    def _read_query(cls, app_config, user):
+        '''Mongo query terms that limit tickets of app_config to the ones
+        user can read, or None if they can't read any.'''
+        project = app_config.project.root_project
+        readable, unreadable = cls._private_access(app_config, user)
+        if security.has_access(app_config, 'read', user, project)():
+            if not unreadable:
+                return {}
+            # all the tickets but the private ones, save those user can read
+            public = {'acl.access': {'$ne': ACE.DENY}}
+            if not readable:
+                return public
+            return {'$or': [public, {'_id': {'$in': [_id for _id, num in readable]}}]}
+        if not readable:
+            return None
+        return {'_id': {'$in': [_id for _id, num in readable]}}
+
+    @classmethod
+    def _read_fq(cls, app_config, user):
+        '''Like _read_query, but as a list of solr filter queries'''
+        project = app_config.project.root_project
+        readable, unreadable = cls._private_access(app_config, user)
+        # solr refuses boolean queries of more than 1024 clauses, so the
+        # ticket numbers are split between nested ones
+        nums = sorted(num for _id, num in readable)
+        clauses = ' OR '.join(
+            'ticket_num_i:(%s)' % ' OR '.join(str(num) for num in chunk)
+            for chunk in utils.chunked_iter(nums, cls.FQ_CHUNK_SIZE))
+        if security.has_access(app_config, 'read', user, project)():
+            if not unreadable:
+                return []
+            # there are usually far fewer private tickets someone can read
+            # (their own) than ones they can't, so exclude all private
+            # tickets but those
+            if not readable:
+                return ['-private_b:True']
+            return ['-(+private_b:True -(%s))' % clauses]
+        if not readable:
+            return None
+        return ['(%s)' % clauses]
+
+    @classmethod
+    def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, deleted=False,
+                    after=None, **kw):
         """
         Query tickets, filtering for 'read' permission, sorting and paginating the result.
 
+        Tickets the user can't read are left out by the query itself, so
+        every page but the last is full, and count is exact.  Results are
+        sorted by sort and then ticket_num, and the result includes a
+        'next' cursor: pass it back as after (instead of page) to get the
+        tickets following this page, without skipping over all the ones
+        before it.
+
         See also paged_search which does a solr search
         """
         limit, page, start = g.handle_paging(limit, page, default=25)
-        q = cls.query.find(dict(query, app_config_id=app_config._id, deleted=deleted))
-        q = q.sort('ticket_num', pymongo.DESCENDING)
+        field, direction = 'ticket_num', pymongo.DESCENDING
         if sort:
             field, direction = sort.split()
             if field.startswith('_'):
@@ -847,36 +1202,83 @@ def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, del
             direction = dict(
                 asc=pymongo.ASCENDING,
                 desc=pymongo.DESCENDING)[direction]
-            q = q.sort(field, direction)
-        q = q.skip(start)
-        q = q.limit(limit)
-        tickets = []
-        count = q.count()
-        for t in q:
-            if security.has_access(t, 'read', user, app_config.project.root_project):
-                tickets.append(t)
+        tickets, count, next_after = [], 0, None
+        read_query = cls._read_query(app_config, user)
+        if read_query is not None:
+            q_base = dict(query, app_config_id=app_config._id, deleted=deleted)
+            if '$or' in q_base and '$or' in read_query:
+                q_base = {'$and': [q_base, read_query]}
             else:
-                count = count -1
+                q_base.update(read_query)
+            count = cls.query.find(q_base).count()
+            q_page = q_base
+            if after is not None:
+                q_page = cls._keyset_query(app_config, q_base, field, direction, int(after))
+                start = 0
+            q = cls.query.find(q_page)
+            sort_keys = [(field, direction)]
+            if field != 'ticket_num':
+                sort_keys.append(('ticket_num', direction))
+            q = q.sort(sort_keys).skip(start).limit(limit)
+            tickets = q.all()
+            if len(tickets) == limit:
+                next_after = tickets[-1].ticket_num
 
         return dict(
             tickets=tickets,
             count=count, q=json.dumps(query), limit=limit, page=page, sort=sort,
-            **kw)
+            after=after, next=next_after, **kw)
+
+    @classmethod
+    def _keyset_query(cls, app_config, query, field, direction, after):
+        '''Narrow query to the tickets that sort after ticket number after'''
+        op = '$gt' if direction == pymongo.ASCENDING else '$lt'
+        if field == 'ticket_num':
+            return dict(query, ticket_num={op: after})
+        ticket = cls.query.get(app_config_id=app_config._id, ticket_num=after)
+        if ticket is None:
+            # the cursor ticket is gone (moved, say); fall back to ticket_num
+            return dict(query, ticket_num={op: after})
+        value = ticket
+        for name in field.split('.'):
+            value = value.get(name) if isinstance(value, dict) else getattr(value, name, None)
+        same = {field: value, 'ticket_num': {op: after}}
+        if value is None:
+            # missing values sort before everything else
+            if direction == pymongo.ASCENDING:
+                keyset = [{field: {'$ne': None}}, same]
+            else:
+                keyset = [same]
+        elif direction == pymongo.ASCENDING:
+            keyset = [{field: {op: value}}, same]
+        else:
+            # ... so they all follow a non-missing value when descending
+            keyset = [{field: {op: value}}, same, {field: None}]
+        if '$or' in query:
+            return {'$and': [query, {'$or': keyset}]}
+        return dict(query, **{'$or': keyset})
 
     @classmethod
-    def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_deleted=False, **kw):
+    def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_deleted=False,
+                     after=None, **kw):
         """Query tickets from Solr, filtering for 'read' permission, sorting and paginating the result.
 
         See also paged_query which does a mongo search.
 
         We do the sorting and skipping right in SOLR, before we ever ask
-        Mongo for the actual tickets.  Other keywords for
+        Mongo for the actual tickets.  Tickets the user can't read (and
+        deleted ones, unless show_deleted) are filtered out in SOLR too, so
+        pages are full and count is exact.  Other keywords for
         search_artifact (e.g., history) or for SOLR are accepted through
         kw.  The output is intended to be used directly in templates,
         e.g., exposed controller methods can just:
 
             return paged_query(q, ...)
 
+        When sorting by ticket number (the default), the result includes a
+        'next' cursor, which can be passed back as after (instead of page)
+        to get the following page; otherwise 'next' is None.
+
         If you want all the results at once instead of paged you have
         these options:
           - don't call this routine, search directly in mongo
@@ -888,13 +1290,23 @@ def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_d
         limit, page, start = g.handle_paging(limit, page, default=25)
         count = 0
         tickets = []
+        next_after = None
         refined_sort = sort if sort else 'ticket_num_i desc'
         if  'ticket_num_i' not in refined_sort:
             refined_sort += ',ticket_num_i asc'
+        sort_field, sort_dir = (refined_sort.split(',')[0].split() + ['asc'])[:2]
+        keyset = sort_field == 'ticket_num_i'
         try:
-            if q:
+            fq = cls._read_fq(app_config, user) if q else None
+            if fq is not None:
+                if not show_deleted:
+                    fq.append('-deleted_b:true')
+                if keyset and after is not None:
+                    fq.append('ticket_num_i:' + (
+                        '{%d TO *}' if sort_dir == 'asc' else '{* TO %d}') % int(after))
+                    start = 0
                 matches = search_artifact(
-                    cls, q, short_timeout=True,
+                    cls, q, short_timeout=True, fq=fq,
                     rows=limit, sort=refined_sort, start=start, fl='ticket_num_i', **kw)
             else:
                 matches = None
@@ -906,6 +1318,8 @@ def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_d
             count = matches.hits
             # ticket_numbers is in sorted order
             ticket_numbers = [match['ticket_num_i'] for match in matches.docs]
+            if keyset and len(ticket_numbers) == limit:
+                next_after = ticket_numbers[-1]
             # but query, unfortunately, returns results in arbitrary order
             query = cls.query.find(dict(app_config_id=app_config._id, ticket_num={'$in':ticket_numbers}))
             # so stick all the results in a dictionary...
@@ -913,17 +1327,20 @@ def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, show_d
             for t in query:
                 ticket_for_num[t.ticket_num] = t
             # and pull them out in the order given by ticket_numbers
+            found = [ticket_for_num[tn] for tn in ticket_numbers if tn in ticket_for_num]
+            project = app_config.project.root_project
+            deletable = set()
+            if show_deleted:
+                deletable = set(id(t) for t in security.has_access_many(found, 'delete', user, project))
             tickets = []
-            for tn in ticket_numbers:
-                if tn in ticket_for_num:
-                    show_deleted = show_deleted and security.has_access(ticket_for_num[tn], 'delete', user, app_config.project.root_project)
-                    if (security.has_access(ticket_for_num[tn], 'read', user, app_config.project.root_project) and
-                        (show_deleted or ticket_for_num[tn].deleted==False)):
-                        tickets.append(ticket_for_num[tn])
-                    else:
-                        count = count -1
+            for t in found:
+                if id(t) in deletable or t.deleted==False:
+                    tickets.append(t)
+                else:
+                    count = count -1
         return dict(tickets=tickets,
                     count=count, q=q, limit=limit, page=page, sort=sort,
+                    after=after, next=next_after,
                     solr_error=solr_error, **kw)
 
 class TicketAttachment(BaseAttachment):
@@ -18,14 +18,20 @@
 import os
 import json
 from datetime import datetime, timedelta
+from cStringIO import StringIO
 from nose.tools import assert_equal
 
+import mock
 import ming
-from pylons import app_globals as g
+from pylons import app_globals as g, tmpl_context as c
 
 from allura import model as M
+from allura.lib import helpers as h
 from alluratest.controller import TestRestApiBase
 from allura.tests import decorators as td
+from forgetracker.import_support import ImportSupport
+from forgetracker.export_support import ExportSupport
+from forgetracker import model as TM
 
 class TestImportController(TestRestApiBase):
 
@@ -127,3 +133,70 @@ def test_import(self):
         assert ticket_json['summary'] in r
         r = self.app.get('/p/test/bugs/')
         assert ticket_json['summary'] in r
+
+    @td.with_tracker
+    def test_stream_import_export(self):
+        here_dir = os.path.dirname(__file__)
+        doc_json = json.loads(open(here_dir + '/data/sf.json').read())
+        ticket_json = doc_json['trackers']['default']['artifacts'][0]
+        h.set_context('test', 'bugs', neighborhood='Projects')
+        c.user = M.User.by_username('test-admin')
+        r = ImportSupport().perform_stream_import(
+            StringIO(json.dumps(ticket_json) + '\n'),
+            '{"user_map": {"hinojosa4": "test-admin", "ma_boehm": "test-user"}}',
+            import_id='stream-test')
+        assert r['status']
+        assert_equal(r['errors'], [])
+
+        ming.orm.ThreadLocalORMSession.flush_all()
+        M.MonQTask.run_ready()
+        ming.orm.ThreadLocalORMSession.flush_all()
+
+        indexed_tickets = filter(lambda a: a['type_s'] == 'Ticket', g.solr.db.values())
+        assert_equal(len(indexed_tickets), 1)
+        assert_equal(indexed_tickets[0]['ticket_num_i'], ticket_json['id'])
+        # the reindex only covers this import, comments included
+        indexed_posts = filter(lambda a: a['type_s'] == 'Post', g.solr.db.values())
+        assert_equal(len(indexed_posts), len(ticket_json['comments']))
+        r = self.app.get('/rest/p/test/bugs/204/')
+        self.verify_ticket(r.json['ticket'], ticket_json)
+
+        h.set_context('test', 'bugs', neighborhood='Projects')
+        out = StringIO()
+        assert_equal(ExportSupport(c.app.config).export(out), 1)
+        exported = json.loads(out.getvalue())
+        for key in ('id', 'summary', 'description', 'status', 'date', 'date_updated',
+                    'resolution', 'cc'):
+            assert_equal(exported[key], ticket_json[key])
+        assert_equal(exported['submitter'], 'test-user')
+        assert_equal(exported['assigned_to'], 'test-admin')
+        assert_equal([cm['comment'] for cm in exported['comments']],
+                     [cm['comment'] for cm in ticket_json['comments']])
+
+    @td.with_tracker
+    def test_stream_import_indexes_every_batch(self):
+        here_dir = os.path.dirname(__file__)
+        doc_json = json.loads(open(here_dir + '/data/sf.json').read())
+        ticket_json = doc_json['trackers']['default']['artifacts'][0]
+        tickets = [dict(ticket_json, id=300 + i, summary='ticket %s' % i) for i in range(5)]
+        h.set_context('test', 'bugs', neighborhood='Projects')
+        c.user = M.User.by_username('test-admin')
+        with mock.patch.object(ImportSupport, 'BATCH_SIZE', 2):
+            r = ImportSupport().perform_stream_import(
+                StringIO(''.join(json.dumps(t) + '\n' for t in tickets)),
+                '{"user_map": {"hinojosa4": "test-admin", "ma_boehm": "test-user"}}',
+                import_id='stream-batches')
+        assert_equal(r['errors'], [])
+
+        ming.orm.ThreadLocalORMSession.flush_all()
+        M.MonQTask.run_ready()
+        ming.orm.ThreadLocalORMSession.flush_all()
+
+        indexed_tickets = [d['ticket_num_i'] for d in g.solr.db.values() if d['type_s'] == 'Ticket']
+        assert_equal(sorted(indexed_tickets), [300, 301, 302, 303, 304])
+        indexed_posts = filter(lambda a: a['type_s'] == 'Post', g.solr.db.values())
+        assert_equal(len(indexed_posts), 5 * len(ticket_json['comments']))
+        for ticket in TM.Ticket.query.find(dict(import_id='stream-batches')):
+            assert M.ArtifactReference.query.get(_id=ticket.index_id()), ticket.ticket_num
+            for post in ticket.discussion_thread.posts:
+                assert M.ArtifactReference.query.get(_id=post.index_id()), post.text
@@ -20,10 +20,12 @@
 from datetime import datetime, timedelta
 
 import forgetracker
-from forgetracker.model import Globals
+from forgetracker.model import Globals, Ticket
 from forgetracker.tests.unit import TrackerTestWithModel
 from pylons import tmpl_context as c
 from allura.lib import helpers as h
+from allura.lib.search import SearchError
+from allura import model as M
 
 from ming.orm.ormsession import ThreadLocalORMSession
 
@@ -44,6 +46,11 @@ def test_next_ticket_number_increments(self):
         assert Globals.next_ticket_num() == 1
         assert Globals.next_ticket_num() == 2
 
+    def test_next_ticket_nums(self):
+        assert_equal(Globals.next_ticket_num(), 1)
+        assert_equal(Globals.next_ticket_nums(3), [2, 3, 4])
+        assert_equal(Globals.next_ticket_num(), 5)
+
     def test_ticket_numbers_are_independent(self):
         assert Globals.next_ticket_num() == 1
         h.set_context('test', 'doc-bugs', neighborhood='Projects')
@@ -95,24 +102,132 @@ def test_invalidate_bin_counts(self, mock_dt, mock_task):
         assert_equal(gbl._bin_counts_invalidated, now)
 
     @mock.patch('forgetracker.model.ticket.Bin')
-    @mock.patch('forgetracker.model.ticket.search_artifact')
+    @mock.patch('forgetracker.model.ticket.count_artifacts')
     @mock.patch('forgetracker.model.ticket.datetime')
-    def test_update_bin_counts(self, mock_dt, mock_search, mock_bin):
+    def test_update_bin_counts(self, mock_dt, mock_count, mock_bin):
         now = datetime.utcnow().replace(microsecond=0)
         mock_dt.utcnow.return_value = now
         gbl = Globals()
         gbl._bin_counts_invalidated = now - timedelta(minutes=1)
-        mock_bin.query.find.return_value = [mock.Mock(summary='foo', terms='bar')]
-        mock_search().hits = 5
+        mock_bin.query.find.return_value = [
+            mock.Mock(summary='foo', terms='bar'),
+            mock.Mock(summary='mine', terms='assigned_to:$USER'),
+            mock.Mock(summary='baz', terms='qux')]
+        mock_count.return_value = [5, 3]
 
         assert_equal(gbl._bin_counts_data, [])  # sanity pre-check
         gbl.update_bin_counts()
         assert mock_bin.query.find.called
-        mock_search.assert_called_with(forgetracker.model.Ticket, 'bar', rows=0, short_timeout=False)
-        assert_equal(gbl._bin_counts_data, [{'summary': 'foo', 'hits': 5}])
+        mock_count.assert_called_once_with(forgetracker.model.Ticket, ['bar', 'qux'])
+        assert_equal(gbl._bin_counts_data, [{'summary': 'foo', 'hits': 5},
+                                            {'summary': 'baz', 'hits': 3}])
         assert_equal(gbl._bin_counts_expire, now + timedelta(minutes=60))
         assert_equal(gbl._bin_counts_invalidated, None)
 
+    @mock.patch('forgetracker.model.ticket.Bin')
+    @mock.patch('forgetracker.model.ticket.search_artifact')
+    @mock.patch('forgetracker.model.ticket.count_artifacts')
+    def test_update_bin_counts_bad_query(self, mock_count, mock_search, mock_bin):
+        gbl = Globals()
+        mock_bin.query.find.return_value = [
+            mock.Mock(summary='foo', terms='bar'),
+            mock.Mock(summary='bad', terms='(')]
+        mock_count.side_effect = SearchError('bad query')
+        mock_search.side_effect = [mock.Mock(hits=5), SearchError('bad query')]
+        gbl.update_bin_counts()
+        mock_search.assert_called_with(forgetracker.model.Ticket, '(', rows=0, short_timeout=False)
+        assert_equal(gbl._bin_counts_data, [{'summary': 'foo', 'hits': 5},
+                                            {'summary': 'bad', 'hits': 0}])
+
+    def test_milestone_counts(self):
+        developer = M.ProjectRole.by_name('Developer')
+        Ticket(ticket_num=1, summary='t1', status='open',
+               custom_fields={'_milestone': '1.0'})
+        Ticket(ticket_num=2, summary='t2', status='closed',
+               custom_fields={'_milestone': '1.0'})
+        Ticket(ticket_num=3, summary='t3', status='open',
+               custom_fields={'_milestone': '2.0'})
+        Ticket(ticket_num=4, summary='t4', status='open', deleted=True,
+               custom_fields={'_milestone': '2.0'})
+        Ticket(ticket_num=5, summary='t5', status='open',
+               custom_fields={'_milestone': '2.0'},
+               acl=[M.ACE.allow(developer._id, 'read'), M.DENY_ALL])
+        Ticket(ticket_num=6, summary='t6', status='open')
+        ThreadLocalORMSession.flush_all()
+        gbl = c.app.globals
+        expected = {
+            '_milestone:1.0': dict(name='_milestone:1.0', hits=2, closed=1),
+            '_milestone:2.0': dict(name='_milestone:2.0', hits=2, closed=0),
+        }
+        assert_equal(gbl.milestone_counts(), expected)
+        assert_equal(gbl.milestone_count('_milestone:2.0'), expected['_milestone:2.0'])
+        assert_equal(gbl.milestone_count('_milestone:3.0'),
+                     dict(name='_milestone:3.0', hits=0, closed=0))
+
+        # the private ticket isn't counted for users who can't read it
+        anon = M.User.anonymous()
+        expected['_milestone:2.0']['hits'] = 1
+        assert_equal(gbl.milestone_counts(user=anon), expected)
+
+    @mock.patch('forgetracker.model.ticket.mim', mock.Mock(Collection=type('Collection', (object,), {})))
+    @mock.patch('forgetracker.model.ticket._aggregate')
+    def test_milestone_counts_aggregate(self, aggregate):
+        developer = M.ProjectRole.by_name('Developer')
+        public = Ticket(ticket_num=1, summary='t1')
+        private = Ticket(ticket_num=2, summary='t2',
+                         acl=[M.ACE.allow(developer._id, 'read'), M.DENY_ALL])
+        ThreadLocalORMSession.flush_all()
+        aggregate.return_value = [
+            dict(_id=dict(acl=[], closed=False, m0='1.0'), hits=3, ticket_id=public._id),
+            dict(_id=dict(acl=[], closed=True, m0='1.0'), hits=2, ticket_id=public._id),
+            dict(_id=dict(acl=[], closed=False), hits=4, ticket_id=public._id),
+            dict(_id=dict(acl=list(private.acl), closed=True, m0='2.0'), hits=1,
+                 ticket_id=private._id),
+        ]
+        gbl = c.app.globals
+        expected = {
+            '_milestone:1.0': dict(name='_milestone:1.0', hits=5, closed=2),
+            '_milestone:2.0': dict(name='_milestone:2.0', hits=1, closed=1),
+        }
+        assert_equal(gbl.milestone_counts(), expected)
+        pipeline = aggregate.call_args[0][1]
+        assert_equal(pipeline[0], {'$match': {'app_config_id': c.app.config._id, 'deleted': False}})
+        assert_equal(pipeline[1]['$group']['_id']['m0'], '$custom_fields._milestone')
+        # groups under an acl the user can't read aren't counted
+        del expected['_milestone:2.0']
+        assert_equal(gbl.milestone_counts(user=M.User.anonymous()), expected)
+
+
+    @mock.patch('forgetracker.model.ticket._aggregate_one')
+    def test_stats(self, aggregate):
+        aggregate.side_effect = [
+            dict(total=5, open=3, closed=2, since_0=1, since_1=4),
+            dict(count=7, since_0=2, since_1=6)]
+        now = datetime.utcnow()
+        since = [now - timedelta(days=7), now - timedelta(days=14)]
+        stats = c.app.globals.stats(since=since)
+        assert_equal(stats, dict(total=5, open=3, closed=2, comments=7,
+                                 tickets_since=[1, 4], comments_since=[2, 6]))
+        pipeline = aggregate.call_args_list[0][0][1]
+        assert_equal(pipeline[0], {'$match': {'app_config_id': c.app.config._id}})
+        assert_equal(pipeline[1]['$group']['since_1'],
+                     {'$sum': {'$cond': [{'$gte': ['$created_date', since[1]]}, 1, 0]}})
+
+        # nothing to count
+        aggregate.side_effect = [{}, {}]
+        stats = c.app.globals.stats()
+        assert_equal(stats, dict(total=0, open=0, closed=0, comments=0,
+                                 tickets_since=[], comments_since=[]))
+
+    def test_time_series(self):
+        from forgetracker.model.ticket import _time_series
+        buckets = [{'_id': {'y': 2013, 'm': 6, 'd': 2}, 'count': 3}]
+        assert_equal(_time_series(buckets, 'date', datetime(2013, 6, 1), datetime(2013, 6, 3)),
+                     [[1370044800000.0, 0], [1370131200000.0, 3], [1370217600000.0, 0]])
+        buckets = [{'_id': {'y': 2013, 'm': 7}, 'count': 2}]
+        assert_equal(_time_series(buckets, 'month', datetime(2013, 6, 1), datetime(2013, 7, 15)),
+                     [[1370044800000.0, 0], [1372636800000.0, 2]])
+
 
 class TestCustomFields(TrackerTestWithModel):
     def test_it_has_sortable_custom_fields(self):
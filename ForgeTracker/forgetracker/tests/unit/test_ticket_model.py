@@ -18,6 +18,7 @@
 from pylons import tmpl_context as c
 from datetime import datetime
 
+import mock
 from ming.orm.ormsession import ThreadLocalORMSession
 from ming import schema
 from nose.tools import raises, assert_raises, assert_equal
@@ -261,3 +262,81 @@ def test_ticket_move_with_users_not_in_project(self):
         message += '\n- **_user_field_2**: test-user-0 (user not in project)'
         message += '\n- **assigned_to**: test-user-0 (user not in project)'
         assert_equal(post.text, message)
+
+    def test_read_filters(self):
+        from allura.websetup import bootstrap
+        observer = bootstrap.create_user('Random Non-Project User')
+        tickets = {}
+        for i in range(1, 6):
+            t = tickets[i] = Ticket(summary='ticket %s' % i, ticket_num=i,
+                                    reported_by_id=observer._id if i < 4 else c.user._id)
+            if i < 5:
+                t.private = True
+        ThreadLocalORMSession.flush_all()
+
+        # the private tickets observer reported, but not the other one
+        readable, unreadable = Ticket._private_access(c.app.config, observer)
+        assert_equal(sorted(num for _id, num in readable), [1, 2, 3])
+        assert unreadable
+        query = Ticket._read_query(c.app.config, observer)
+        assert_equal(query['$or'][0], {'acl.access': {'$ne': 'DENY'}})
+        assert_equal(set(query['$or'][1]['_id']['$in']), set(tickets[i]._id for i in (1, 2, 3)))
+        with mock.patch.object(Ticket, 'FQ_CHUNK_SIZE', 2):
+            assert_equal(Ticket._read_fq(c.app.config, observer), [
+                '-(+private_b:True -(ticket_num_i:(1 OR 2) OR ticket_num_i:(3)))'])
+
+        # admins read everything
+        assert_equal(Ticket._read_query(c.app.config, c.user), {})
+        assert_equal(Ticket._read_fq(c.app.config, c.user), [])
+
+    def test_paged_query(self):
+        from allura.websetup import bootstrap
+        observer = bootstrap.create_user('Random Non-Project User')
+        for i in range(1, 7):
+            t = Ticket(summary='ticket %s' % i, ticket_num=i,
+                       status='closed' if i % 2 else 'open')
+            if i in (2, 5):
+                t.private = True
+        ThreadLocalORMSession.flush_all()
+
+        # private tickets are filtered out in the query, so pages are full
+        r = Ticket.paged_query(c.app.config, observer, {}, limit=2)
+        assert_equal(r['count'], 4)
+        assert_equal([t.ticket_num for t in r['tickets']], [6, 4])
+        r = Ticket.paged_query(c.app.config, observer, {}, limit=2, page=1)
+        assert_equal([t.ticket_num for t in r['tickets']], [3, 1])
+        r = Ticket.paged_query(c.app.config, c.user, {}, limit=2, page=1)
+        assert_equal(r['count'], 6)
+        assert_equal([t.ticket_num for t in r['tickets']], [4, 3])
+
+        # following the cursor gives the same pages
+        r = Ticket.paged_query(c.app.config, observer, {}, limit=2)
+        assert_equal(r['next'], 4)
+        r = Ticket.paged_query(c.app.config, observer, {}, limit=2, after=r['next'])
+        assert_equal([t.ticket_num for t in r['tickets']], [3, 1])
+
+        # ties in the sort field are broken by ticket_num
+        pages = []
+        after = None
+        while True:
+            r = Ticket.paged_query(c.app.config, c.user, {}, limit=2,
+                                   sort='status asc', after=after)
+            pages.append([t.ticket_num for t in r['tickets']])
+            after = r['next']
+            if after is None: break
+        assert_equal(pages, [[1, 3], [5, 2], [4, 6], []])
+
+        # missing values sort last when descending, and the cursor gets to them
+        for t in Ticket.query.find():
+            t.assigned_to_id = {1: c.user._id, 4: c.user._id,
+                                3: observer._id, 6: observer._id}.get(t.ticket_num)
+        ThreadLocalORMSession.flush_all()
+        pages = []
+        after = None
+        while True:
+            r = Ticket.paged_query(c.app.config, c.user, {}, limit=3,
+                                   sort='assigned_to_id desc', after=after)
+            pages.append([t.ticket_num for t in r['tickets']])
+            after = r['next']
+            if after is None: break
+        assert_equal(pages, [[6, 3, 4], [1, 5, 2], []])
@@ -522,10 +522,12 @@ def bin_counts(self, *args, **kw):
     @expose('json:')
     def milestone_counts(self, *args, **kw):
         milestone_counts = []
+        counts = c.app.globals.milestone_counts()
         for fld in c.app.globals.milestone_fields:
             for m in getattr(fld, "milestones", []):
                 if m.complete: continue
-                count = c.app.globals.milestone_count('%s:%s' % (fld.name, m.name))['hits']
+                d = counts.get('%s:%s' % (fld.name, m.name))
+                count = d['hits'] if d else 0
                 name = h.text.truncate(m.name, 72)
                 milestone_counts.append({'name': name, 'count': count})
         return {'milestone_counts': milestone_counts}
@@ -591,10 +593,12 @@ def milestones(self, **kw):
         require_access(c.app, 'configure')
         milestones = []
         c.date_field = W.date_field
+        counts = c.app.globals.milestone_counts()
         for fld in c.app.globals.milestone_fields:
             if fld.name == '_milestone':
                 for m in fld.milestones:
-                    d =  c.app.globals.milestone_count('%s:%s' % (fld.name, m.name))
+                    name = '%s:%s' % (fld.name, m.name)
+                    d = counts.get(name, dict(name=name, hits=0, closed=0))
                     milestones.append(dict(
                         name=m.name,
                         due_date=m.get('due_date'),
@@ -869,12 +873,17 @@ def update_tickets(self, **post_data):
 
         changes = {}
         changed_tickets = {}
+        user_cache = {}
+        def get_user(_id):
+            if _id not in user_cache:
+                user_cache[_id] = M.User.query.get(_id=_id)
+            return user_cache[_id]
         for ticket in tickets:
             message = ''
             for k, v in sorted(values.iteritems()):
                 if k == 'assigned_to_id':
-                    new_user = M.User.query.get(_id=v)
-                    old_user = M.User.query.get(_id=getattr(ticket, k))
+                    new_user = get_user(v)
+                    old_user = get_user(getattr(ticket, k))
                     if new_user:
                         message += get_change_text(
                             get_label(k),
@@ -902,8 +911,8 @@ def cf_val(cf):
             if message != '':
                 changes[ticket._id] = message
                 changed_tickets[ticket._id] = ticket
-                ticket.discussion_thread.post(message, notify=False)
-                ticket.commit()
+        TM.Ticket.commit_many(
+            [t for t in tickets if t._id in changed_tickets], changes)
 
         filtered_changes = c.app.globals.filtered_by_subscription(changed_tickets)
         users = M.User.query.find({'_id': {'$in': filtered_changes.keys()}}).all()
@@ -966,29 +975,10 @@ def changes_iter(user):
         flash('Updated {} ticket{}'.format(count, 's' if count != 1 else ''), 'ok')
         redirect('edit/' + post_data['__search'])
 
-    def tickets_since(self, when=None):
-        count = 0
-        if when:
-            count = TM.Ticket.query.find(dict(app_config_id=c.app.config._id,
-                created_date={'$gte':when})).count()
-        else:
-            count = TM.Ticket.query.find(dict(app_config_id=c.app.config._id)).count()
-        return count
-
-    def ticket_comments_since(self, when=None):
-        q = dict(
-            discussion_id=c.app.config.discussion_id)
-        if when is not None:
-            q['timestamp'] = {'$gte':when}
-        return M.Post.query.find(q).count()
-
     @with_trailing_slash
     @expose('jinja:forgetracker:templates/tracker/stats.html')
     def stats(self, dates=None, **kw):
         globals = c.app.globals
-        total = TM.Ticket.query.find(dict(app_config_id=c.app.config._id, deleted = False)).count()
-        open = TM.Ticket.query.find(dict(app_config_id=c.app.config._id, deleted = False, status={'$in': list(globals.set_of_open_status_names)})).count()
-        closed = TM.Ticket.query.find(dict(app_config_id=c.app.config._id, deleted = False, status={'$in': list(globals.set_of_closed_status_names)})).count()
         now = datetime.utcnow()
         week = timedelta(weeks=1)
         fortnight = timedelta(weeks=2)
@@ -996,21 +986,13 @@ def stats(self, dates=None, **kw):
         week_ago = now - week
         fortnight_ago = now - fortnight
         month_ago = now - month
-        week_tickets = self.tickets_since(week_ago)
-        fortnight_tickets = self.tickets_since(fortnight_ago)
-        month_tickets = self.tickets_since(month_ago)
-        comments=self.ticket_comments_since()
-        week_comments=self.ticket_comments_since(week_ago)
-        fortnight_comments=self.ticket_comments_since(fortnight_ago)
-        month_comments=self.ticket_comments_since(month_ago)
+        stats = globals.stats(since=[week_ago, fortnight_ago, month_ago])
+        week_tickets, fortnight_tickets, month_tickets = stats['tickets_since']
+        week_comments, fortnight_comments, month_comments = stats['comments_since']
         c.user_select = ffw.ProjectUserCombo()
         if dates is None:
             today = datetime.utcnow()
             dates = "%s to %s" % ((today - timedelta(days=61)).strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d'))
-        if c.app.config.get_tool_data('sfx', 'group_artifact_id') and config.get('zarkov.webservice_host'):
-            show_stats = True
-        else:
-            show_stats = False
         return dict(
                 now=str(now),
                 week_ago=str(week_ago),
@@ -1019,37 +1001,37 @@ def stats(self, dates=None, **kw):
                 week_tickets=week_tickets,
                 fortnight_tickets=fortnight_tickets,
                 month_tickets=month_tickets,
-                comments=comments,
+                comments=stats['comments'],
                 week_comments=week_comments,
                 fortnight_comments=fortnight_comments,
                 month_comments=month_comments,
-                total=total,
-                open=open,
-                closed=closed,
+                total=stats['total'],
+                open=stats['open'],
+                closed=stats['closed'],
                 globals=globals,
-                dates=dates,
-                show_stats=show_stats)
+                dates=dates)
 
     @expose('json:')
     def stats_data(self, begin=None, end=None, **kw):
+        if begin is None and end is None:
+            end_time = datetime.utcnow()
+            begin_time = (end_time - timedelta(days=61))
+            end = end_time.strftime('%Y-%m-%d')
+            begin = begin_time.strftime('%Y-%m-%d')
+        else:
+            end_time = datetime.strptime(end,'%Y-%m-%d')
+            begin_time = datetime.strptime(begin,'%Y-%m-%d')
+        time_interval = 'date'
+        if end_time - begin_time > timedelta(days=183):
+            time_interval = 'month'
         if c.app.config.get_tool_data('sfx', 'group_artifact_id') and config.get('zarkov.webservice_host'):
-            if begin is None and end is None:
-                end_time = datetime.utcnow()
-                begin_time = (end_time - timedelta(days=61))
-                end = end_time.strftime('%Y-%m-%d')
-                begin = begin_time.strftime('%Y-%m-%d')
-            else:
-                end_time = datetime.strptime(end,'%Y-%m-%d')
-                begin_time = datetime.strptime(begin,'%Y-%m-%d')
-            time_interval = 'date'
-            if end_time - begin_time > timedelta(days=183):
-                time_interval = 'month'
             q_filter = 'group-tracker-%s/%s/%s/' % (time_interval,c.project.get_tool_data('sfx', 'group_id'),c.app.config.get_tool_data('sfx', 'group_artifact_id'))
             params = urlencode({'data': '{"c":"tracker","b":"'+q_filter+begin+'","e":"'+q_filter+end+'"}'})
             read_zarkov = json.load(urlopen(config.get('zarkov.webservice_host')+'/q', params))
             return zero_fill_zarkov_result(read_zarkov, time_interval, begin, end)
         else:
-            return dict()
+            return dict(data=c.app.globals.stats_series(
+                begin_time, end_time, period=time_interval))
 
     @expose()
     @validate(W.subscribe_form)
@@ -1681,9 +1663,9 @@ def _check_security(self):
         require_access(c.app, 'read')
 
     @expose('json:')
-    def index(self, limit=100, page=0, **kw):
+    def index(self, limit=100, page=0, after=None, **kw):
         results = TM.Ticket.paged_query(c.app.config, c.user, query={},
-                                        limit=int(limit), page=int(page))
+                                        limit=int(limit), page=int(page), after=after)
         results['tickets'] = [dict(ticket_num=t.ticket_num, summary=t.summary)
                               for t in results['tickets']]
         results.pop('q', None)
@@ -1726,15 +1708,20 @@ def perform_import(self, doc=None, options=None, **post_data):
 
         migrator = ImportSupport()
         try:
-            status = migrator.perform_import(doc, options, **post_data)
+            if hasattr(doc, 'file'):
+                # an uploaded file of line-delimited JSON, one ticket per line
+                status = migrator.perform_stream_import(doc.file, options)
+            else:
+                status = migrator.perform_import(doc, options, **post_data)
             return status
         except Exception, e:
             log.exception(e)
             return dict(status=False, errors=[str(e)])
 
     @expose('json:')
-    def search(self, q=None, limit=100, page=0, sort=None, **kw):
-        results = TM.Ticket.paged_search(c.app.config, c.user, q, limit, page, sort, show_deleted=False)
+    def search(self, q=None, limit=100, page=0, sort=None, after=None, **kw):
+        results = TM.Ticket.paged_search(c.app.config, c.user, q, limit, page, sort,
+                                         show_deleted=False, after=after)
         results['tickets'] = [dict(ticket_num=t.ticket_num, summary=t.summary)
                               for t in results['tickets']]
         return results
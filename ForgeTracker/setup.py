@@ -51,5 +51,7 @@
 
       [paste.paster_command]
       fix-discussion = forgetracker.command.fix_discussion:FixDiscussion
+      tracker-export = forgetracker.command.export_tickets:ExportTickets
+      tracker-import = forgetracker.command.import_tickets:ImportTickets
       """,
       )